@@ -0,0 +1,185 @@
+# sharded block backfill: N worker processes, each with its own IPC connection and NodeInfo
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import shutil
+import time
+
+import rate_limiter
+from node_information import NodeInfo
+
+DEFAULT_CHUNK_SIZE = 100
+DEFAULT_WORKERS = max(1, multiprocessing.cpu_count() - 1)
+# seconds between checks that the workers are still alive while waiting for results
+RESULT_POLL_INTERVAL = 1
+DEFAULT_LOGGER = logging.getLogger(__name__)
+
+
+def chunk_ranges(start_block, end_block, chunk_size):
+    """
+    Splits the inclusive range [start_block, end_block] into (first, last) chunks.
+    """
+    output = []
+    first = start_block
+    while first <= end_block:
+        last = min(first + chunk_size - 1, end_block)
+        output.append((first, last))
+        first = last + 1
+    return output
+
+
+def part_path(parts_dir, chunk):
+    return os.path.join(parts_dir, "blocks_{0}_{1}.jsonl".format(chunk[0], chunk[1]))
+
+
+def _worker(config, chunks, results, parts_dir, log_level):
+    logger = logging.getLogger("Backfill worker {0}".format(os.getpid()))
+    logger.setLevel(log_level)
+    # a forked worker inherits the parent's controller; build one from this worker's config
+    rate_limiter.reset()
+    node_info = NodeInfo(logger, config, rate_limiter.PRIORITY_BACKFILL)
+    while True:
+        # None is the sentinel telling this worker there are no chunks left
+        chunk = chunks.get()
+        if chunk is None:
+            break
+        start = time.time()
+        try:
+            results.put(_fetch_chunk(node_info, chunk, parts_dir) + (time.time() - start,))
+        except Exception as err:
+            results.put((chunk, False, repr(err), time.time() - start))
+
+
+def _fetch_chunk(node_info, chunk, parts_dir):
+    """
+    Writes the chunk's blocks to its part file; returns (chunk, success, error).
+    """
+    if not node_info._check_synced():
+        return chunk, False, "node not synchronized"
+    tmp_path = part_path(parts_dir, chunk) + ".tmp"
+    output_stream = open(tmp_path, "w")
+    failed_block = None
+    try:
+        for block_number in range(chunk[0], chunk[1] + 1):
+            block_data = node_info._getBlockData(block_number)
+            if block_data is None:
+                failed_block = block_number
+                break
+            output_stream.write(str(block_data))
+            output_stream.write("\n")
+    except Exception:
+        output_stream.close()
+        os.unlink(tmp_path)
+        raise
+    output_stream.close()
+    if failed_block is None:
+        os.rename(tmp_path, part_path(parts_dir, chunk))
+        return chunk, True, None
+    os.unlink(tmp_path)
+    return chunk, False, "could not get block {0}".format(failed_block)
+
+
+def load_checkpoint(checkpoint_file):
+    done = set()
+    if os.path.exists(checkpoint_file):
+        checkpoint_stream = open(checkpoint_file, "r")
+        for line in checkpoint_stream:
+            if line.strip():
+                done.add(tuple(json.loads(line)))
+        checkpoint_stream.close()
+    return done
+
+
+def run_backfill(config, start_block, end_block, output_file, workers=DEFAULT_WORKERS,
+                 chunk_size=DEFAULT_CHUNK_SIZE, logger=None, worker_log_level=logging.WARNING):
+    """
+    Fetches every block in [start_block, end_block] into output_file, one
+    BlockData JSON per line in block order. Workers take chunks off a shared
+    queue as they finish, so a slow chunk doesn't hold up the rest. Finished
+    chunks are recorded in <output_file>.checkpoint, so an interrupted run
+    resumes where it left off. config['backfill_rpc_rate_limit'] caps the
+    workers' combined RPC rate so live commands keep the node responsive;
+    with config['rpc_rate_limit_file'] the workers instead draw from the
+    host's shared budget behind every other caller.
+
+    :return: list of (chunk, error) for chunks that failed; empty on success
+    """
+    log = (logger or DEFAULT_LOGGER).info
+    checkpoint_file = output_file + ".checkpoint"
+    parts_dir = output_file + ".parts"
+    if not os.path.isdir(parts_dir):
+        os.makedirs(parts_dir)
+
+    all_chunks = chunk_ranges(start_block, end_block, chunk_size)
+    done = set(chunk for chunk in load_checkpoint(checkpoint_file) if os.path.exists(part_path(parts_dir, chunk)))
+    remaining = [chunk for chunk in all_chunks if chunk not in done]
+    log("Backfill {0}-{1}: {2} chunks, {3} already done, {4} workers".format(
+        start_block, end_block, len(all_chunks), len(all_chunks) - len(remaining), workers))
+
+    process_count = min(workers, len(remaining))
+    if config.get("backfill_rpc_rate_limit") and process_count and not config.get("rpc_rate_limit_file"):
+        # each worker process has its own limiter, so they split the backfill's budget; the burst
+        # falls back to one second of a worker's rate
+        config = dict(config, rpc_rate_limit=config["backfill_rpc_rate_limit"] / process_count, rpc_burst=None)
+    chunks = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    for chunk in remaining:
+        chunks.put(chunk)
+    for _ in range(process_count):
+        chunks.put(None)
+    processes = [multiprocessing.Process(target=_worker, args=(config, chunks, results, parts_dir, worker_log_level))
+                 for _ in range(process_count)]
+    for each in processes:
+        each.start()
+
+    failures = []
+    checkpoint_stream = open(checkpoint_file, "a")
+    outstanding = set(remaining)
+    drained = False
+    while outstanding:
+        try:
+            chunk, success, error, elapsed = results.get(timeout=RESULT_POLL_INTERVAL)
+        except queue.Empty:
+            if any(each.is_alive() for each in processes):
+                continue
+            if not drained:
+                # a result may have been put just before its worker exited
+                drained = True
+                continue
+            # every worker has exited, whatever they were working on will never be reported
+            exit_codes = [each.exitcode for each in processes]
+            for chunk in sorted(outstanding):
+                failures.append((chunk, "worker exited (exit codes {0})".format(exit_codes)))
+                log("Chunk {0}-{1} failed: worker exited (exit codes {2})".format(chunk[0], chunk[1], exit_codes))
+            break
+        outstanding.discard(chunk)
+        if success:
+            checkpoint_stream.write(json.dumps(list(chunk)) + "\n")
+            checkpoint_stream.flush()
+            done.add(chunk)
+            log("Chunk {0}-{1} done in {2:.2f}s ({3}/{4})".format(chunk[0], chunk[1], elapsed,
+                                                                 len(done), len(all_chunks)))
+        else:
+            failures.append((chunk, error))
+            log("Chunk {0}-{1} failed: {2}".format(chunk[0], chunk[1], error))
+    checkpoint_stream.close()
+    for each in processes:
+        each.join()
+
+    if failures:
+        log("{0} chunks failed, rerun the same command to retry them".format(len(failures)))
+        return failures
+
+    # ordered merge of the per-chunk files
+    output_stream = open(output_file, "w")
+    for chunk in all_chunks:
+        part_stream = open(part_path(parts_dir, chunk), "r")
+        shutil.copyfileobj(part_stream, output_stream)
+        part_stream.close()
+    output_stream.close()
+    shutil.rmtree(parts_dir)
+    os.unlink(checkpoint_file)
+    log("Backfill complete: {0}".format(output_file))
+    return failures
@@ -0,0 +1,317 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import ipc_socket
+import ipc_test_harness
+import node_information
+import rpc_cache
+import rpc_interface
+import util
+
+HELP = """
+python3 benchmark.py [--output bench_output.json] [--compare baseline.json] [--threshold 1.25] [--quick]
+
+Runs the RPC/IPC hot path benchmarks against the local stand-in node
+(ipc_test_harness) and writes the results as JSON. With --compare, the mean
+and p50 timings are checked against the baseline file and the run exits
+non-zero if any of them regressed past its threshold.
+"""
+
+DEFAULT_OUTPUT = "bench_output.json"
+
+# allowed slowdown relative to the baseline before a metric counts as a regression
+DEFAULT_THRESHOLD = 1.25
+REGRESSION_THRESHOLDS = {
+    # anything going over a real socket is noisier than in-memory work
+    "geth_interface_send": 1.5,
+    "node_info_update": 1.5,
+    "node_info_update_cached": 1.5,
+}
+
+# tail latencies are too noisy to gate on, so only the central ones are compared
+COMPARED_METRICS = ("mean_seconds", "p50_seconds")
+
+BLOCK_SIZES = (0, 10, 100, 1000)
+
+
+def summarize(samples):
+    ordered = sorted(samples)
+    count = len(ordered)
+    total = sum(ordered)
+    return {"count": count,
+            "mean_seconds": total / count,
+            "min_seconds": ordered[0],
+            "p50_seconds": ordered[int(0.50 * (count - 1))],
+            "p95_seconds": ordered[int(0.95 * (count - 1))],
+            "p99_seconds": ordered[int(0.99 * (count - 1))],
+            "max_seconds": ordered[-1],
+            "ops_per_second": count / total if total else None}
+
+
+def time_calls(func, iterations):
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return summarize(samples)
+
+
+def synthetic_block(number, tx_count):
+    """
+    Full block in geth's eth_getBlockByNumber(..., true) shape with tx_count transactions.
+    """
+    transactions = []
+    for i in range(tx_count):
+        transactions.append({"blockHash": "0x%064x" % number,
+                             "blockNumber": hex(number),
+                             "from": "0x%040x" % (i + 1),
+                             "gas": hex(21000 + i),
+                             "gasPrice": hex(4000000000 + i),
+                             "hash": "0x%056x%08x" % (number, i),
+                             "input": "0x",
+                             "nonce": hex(i),
+                             "to": "0x%040x" % (i + 2),
+                             "transactionIndex": hex(i),
+                             "value": hex(10 ** 18 + i)})
+    return {"number": hex(number),
+            "hash": "0x%064x" % number,
+            "parentHash": "0x%064x" % (number - 1),
+            "timestamp": hex(1548808543 + number),
+            "gasUsed": hex(21000 * tx_count),
+            "gasLimit": hex(8000000),
+            "size": hex(1000 + 110 * tx_count),
+            "transactions": transactions}
+
+
+def bench_process_request(iterations):
+    rpc = rpc_interface.RPCInterface()
+
+    def call():
+        rpc.process_request({"method": "eth_gasPrice", "params": []})
+    result = time_calls(call, iterations)
+    rpc.outstanding_requests = []
+    return result
+
+
+def bench_process_response(iterations):
+    rpc = rpc_interface.RPCInterface()
+    responses = []
+    for _ in range(iterations):
+        request_data = rpc.eth_gas_price()
+        responses.append(ipc_test_harness.IPCTestHarness(request_data, {}).send())
+    samples = []
+    for each in responses:
+        start = time.perf_counter()
+        rpc.process_response(each)
+        samples.append(time.perf_counter() - start)
+    return summarize(samples)
+
+
+def bench_send(config, iterations):
+    rpc = rpc_interface.RPCInterface()
+
+    def call():
+        ipc_socket.GethInterface(rpc.eth_gas_price(), config, logging.getLogger("benchmark")).send()
+    return time_calls(call, iterations)
+
+
+def uncached_node_info(config):
+    node_info = node_information.NodeInfo(logging.getLogger("benchmark"), config)
+    node_info.rpc_cache = rpc_cache.RPCCache.disabled()
+    return node_info
+
+
+def bench_node_info_update(config, iterations):
+    return time_calls(uncached_node_info(config).update, iterations)
+
+
+def bench_node_info_update_cached(config, iterations):
+    node_info = node_information.NodeInfo(logging.getLogger("benchmark"), config)
+    node_info.rpc_cache = rpc_cache.RPCCache()
+    return time_calls(node_info.update, iterations)
+
+
+def bench_get_block_data(config, store, iterations):
+    node_info = uncached_node_info(config)
+    node_info.transport = ipc_test_harness.IPCTestHarness
+    output = {}
+    for tx_count in BLOCK_SIZES:
+        number = 9000000 + tx_count
+        store.add_block(synthetic_block(number, tx_count))
+        output[str(tx_count)] = time_calls(lambda: node_info._getBlockData(number), iterations)
+    return output
+
+
+def bench_block_str(config, iterations):
+    node_info = uncached_node_info(config)
+    node_info.transport = ipc_test_harness.IPCTestHarness
+    output = {}
+    for tx_count in BLOCK_SIZES:
+        block_data = node_info._getBlockData(9000000 + tx_count)
+        output[str(tx_count)] = time_calls(lambda: str(block_data), iterations)
+    return output
+
+
+def bench_block_upload(config, iterations):
+    """
+    Encoding cost and body size of the largest block in each upload format.
+    """
+    node_info = uncached_node_info(config)
+    node_info.transport = ipc_test_harness.IPCTestHarness
+    block_data = node_info._getBlockData(9000000 + BLOCK_SIZES[-1])
+    formats = {"legacy": (lambda: str(block_data), None),
+               "nested": (block_data.to_dict, None),
+               "nested_gzip": (block_data.to_dict, "gzip")}
+    output = {}
+    for name, (encode_input, compression) in formats.items():
+        def call():
+            return util.encode_json_body({"success": True, "command_id": 0, "input": encode_input()}, compression)
+        output[name] = time_calls(call, iterations)
+        output[name]["body_bytes"] = len(call()[0])
+    return output
+
+
+def bench_transfer_round_trips(server, transfers):
+    """
+    Node requests per node-signed transfer with gas from the estimate cache,
+    using the conservative new-recipient estimate and with recipients told
+    apart by a balanceOf call. Each transfer goes to a different address.
+    Returns None when web3 isn't installed.
+    """
+    try:
+        import erc20
+        import gas_cache
+    except ImportError:
+        return None
+    config_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config")
+    config = {"ipc_address": server.socket_path,
+              "max_rpc_tries": 1,
+              "account_password": "",
+              "abi": os.path.join(config_dir, "erc20.abi"),
+              "bin": os.path.join(config_dir, "erc20.bin")}
+    erc20.connect(config)
+    contract = erc20.ExecuteERC20Contract(config, "0x3c469e9d6c5875d37a43F353d4Ea8dA14f68B5c1",
+                                          logging.getLogger("benchmark"))
+    estimates = gas_cache.get_gas_cache(config)
+    output = {}
+    for name, split_recipients in (("conservative", False), ("balance_lookup", True)):
+        estimates.split_recipients = split_recipients
+        recipients = ["0x" + "{0:040x}".format(index + 1) for index in range(transfers + 1)]
+        # the first transfer fills the estimate cache
+        contract._send_transfer(erc20.Web3.toChecksumAddress(recipients.pop()), 1, 1)
+        before = dict(server.method_counts)
+
+        def call():
+            contract._send_transfer(erc20.Web3.toChecksumAddress(recipients.pop()), 1, 1)
+        output[name] = time_calls(call, transfers)
+        requests = dict((method, count - before.get(method, 0)) for method, count in server.method_counts.items()
+                        if count != before.get(method, 0))
+        output[name]["node_requests_per_transfer"] = sum(requests.values()) / transfers
+        output[name]["node_requests"] = requests
+    return output
+
+
+def flatten(results, prefix=""):
+    output = {}
+    for key, value in results.items():
+        name = prefix + "." + key if prefix else key
+        if type(value) is dict:
+            output.update(flatten(value, name))
+        else:
+            output[name] = value
+    return output
+
+
+def find_regressions(results, baseline, default_threshold=DEFAULT_THRESHOLD):
+    """
+    Returns a list of (metric, baseline, current, threshold) for every compared
+    metric that got slower than its threshold allows.
+    """
+    current = flatten(results)
+    previous = flatten(baseline)
+    regressions = []
+    for name, value in current.items():
+        if name.split(".")[-1] not in COMPARED_METRICS or name not in previous or not previous[name]:
+            continue
+        threshold = REGRESSION_THRESHOLDS.get(name.split(".")[0], default_threshold)
+        if value > previous[name] * threshold:
+            regressions.append((name, previous[name], value, threshold))
+    return regressions
+
+
+def current_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(quick=False):
+    # in-memory benchmarks are cheap; socket ones pay a connect per call
+    memory_iterations = 2000 if quick else 20000
+    socket_iterations = 100 if quick else 1000
+    block_iterations = 20 if quick else 200
+    transfer_iterations = 20 if quick else 200
+
+    ipc_test_harness.NODE_SYNCED = True
+    store = ipc_test_harness.get_fixture_store()
+    socket_dir = tempfile.mkdtemp()
+    server = ipc_test_harness.StandInGethServer(os.path.join(socket_dir, "geth.ipc"), store).start()
+    config = {"ipc_address": server.socket_path,
+              "max_rpc_tries": 1,
+              "account": "0x" + "00" * 20}
+    logging.getLogger("benchmark").setLevel(logging.WARNING)
+    try:
+        results = {"process_request": bench_process_request(memory_iterations),
+                   "process_response": bench_process_response(memory_iterations),
+                   "geth_interface_send": bench_send(config, socket_iterations),
+                   "node_info_update": bench_node_info_update(config, socket_iterations),
+                   "node_info_update_cached": bench_node_info_update_cached(config, socket_iterations),
+                   "get_block_data": bench_get_block_data(config, store, block_iterations),
+                   "block_data_str": bench_block_str(config, block_iterations),
+                   "block_upload": bench_block_upload(config, block_iterations),
+                   "transfer_round_trips": bench_transfer_round_trips(server, transfer_iterations)}
+    finally:
+        server.stop()
+        os.rmdir(socket_dir)
+    return {"commit": current_commit(),
+            "timestamp": time.time(),
+            "python": platform.python_version(),
+            "quick": quick,
+            "results": results}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=HELP, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", default=DEFAULT_OUTPUT)
+    parser.add_argument("--compare", default=None)
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument("--quick", action="store_true")
+    args = parser.parse_args()
+
+    report = run(args.quick)
+    output_stream = open(args.output, "w")
+    json.dump(report, output_stream, indent=2, sort_keys=True)
+    output_stream.close()
+    print("Wrote benchmark results to {0}".format(args.output))
+
+    if args.compare:
+        baseline_stream = open(args.compare, "r")
+        baseline = json.load(baseline_stream)
+        baseline_stream.close()
+        regressions = find_regressions(report["results"], baseline["results"], args.threshold)
+        for name, previous, value, threshold in regressions:
+            print("REGRESSION {0}: {1:.6f}s -> {2:.6f}s (threshold x{3})".format(name, previous, value, threshold))
+        if regressions:
+            sys.exit(1)
+        print("No regressions against {0}".format(args.compare))
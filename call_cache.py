@@ -0,0 +1,123 @@
+# caches eth_call results per block, so repeated contract reads within a block never reach the node
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_MAX_ENTRIES = 4096
+# with no new heads reported, the head is looked up again after this many seconds
+DEFAULT_HEAD_TTL = 15
+# blocks this far below the head are treated as final, so their hashes can be remembered
+FINAL_DEPTH = 12
+
+
+class CallCache:
+    """
+    eth_call results keyed by (contract, calldata, block hash). Calls against
+    the current head are dropped when a new head arrives; calls pinned to an
+    explicit block stay until evicted, since a block hash's state never changes.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, head_ttl=DEFAULT_HEAD_TTL):
+        self.max_entries = max_entries
+        self.head_ttl = head_ttl
+        self.lock = threading.Lock()
+        # key -> (result, pinned)
+        self.entries = OrderedDict()
+        self.head_number = None
+        self.head_hash = None
+        self.head_seen = None
+        # block number -> hash, only for final blocks
+        self.block_hashes = {}
+        self.hits = 0
+        self.misses = 0
+
+    def new_head(self, block_number, block_hash):
+        with self.lock:
+            if self.head_number is not None and block_number < self.head_number:
+                return
+            self.head_seen = time.time()
+            if block_hash == self.head_hash:
+                return
+            self.head_number = block_number
+            self.head_hash = block_hash
+            for key in [key for key, entry in self.entries.items() if not entry[1] and key[2] != block_hash]:
+                del self.entries[key]
+
+    def head(self):
+        """
+        Returns (block number, block hash) of the head, or None when it is
+        unknown or hasn't been reported for head_ttl seconds.
+        """
+        with self.lock:
+            if self.head_hash is None or time.time() - self.head_seen > self.head_ttl:
+                return None
+            return self.head_number, self.head_hash
+
+    def block_hash(self, block_number):
+        with self.lock:
+            return self.block_hashes.get(block_number)
+
+    def remember_block_hash(self, block_number, block_hash):
+        with self.lock:
+            if self.head_number is None or block_number > self.head_number - FINAL_DEPTH:
+                # could still be reorged away
+                return
+            if len(self.block_hashes) >= self.max_entries:
+                self.block_hashes.clear()
+            self.block_hashes[block_number] = block_hash
+
+    def call(self, contract_address, calldata, block_hash, pinned, live_call):
+        """
+        Returns the cached result for the call at block_hash, or runs
+        live_call() (which must execute the call at that same block) and
+        caches what it returns.
+
+        :param pinned: True for calls against an explicit block, which are kept across new heads
+        """
+        key = (contract_address.lower(), calldata, block_hash)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        result = live_call()
+        with self.lock:
+            if pinned or block_hash == self.head_hash:
+                self.entries[key] = (result, pinned)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        return result
+
+    def export_state(self, max_entries=None):
+        """
+        Pinned results and final block hashes; results at the head are not
+        kept since the head will have moved on by the time they are restored.
+        """
+        with self.lock:
+            entries = [list(key) + [entry[0]] for key, entry in self.entries.items() if entry[1]]
+            return {"entries": entries[-max_entries:] if max_entries else entries,
+                    "block_hashes": sorted(self.block_hashes.items())}
+
+    def restore_state(self, state):
+        with self.lock:
+            for contract_address, calldata, block_hash, result in state["entries"]:
+                self.entries[(contract_address, calldata, block_hash)] = (result, True)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            self.block_hashes.update(state["block_hashes"])
+
+
+_call_cache = None
+_call_cache_lock = threading.Lock()
+
+
+def get_call_cache(config=None):
+    global _call_cache
+    with _call_cache_lock:
+        if _call_cache is None:
+            config = config or {}
+            _call_cache = CallCache(config.get("call_cache_max_entries", DEFAULT_MAX_ENTRIES),
+                                    config.get("call_cache_head_ttl", DEFAULT_HEAD_TTL))
+        return _call_cache
@@ -1,10 +1,18 @@
 from urllib.request import Request, urlopen, URLError
 from node_information import NodeInfo
+import backfill
 import erc20
+import local_signer
+import rpc_metrics
+import tracing
+import worker_state
 import ssl
 import sys
 import util
 import json
+import os
+import log_pipeline
+import memory_profile
 import logging
 import time
 
@@ -12,12 +20,21 @@ HELP = """
 python3 command.py <mode>
 
 modes: undirected_command (loop)
+       directed_command (loop)
+       backfill <start_block> <end_block> [workers] [output_file]
 
 With loop specified, the command module will request new commands after completing a command
 automatically, stopping when it receives any error from the Node API
+
+backfill fetches a block range across several worker processes into output_file (one block
+per line, in order). Rerunning the same command resumes an interrupted backfill.
 """
 
 MAX_ATTEMPTS = 5
+# seconds a command loop waits after a poll that returned no command
+DEFAULT_IDLE_INTERVAL = 1
+# used when CommandModule is created without a logger
+DEFAULT_LOGGER = logging.getLogger("Command Executor v2")
 
 
 class NodeApiError(Exception):
@@ -29,74 +46,86 @@ class NodeApiError(Exception):
 
 
 class CommandModule:
-    def __init__(self, use_logger=None):
-        self.logger = use_logger
-        self.node_info = NodeInfo(use_logger)
-        self.config = util.load_config_from_file()
+    def __init__(self, use_logger=None, config=None):
+        """
+        :param config: defaults to config.json
+        """
+        self.logger = use_logger or DEFAULT_LOGGER
+        self.config = config or util.load_config_from_file()
+        self.node_info = NodeInfo(use_logger, self.config)
+        if self.config.get("nodes"):
+            erc20.connect(self.config)
+        # decrypt the keystore now rather than on the first transaction
+        local_signer.get_signer(self.config)
         self.max_attempts = self.config['max_rpc_tries']
         self.ssl_ctx = ssl.SSLContext()
         self.ssl_ctx.load_default_certs()
         self.command_id = 0
-
-    def _api_response(self, success, command_id, data):
+        # set to a worker_state.WorkerState when config['worker_state_file'] is configured
+        self.state = None
+
+    def watch_memory(self, profiler):
+        """
+        Adds the structures a long-running loop could grow without bound to a
+        memory_profile.MemoryProfiler's reports.
+        """
+        node_info = self.node_info
+        profiler.watch("rpc_interface.outstanding_requests", lambda: len(node_info.rpc_interface.outstanding_requests))
+        profiler.watch("node_info.peers", lambda: len(node_info.peers))
+        profiler.watch("rpc_cache.entries", lambda: len(node_info.rpc_cache.entries))
+        profiler.watch("call_cache.entries", lambda: len(node_info.call_cache.entries))
+        profiler.watch("transaction_monitor.pending",
+                       lambda: len(erc20.get_transaction_monitor(self.config, self.logger).pending))
+        if self.state:
+            profiler.watch("worker_state.completed", lambda: len(self.state.completed))
+
+    def _post_command_output(self, output):
+        """
+        POSTs a command result to the Node API's command_output endpoint,
+        retrying up to max_rpc_tries times. The body is compressed when
+        config['upload_compression'] is "gzip" or "deflate".
+        """
         config = self.config
+        endpoint_url = config["api_endpoint"] + "node_api/command_output/" + config["api_key"]
+        self.logger.debug("Making request to api_endpoint: %s", endpoint_url)
+
+        body, headers = util.encode_json_body(output, config.get("upload_compression"))
+        headers['User-Agent'] = config['user_agent']
+        req = Request(endpoint_url, data=body, headers=headers, method="POST")
+        max_attempts = self.max_attempts
+        while max_attempts > 0:
+            try:
+                urlopen(req, context=self.ssl_ctx)
+                self.logger.info("Node information updated successfully.")
+                if self.state:
+                    self.state.command_done(output["command_id"], output)
+                break
+            except URLError as err:
+                self.logger.error("Error from Node API update endpoint: %s", err)
+                error_delay = config['polling_interval']
+                self.logger.info("Sleeping for %s seconds", error_delay)
+                time.sleep(error_delay)
+                max_attempts -= 1
+                self.logger.info("Retrying request to Node API, %s remaining", max_attempts)
+
+    @tracing.traced("command.api_response")
+    def _api_response(self, success, command_id, data):
         if success:
             output = dict(success=True,
                           command_id=command_id,
                           input=data)
-            api_endpoint_url = config["api_endpoint"] + "node_api/command_output/" + config["api_key"]
-            logger.debug("Making request to api_endpoint: " + api_endpoint_url)
-
-            req = Request(api_endpoint_url,
-                          data=json.dumps(output).encode('utf-8'),
-                          headers={'Content-Type': 'application/json',
-                                   'User-Agent': config['user_agent']},
-                          method="POST")
-            max_attempts = self.max_attempts
-            while max_attempts > 0:
-                try:
-                    urlopen(req, context=self.ssl_ctx)
-                    logger.info("Node information updated successfully.")
-                    break
-                except URLError as err:
-                    logger.error("Error from Node API update endpoint: {0}".format(err))
-                    error_delay = config['polling_interval']
-                    logger.info("Sleeping for {0} seconds".format(error_delay))
-                    time.sleep(error_delay)
-                    max_attempts -= 1
-                    logger.info("Retrying request to Node API, {0} remaining".format(max_attempts))
         else:
             output = dict(success=False,
                           command_id=command_id,
                           input="",
                           error_message="Could not get block data. (might still be pending)")
-            endpoint_url = config["api_endpoint"] + "node_api/command_output/" + config["api_key"]
-            logger.debug("Making request to api_endpoint: " + endpoint_url)
-
-            req = Request(endpoint_url,
-                          data=json.dumps(output).encode('utf-8'),
-                          headers={'Content-Type': 'application/json',
-                                   'User-Agent': config['user_agent']},
-                          method="POST")
-
-            max_attempts = self.max_attempts
-            while max_attempts > 0:
-                try:
-                    urlopen(req, context=self.ssl_ctx)
-                    logger.info("Node information updated successfully.")
-                    break
-                except URLError as err:
-                    logger.error("URLError from Node API endpoint: {0}".format(err))
-                    error_delay = config['polling_interval']
-                    logger.info("Sleeping for {0} seconds".format(error_delay))
-                    time.sleep(error_delay)
-                    max_attempts -= 1
-                    logger.info("Retrying request to Node API, {0} remaining".format(max_attempts))
+        self._post_command_output(output)
 
+    @tracing.traced("command.publish_contract", profile=True)
     def _publish_contract(self, name, symbol, initial_supply, command_id, token_id):
         config = self.config
 
-        new_contract = erc20.PublishERC20Contract(config, name, symbol, initial_supply)
+        new_contract = erc20.PublishERC20Contract(config, name, symbol, initial_supply, self.logger)
         contract_address = new_contract.deploy()
 
         if contract_address:
@@ -107,6 +136,7 @@ class CommandModule:
             self._api_response(False, command_id, json.dumps({"error_message": "Failed to create contract.",
                                                               "token_id": token_id}))
 
+    @tracing.traced("command.burn_tokens", profile=True)
     def _burn_tokens(self, contract_address, tokens, gas_price, token_id):
         config = self.config
         command_id = self.command_id
@@ -126,6 +156,7 @@ class CommandModule:
             self._api_response(False, command_id, {"error_message": "ERC20 burn command failed.",
                                                    "token_id": token_id})
 
+    @tracing.traced("command.total_supply", profile=True)
     def _total_supply(self, contract_address, token_id):
         config = self.config
         command_id = self.command_id
@@ -136,9 +167,11 @@ class CommandModule:
             if result:
                 self._api_response(True, command_id, json.dumps({"total_supply": result,
                                                                  "token_id": token_id}))
+                return
         self._api_response(False, command_id, {"error_message": "ERC20 total supply failed.",
                                                "token_id": token_id})
 
+    @tracing.traced("command.transfer", profile=True)
     def _transfer(self, contract_address, tokens, address, gas_price, token_id):
         config = self.config
         command_id = self.command_id
@@ -154,67 +187,68 @@ class CommandModule:
                           "token_id": token_id,
                           "contract_address": contract_address}
                 self._api_response(True, command_id, json.dumps(output))
+                return
         self._api_response(False, command_id, {"error_message": "ERC20 transfer failed.",
                                                "token_id": token_id})
 
+    def _resume_command(self, command_id, command_data):
+        """
+        Deals with a command the previous run of this worker already received:
+        a finished one has its output posted again instead of being re-run, and
+        one that was interrupted part way is reported as failed unless it only
+        reads, so a transfer is never sent twice. Returns True if the command
+        was dealt with, False if it should be run.
+        """
+        previous = self.state.previous_run(command_id) if self.state else None
+        if previous is None:
+            return False
+        outcome, data = previous
+        if outcome == "done":
+            if data is None:
+                return False
+            self.logger.info("Command %s finished before the restart, posting its output again", command_id)
+            self._post_command_output(data)
+            return True
+        if worker_state.read_only(command_data):
+            return False
+        self.logger.error("Command %s was interrupted by a restart, not running it again", command_id)
+        self._post_command_output(dict(success=False,
+                                       command_id=command_id,
+                                       input="",
+                                       error_message="Interrupted by a worker restart, check for a pending "
+                                                     "transaction before retrying."))
+        return True
+
+    def _block_upload_input(self, block_data):
+        """
+        The block as uploaded: only transactions touching config['upload_address_filter']
+        when set, and nested JSON when config['upload_format'] is "nested"
+        (otherwise the legacy string with each transaction JSON-encoded inside it).
+        """
+        if self.config.get("upload_address_filter"):
+            block_data = block_data.filtered(self.config["upload_address_filter"])
+        if self.config.get("upload_format") == "nested":
+            return block_data.to_dict()
+        return str(block_data)
+
+    @tracing.traced("command.get_block_data", profile=True)
     def _get_block_data(self, block_number, command_id):
-        config = self.config
-
         block_data = self.node_info.get_block_data(block_number)
         if block_data:
             output = dict(success=True,
                           command_id=command_id,
-                          input=str(block_data))
-            api_endpoint_url = config["api_endpoint"] + "node_api/command_output/" + config["api_key"]
-            logger.debug("Making request to api_endpoint: " + api_endpoint_url)
-
-            req = Request(api_endpoint_url,
-                          data=json.dumps(output).encode('utf-8'),
-                          headers={'Content-Type': 'application/json',
-                                   'User-Agent': config['user_agent']},
-                          method="POST")
-            max_attempts = self.max_attempts
-            while max_attempts > 0:
-                try:
-                    urlopen(req, context=self.ssl_ctx)
-                    logger.info("Node information updated successfully.")
-                    break
-                except URLError as err:
-                    logger.error("Error from Node API update endpoint: {0}".format(err))
-                    error_delay = config['polling_interval']
-                    logger.info("Sleeping for {0} seconds".format(error_delay))
-                    time.sleep(error_delay)
-                    max_attempts -= 1
-                    logger.info("Retrying request to Node API, {0} remaining".format(max_attempts))
+                          input=self._block_upload_input(block_data))
         else:
             output = dict(success=False,
                           command_id=command_id,
                           input="",
                           error_message="Could not get block data. (might still be pending)")
-            endpoint_url = config["api_endpoint"] + "node_api/command_output/" + config["api_key"]
-            logger.debug("Making request to api_endpoint: " + endpoint_url)
-
-            req = Request(endpoint_url,
-                          data=json.dumps(output).encode('utf-8'),
-                          headers={'Content-Type': 'application/json',
-                                   'User-Agent': config['user_agent']},
-                          method="POST")
-
-            max_attempts = self.max_attempts
-            while max_attempts > 0:
-                try:
-                    urlopen(req, context=self.ssl_ctx)
-                    logger.info("Node information updated successfully.")
-                    break
-                except URLError as err:
-                    logger.error("URLError from Node API endpoint: {0}".format(err))
-                    error_delay = config['polling_interval']
-                    logger.info("Sleeping for {0} seconds".format(error_delay))
-                    time.sleep(error_delay)
-                    max_attempts -= 1
-                    logger.info("Retrying request to Node API, {0} remaining".format(max_attempts))
+        self._post_command_output(output)
 
     def directed_command(self):
+        """
+        Polls the Node API for one directed command and runs it. Returns True if a command was run.
+        """
         directed_dispatch_url = self.config["api_endpoint"]
         directed_dispatch_url += "node_api/dispatch_directed_command/" + self.config["api_key"]
         ssl_ctx = self.ssl_ctx
@@ -222,13 +256,20 @@ class CommandModule:
             response_data = json.load(urlopen(directed_dispatch_url, context=ssl_ctx))
             if response_data["result"] == "OK":
                 command_data = response_data["command_data"]
+                if not command_data:
+                    # nothing dispatched
+                    return False
                 if 'command_id' in command_data:
                     command_id = command_data["command_id"]
                     self.command_id = command_id
                 else:
-                    self.logger.error("Node API Error: {0}".format("command_id not found in response_data"))
+                    self.logger.error("Node API Error: %s", "command_id not found in response_data")
                     raise NodeApiError("command_id not found in response_data")
                 if 'erc20_function' in command_data:
+                    if self._resume_command(command_id, command_data):
+                        return True
+                    if self.state:
+                        self.state.command_started(command_id, command_data)
                     if command_data['erc20_function'] == "publish":
                         token_name = command_data["token_name"]
                         token_symbol = command_data["token_symbol"]
@@ -252,16 +293,20 @@ class CommandModule:
                         contract_address = command_data["contract_address"]
                         token_id = command_data["token_id"]
                         self._total_supply(contract_address, token_id)
+                    return True
 
             elif response_data["result"] == "Error":
-                self.logger.error("Node API Error: {0}".format(response_data["error_message"]))
+                self.logger.error("Node API Error: %s", response_data["error_message"])
                 raise NodeApiError(response_data["error_message"])
             else:
-                self.logger.error("Unrecognized response from Node API endpoint: " + self.config["api_endpoint"])
+                self.logger.error("Unrecognized response from Node API endpoint: %s", self.config["api_endpoint"])
         except URLError as err:
-            logger.error("URLError: {0}".format(err))
+            self.logger.error("URLError: %s", err)
 
     def undirected_command(self):
+        """
+        Polls the Node API for one undirected command and runs it. Returns True if a command was run.
+        """
         dispatch_undirected_url = self.config["api_endpoint"]
         dispatch_undirected_url += "node_api/dispatch_undirected_command/" + self.config["api_key"]
         ssl_ctx = self.ssl_ctx
@@ -272,21 +317,26 @@ class CommandModule:
                 if 'get_block_data' in command_data:
                     command_id = command_data["command_id"]
                     block_number = command_data["get_block_data"]
-                    self.logger.info("Received get_block_data: {0} command_id: {1}".format(block_number, command_id))
+                    self.logger.info("Received get_block_data: %s command_id: %s", block_number, command_id)
+                    if self._resume_command(command_id, command_data):
+                        return True
+                    if self.state:
+                        self.state.command_started(command_id, command_data)
                     self._get_block_data(block_number, command_id)
+                    return True
             elif response_data["result"] == "Error":
-                self.logger.error("Node API Error: {0}".format(response_data["error_message"]))
+                self.logger.error("Node API Error: %s", response_data["error_message"])
                 raise NodeApiError(response_data["error_message"])
             else:
-                self.logger.error("Unrecognized response from Node API endpoint: " + self.config["api_endpoint"])
+                self.logger.error("Unrecognized response from Node API endpoint: %s", self.config["api_endpoint"])
 
         except URLError as err:
-            logger.error("URLError: {0}".format(err))
+            self.logger.error("URLError: %s", err)
 
 
 if __name__ == "__main__":
     if len(sys.argv) < 2:
-        print(help)
+        print(HELP)
         exit(0)
     mode = sys.argv[1]
     loop = False
@@ -298,19 +348,45 @@ if __name__ == "__main__":
     logger.setLevel(logging.INFO)
     ch = logging.StreamHandler()
     ch.setLevel(logging.INFO)
-    # create formatter and add it to the handlers
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    ch.setFormatter(formatter)
     # add the handlers to the logger
     logger.addHandler(ch)
 
     command_module = CommandModule(logger)
+    # create formatter (text or json per config) and move the handlers to a background listener thread
+    ch.setFormatter(log_pipeline.get_formatter(command_module.config))
+    log_pipeline.setup_queue_logging(logger, command_module.config.get("log_queue_size",
+                                                                       log_pipeline.DEFAULT_QUEUE_SIZE))
+    if command_module.config.get("trace_file"):
+        tracing.enable(command_module.config["trace_file"], command_module.config.get("profile_dir"))
+        logger.info("Tracing command execution to %s", command_module.config["trace_file"])
+    if command_module.config.get("metrics_port"):
+        rpc_metrics.MetricsServer(command_module.node_info.metrics, command_module.config["metrics_port"]).start()
+        logger.info("Serving RPC metrics on port %s", command_module.config["metrics_port"])
+    if command_module.config.get("metrics_dump_file"):
+        rpc_metrics.MetricsDumper(command_module.node_info.metrics,
+                                  command_module.config["metrics_dump_file"],
+                                  command_module.config.get("metrics_dump_interval", 60)).start()
+    if mode in ("undirected_command", "directed_command"):
+        # resume from the previous run's file, then keep it current
+        command_module.state = worker_state.get_worker_state(command_module)
+    if command_module.config.get("memory_profile_file"):
+        profiler = memory_profile.enable(command_module.config["memory_profile_file"],
+                                         command_module.config.get("memory_profile_interval",
+                                                                   memory_profile.DEFAULT_INTERVAL),
+                                         command_module.config.get("memory_profile_frames",
+                                                                   memory_profile.DEFAULT_FRAMES),
+                                         logger)
+        command_module.watch_memory(profiler)
+        logger.info("Writing memory reports to %s (kill -USR1 %s for one now)",
+                    command_module.config["memory_profile_file"], os.getpid())
+    idle_interval = command_module.config.get("idle_poll_interval", DEFAULT_IDLE_INTERVAL)
     if mode == "undirected_command":
         if loop:
             logger.info("Starting undirected command loop.")
             try:
                 while True:
-                    command_module.undirected_command()
+                    if not command_module.undirected_command():
+                        time.sleep(idle_interval)
             except NodeApiError:
                 logger.info("Ending undirected command loop.")
         else:
@@ -320,11 +396,25 @@ if __name__ == "__main__":
             logger.info("Starting directed command loop.")
             try:
                 while True:
-                    command_module.directed_command()
+                    if not command_module.directed_command():
+                        time.sleep(idle_interval)
             except NodeApiError:
                 logger.info("Ending directed command loop.")
         else:
             command_module.directed_command()
+    elif mode == "backfill":
+        if len(sys.argv) < 4:
+            print(HELP)
+            exit(1)
+        start_block = int(sys.argv[2])
+        end_block = int(sys.argv[3])
+        workers = int(sys.argv[4]) if len(sys.argv) > 4 else backfill.DEFAULT_WORKERS
+        output_file = sys.argv[5] if len(sys.argv) > 5 else "blocks_{0}_{1}.jsonl".format(start_block, end_block)
+        failures = backfill.run_backfill(command_module.config, start_block, end_block, output_file, workers,
+                                         command_module.config.get("backfill_chunk_size", backfill.DEFAULT_CHUNK_SIZE),
+                                         logger)
+        if failures:
+            exit(1)
     elif mode == "test":
         command_module._api_response(True, 437847, json.dumps({"erc20_function": "publish",
                                                                "new_contract_address": "0x300DEDA0155D4713C690128a5b36a33d0E359817",
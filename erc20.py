@@ -1,16 +1,62 @@
 from web3 import Web3
 from web3.gas_strategies.rpc import rpc_gas_price_strategy
+from hexbytes import HexBytes
 import time
 import logging
+import collections
+import hashlib
 import json
 import random
+import threading
+from concurrent.futures import Future
+import tracing
+import call_cache
+import gas_cache
+import local_signer
+import log_pipeline
+import node_pool
+import rate_limiter
 
 CONSOLE_LOG_LEVEL = logging.INFO
 FILE_LOG_LEVEL = logging.DEBUG
+# used by LoggingBase when no logger is given
+DEFAULT_LOGGER = logging.getLogger("ERC20Interface")
 
 # Change this to IPC for production
 web3 = Web3(Web3.HTTPProvider("http://10.0.0.8:8545"))
 
+DEFAULT_RECEIPT_TIMEOUT = 600
+DEFAULT_RECEIPT_POLL_INTERVAL = 2
+
+# a transaction still pending after this many seconds is resent at a higher gas price
+DEFAULT_BUMP_AFTER = 90
+DEFAULT_BUMP_PERCENT = 12.5
+# geth rejects a replacement that doesn't raise the gas price by at least this much
+MIN_BUMP_PERCENT = 10
+# transactions still unmined after this long are no longer followed
+DEFAULT_MONITOR_TIMEOUT = 6 * 3600
+MAX_CONFIRMATION_SAMPLES = 1000
+# nobody holds this address's key, so it never holds tokens; transfers to it cost what a new recipient costs
+ESTIMATE_RECIPIENT = Web3.toChecksumAddress("0x" + hashlib.sha256(b"erc20 gas estimate recipient").hexdigest()[:40])
+
+# (abi path, bin path) -> (abi, bytecode) and the web3 contract factories built from them
+_contract_files = {}
+_contract_factories = {}
+
+
+def connect(config):
+    """
+    Points the module's web3 at the primary node from config['nodes'] (or
+    config['ipc_address']), which is where transactions must be signed and sent.
+    """
+    global web3
+    primary = node_pool.NodePool(config).primary
+    if primary.kind == "ipc":
+        web3 = Web3(Web3.IPCProvider(primary.address))
+    else:
+        web3 = Web3(Web3.HTTPProvider(primary.address))
+    return web3
+
 
 def find_target_gas_price(max_gas_price_gwei):
     max_gas_price = Web3.toWei(max_gas_price_gwei, 'gwei')
@@ -20,18 +66,15 @@ def find_target_gas_price(max_gas_price_gwei):
 
     if max_gas_price < node_gas_price:
         node_gwei = web3.fromWei(node_gas_price, 'gwei')
-        super().log_error(
-            "Node reported gas price of {0} GWei is less than the maximum allowed gas price of {1} GWei".format(
-                node_gwei,
-                max_gas_price
-            ))
+        DEFAULT_LOGGER.error("Node reported gas price of %s GWei is above the maximum allowed gas price of %s GWei",
+                             node_gwei, max_gas_price_gwei)
         return -1
 
     # split the difference between maximum and min using triangular RNG towards the minimum
 
     difference = max_gas_price - node_gas_price
     split = random.triangular(0, 1, 0.25)
-    target_gas_price = int(difference * split)
+    target_gas_price = node_gas_price + int(difference * split)
 
     return target_gas_price
 
@@ -52,6 +95,16 @@ class ExecutionAlreadyFinished(ERC20Error):
         self.last_function = last_function
 
 
+class DeploymentNotSent(ERC20Error):
+    """
+    A deployment was signed with a nonce after one whose send failed, so it was not sent
+    """
+
+    def __init__(self, failed_symbol):
+        super().__init__("not sent after the deployment of {0} failed".format(failed_symbol))
+        self.failed_symbol = failed_symbol
+
+
 def amount_to_tokens(amount):
     tokens = amount / (10 ** 18)
     return int(tokens)
@@ -62,21 +115,22 @@ def tokens_to_amount(tokens):
     return int(amount)
 
 
+def _admitted(config, method, priority=rate_limiter.PRIORITY_LIVE):
+    # web3 calls don't go through NodeInfo, so they wait their turn with the process's other RPCs here
+    return rate_limiter.get_limiter(config).admitted(method, priority=priority)
+
+
 class LoggingBase:
     def __init__(self, use_logger=None):
-        self.logger = use_logger
+        self.logger = use_logger or DEFAULT_LOGGER
 
-    def log_message(self, message):
-        if self.logger:
-            self.logger.info(message)
-        else:
-            print("{0} - (INFO) - {1}".format(time.asctime(), message))
+    # messages take %-style args and are only formatted if a handler will emit them
 
-    def log_error(self, error_message):
-        if self.logger:
-            self.logger.error(error_message)
-        else:
-            print("{0} - (ERROR) - {1}".format(time.asctime(), error_message))
+    def log_message(self, message, *args):
+        self.logger.info(message, *args)
+
+    def log_error(self, error_message, *args):
+        self.logger.error(error_message, *args)
 
 
 class ExecuteERC20Contract(LoggingBase):
@@ -88,63 +142,98 @@ class ExecuteERC20Contract(LoggingBase):
     def __init__(self, config, contract_address, use_logger=None):
         self.config = config
         self.contract_address = contract_address
-        abi_stream = open(config['abi'], "r")
-        self.erc20abi = abi_stream.read()
-        abi_stream.close()
+        self.erc20abi = load_contract_files(config)[0]
         self.tx_hash = None
         self.tx_receipt = None
         self.last_function = None
 
         super().__init__(use_logger)
 
+    @tracing.traced("erc20.burn_tokens")
     def burn_tokens(self, tokens, gas_price):
         if self.last_function:
             raise ExecutionAlreadyFinished(self.last_function)
         self.last_function = self.BURN_TOKENS
 
-        target_gas_price = find_target_gas_price(gas_price)
+        with tracing.span("erc20.find_target_gas_price"):
+            target_gas_price = find_target_gas_price(gas_price)
         if target_gas_price < 0:
             return
-        super().log_message("Using gas price: {0}".format(Web3.fromWei(target_gas_price, 'gwei')))
+        super().log_message("Using gas price: %s", Web3.fromWei(target_gas_price, 'gwei'))
 
-        web3.eth.defaultAccount = web3.eth.accounts[0]
-        web3.personal.unlockAccount(web3.eth.defaultAccount, self.config['account_password'], 30)
-
-        erc20_contract = web3.eth.contract(address=self.contract_address, abi=self.erc20abi)
         amount = tokens_to_amount(tokens)
-
-        gas = erc20_contract.functions.transfer(self.contract_address, amount).estimateGas()
-        gas_limit = gas * target_gas_price
-        transaction = erc20_contract.functions.transfer(self.contract_address, amount).buildTransaction(
-            {'gas_price': gas_limit})
-        self.tx_hash = web3.eth.sendTransaction(transaction)
-        super().log_message("Sent transaction hash {0}".format(self.tx_hash.hex()))
+        self.tx_hash, transaction = self._send_transfer(self.contract_address, amount, target_gas_price, "burn")
+        super().log_message("Sent transaction hash %s", self.tx_hash.hex())
+        get_transaction_monitor(self.config, self.logger).track(self.tx_hash, Web3.toWei(gas_price, 'gwei'),
+                                                                transaction)
         return True
 
-    def total_supply(self):
+    @tracing.traced("erc20.total_supply")
+    def total_supply(self, block_identifier=None):
+        """
+        :param block_identifier: block number to read at, defaults to the current head
+        """
         if self.last_function:
             raise ExecutionAlreadyFinished(self.last_function)
         self.last_function = self.TOTAL_SUPPLY
 
         erc20_contract = web3.eth.contract(address=self.contract_address, abi=self.erc20abi)
-        new_supply = erc20_contract.functions.totalSupply().call()
+        new_supply = self._cached_call(erc20_contract, "totalSupply", [], block_identifier)
         tokens = amount_to_tokens(new_supply)
-        super().log_message("totalSupply: {0}".format(tokens))
+        super().log_message("totalSupply: %s", tokens)
 
         return tokens
 
-    def remaining_tokens(self):
+    @tracing.traced("erc20.remaining_tokens")
+    def remaining_tokens(self, block_identifier=None):
+        """
+        :param block_identifier: block number to read at, defaults to the current head
+        """
         if self.last_function:
             raise ExecutionAlreadyFinished(self.last_function)
         self.last_function = self.REMAINING_SUPPLY
 
         erc20_contract = web3.eth.contract(address=self.contract_address, abi=self.erc20abi)
-        amount_remaining = erc20_contract.functions.balanceOf(web3.eth.accounts[0]).call()
+        signer = local_signer.get_signer(self.config)
+        owner = signer.address if signer else web3.eth.accounts[0]
+        amount_remaining = self._cached_call(erc20_contract, "balanceOf", [owner], block_identifier)
         tokens = amount_to_tokens(amount_remaining)
-        super().log_message("remaining tokens: {0}".format(tokens))
+        super().log_message("remaining tokens: %s", tokens)
 
         return tokens
 
+    def _cached_call(self, erc20_contract, function_name, args, block_identifier=None):
+        """
+        Runs a read-only contract function through the shared eth_call cache,
+        at block_identifier when given (cached for good) or else at the current
+        head (cached until the next head).
+        """
+        calls = call_cache.get_call_cache(self.config)
+        if block_identifier is None:
+            head = calls.head()
+            if head is None:
+                # no NodeInfo in this process is reporting heads, or it went quiet
+                with _admitted(self.config, "eth_getBlockByNumber"):
+                    block = web3.eth.getBlock('latest')
+                head = (block.number, block.hash.hex())
+                calls.new_head(*head)
+            block_number, block_hash = head
+        else:
+            block_number = block_identifier
+            block_hash = calls.block_hash(block_number)
+            if block_hash is None:
+                with _admitted(self.config, "eth_getBlockByNumber"):
+                    block_hash = web3.eth.getBlock(block_number).hash.hex()
+                calls.remember_block_hash(block_number, block_hash)
+        calldata = erc20_contract.encodeABI(fn_name=function_name, args=args)
+        contract_function = getattr(erc20_contract.functions, function_name)(*args)
+
+        def live_call():
+            with _admitted(self.config, "eth_call"):
+                return contract_function.call(block_identifier=block_number)
+        return calls.call(self.contract_address, calldata, block_hash, block_identifier is not None, live_call)
+
+    @tracing.traced("erc20.transfer")
     def transfer(self, tokens, address, gas_price):
         """
         transfers tokens to address
@@ -158,24 +247,127 @@ class ExecuteERC20Contract(LoggingBase):
             raise ExecutionAlreadyFinished(self.last_function)
         self.last_function = self.TRANSFER
 
-        target_gas_price = find_target_gas_price(gas_price)
+        with tracing.span("erc20.find_target_gas_price"):
+            target_gas_price = find_target_gas_price(gas_price)
         if target_gas_price < 0:
             return
 
-        web3.eth.defaultAccount = web3.eth.accounts[0]
-        web3.personal.unlockAccount(web3.eth.defaultAccount, self.config['account_password'], 30)
-
-        erc20_contract = web3.eth.contract(address=self.contract_address, abi=self.erc20abi)
         amount = tokens_to_amount(tokens)
-        super().log_message("Using gas price: {0}".format(Web3.fromWei(target_gas_price, 'gwei')))
+        super().log_message("Using gas price: %s", Web3.fromWei(target_gas_price, 'gwei'))
 
-        gas = erc20_contract.functions.transfer(address, amount).estimateGas()
-        gas_limit = gas * target_gas_price
-        transaction = erc20_contract.functions.transfer(address, amount).buildTransaction({'gas_price': gas_limit})
-        self.tx_hash = web3.eth.sendTransaction(transaction)
-        super().log_message("Sent transaction hash {0}".format(self.tx_hash.hex()))
+        self.tx_hash, transaction = self._send_transfer(address, amount, target_gas_price)
+        super().log_message("Sent transaction hash %s", self.tx_hash.hex())
+        get_transaction_monitor(self.config, self.logger).track(self.tx_hash, Web3.toWei(gas_price, 'gwei'),
+                                                                transaction)
         return True
 
+    def _send_transfer(self, address, amount, target_gas_price, function_name="transfer"):
+        """
+        Sends transfer(address, amount) from our account. With a keystore_file
+        configured the transaction is signed locally and sent raw, otherwise the
+        node unlocks the account and signs it. Gas comes from the shared gas
+        estimate cache rather than an estimateGas call per transaction, sized
+        for a recipient that holds no tokens yet unless the cache splits
+        recipients.
+
+        :return: (tx_hash, the signed transaction or None when the node signed it)
+        """
+        erc20_contract = web3.eth.contract(address=self.contract_address, abi=self.erc20abi)
+        contract_function = erc20_contract.functions.transfer(address, amount)
+        signer = local_signer.get_signer(self.config)
+        if signer is None:
+            with tracing.span("erc20.unlock_account"):
+                web3.eth.defaultAccount = web3.eth.accounts[0]
+                web3.personal.unlockAccount(web3.eth.defaultAccount, self.config['account_password'], 30)
+            sender = web3.eth.defaultAccount
+        else:
+            sender = signer.address
+
+        estimates = gas_cache.get_gas_cache(self.config, self.logger)
+        if estimates.split_recipients:
+            # a zero balance costs the extra storage write, whether or not we've sent to this holder before
+            recipient_is_new = self._cached_call(erc20_contract, "balanceOf", [address]) == 0
+            estimated_function = contract_function
+        else:
+            recipient_is_new = True
+            estimated_function = erc20_contract.functions.transfer(ESTIMATE_RECIPIENT, amount)
+
+        def live_estimate():
+            with _admitted(self.config, "eth_estimateGas"):
+                return estimated_function.estimateGas({'from': sender})
+
+        with tracing.span("erc20.estimate_gas"):
+            gas = estimates.estimate(self.contract_address, function_name, recipient_is_new, live_estimate)
+
+        if signer is None:
+            with tracing.span("erc20.build_transaction"):
+                # target_gas_price is already in wei, see find_target_gas_price
+                transaction = contract_function.buildTransaction({'from': sender,
+                                                                  'gas': gas,
+                                                                  'gasPrice': target_gas_price})
+            # transaction submission goes ahead of every read waiting on the node
+            with tracing.span("erc20.send_transaction"), \
+                    _admitted(self.config, "eth_sendTransaction", rate_limiter.PRIORITY_TRANSACTION):
+                tx_hash = web3.eth.sendTransaction(transaction)
+            transaction = None
+        else:
+            try:
+                tx_hash, transaction = self._send_signed(signer, contract_function, gas, target_gas_price)
+            except ValueError as err:
+                # the node rejected the cached gas limit, retry once with a live estimate
+                super().log_error("Transaction rejected with cached gas %s: %s", gas, err)
+                estimates.invalidate(self.contract_address, function_name, recipient_is_new)
+                with tracing.span("erc20.estimate_gas"):
+                    gas = estimates.estimate(self.contract_address, function_name, recipient_is_new, live_estimate)
+                tx_hash, transaction = self._send_signed(signer, contract_function, gas, target_gas_price)
+        return tx_hash, transaction
+
+    def _send_signed(self, signer, contract_function, gas, target_gas_price):
+        nonce = signer.next_nonce(web3)
+        try:
+            with tracing.span("erc20.build_transaction"):
+                transaction = contract_function.buildTransaction({'from': signer.address,
+                                                                  'gas': gas,
+                                                                  'gasPrice': target_gas_price,
+                                                                  'nonce': nonce})
+            with tracing.span("erc20.sign_transaction"):
+                raw_transaction = signer.sign(transaction)
+            with tracing.span("erc20.send_transaction"), \
+                    _admitted(self.config, "eth_sendRawTransaction", rate_limiter.PRIORITY_TRANSACTION):
+                return web3.eth.sendRawTransaction(raw_transaction), transaction
+        except Exception:
+            # the nonce was never used, so the node has to say where the account is
+            signer.reset_nonce()
+            raise
+
+
+def load_contract_files(config):
+    """
+    Reads config['abi'] and config['bin'] once per process; returns (abi, bytecode).
+    """
+    key = (config['abi'], config['bin'])
+    if key not in _contract_files:
+        abi_stream = open(config['abi'], "r")
+        erc20abi = abi_stream.read()
+        abi_stream.close()
+        bin_stream = open(config['bin'], "r")
+        erc20bin = json.load(bin_stream)
+        bin_stream.close()
+        _contract_files[key] = (erc20abi, erc20bin)
+    return _contract_files[key]
+
+
+def contract_factory(config):
+    """
+    web3 contract factory for the ERC20 bytecode, built once per web3 connection.
+    """
+    key = (id(web3), config['abi'], config['bin'])
+    if key not in _contract_factories:
+        erc20abi, erc20bin = load_contract_files(config)
+        _contract_factories.clear()
+        _contract_factories[key] = web3.eth.contract(abi=erc20abi, bytecode=erc20bin["object"])
+    return _contract_factories[key]
+
 
 class PublishERC20Contract(LoggingBase):
     def __init__(self, config, name, symbol, initial_supply, use_logger=None):
@@ -183,46 +375,381 @@ class PublishERC20Contract(LoggingBase):
         self.name = name
         self.symbol = symbol
         self.initial_supply = initial_supply
-        abi_stream = open(config['abi'], "r")
-        self.erc20abi = abi_stream.read()
-        abi_stream.close()
-        bin_stream = open(config['bin'], "r")
-        self.erc20bin = json.load(bin_stream)
-        bin_stream.close()
+        self.erc20abi, self.erc20bin = load_contract_files(config)
         super().__init__(use_logger)
         #
         self.tx_hash = None
         self.tx_receipt = None
 
+    @tracing.traced("erc20.deploy")
     def deploy(self):
-        web3.eth.defaultAccount = web3.eth.accounts[0]
-        web3.personal.unlockAccount(web3.eth.defaultAccount, self.config['account_password'], 30)
-
-        erc20_contract = web3.eth.contract(abi=self.erc20abi, bytecode=self.erc20bin["object"])
-        self.log_message("Instantiated Ethereum contract")
-        gas_estimate = erc20_contract.constructor(self.initial_supply,
-                                                  self.name,
-                                                  self.symbol).estimateGas()
-
-        super().log_message("Gas estimate: {0}".format(gas_estimate))
-        self.tx_hash = erc20_contract.constructor(self.initial_supply,
-                                                  self.name,
-                                                  self.symbol).transact()
-
-        super().log_message("Received tx_hash: {0}, waiting for receipt...".format(self.tx_hash))
-        while 1:
+        """
+        Deploys the contract and waits up to config['receipt_timeout'] seconds for
+        it to be mined. Returns the new contract address, or None on timeout.
+        """
+        pipeline = DeploymentPipeline(self.config, self.logger)
+        job = pipeline.add(self.name, self.symbol, self.initial_supply)
+        pipeline.submit()
+        self.tx_hash = job.tx_hash
+        super().log_message("Received tx_hash: %s, waiting for receipt...", self.tx_hash)
+        with tracing.span("erc20.wait_for_receipt"):
+            pipeline.wait()
+        self.tx_receipt = job.receipt
+        if job.contract_address is None:
+            super().log_error("No receipt for %s after %s seconds", self.tx_hash, pipeline.receipt_timeout)
+            return None
+
+        super().log_message("Received transaction receipt, contract address: %s", job.contract_address)
+
+        return job.contract_address
+
+
+class DeploymentJob:
+    def __init__(self, name, symbol, initial_supply):
+        self.name = name
+        self.symbol = symbol
+        self.initial_supply = initial_supply
+        self.tx_hash = None
+        self.receipt = None
+        self.contract_address = None
+        self.error = None
+        # resolves to the contract address, or None if it failed or timed out
+        self.future = Future()
+
+
+class DeploymentPipeline(LoggingBase):
+    """
+    Deploys many ERC20 contracts at once: every job is submitted back to back
+    with consecutive nonces, then a single poller resolves the contract
+    addresses as the receipts come in, giving up after receipt_timeout. When
+    a locally signed send fails, the jobs after it fail with DeploymentNotSent.
+    """
+
+    def __init__(self, config, use_logger=None):
+        self.config = config
+        self.jobs = []
+        self.receipt_timeout = config.get("receipt_timeout", DEFAULT_RECEIPT_TIMEOUT)
+        self.poll_interval = config.get("receipt_poll_interval", DEFAULT_RECEIPT_POLL_INTERVAL)
+        self.poller = None
+        super().__init__(use_logger)
+
+    def add(self, name, symbol, initial_supply):
+        job = DeploymentJob(name, symbol, initial_supply)
+        self.jobs.append(job)
+        return job
+
+    @tracing.traced("erc20.submit_deployments")
+    def submit(self):
+        """
+        Sends every job that hasn't been sent yet and returns their tx hashes.
+        """
+        factory = contract_factory(self.config)
+        signer = local_signer.get_signer(self.config)
+        if signer is None:
+            web3.eth.defaultAccount = web3.eth.accounts[0]
+            web3.personal.unlockAccount(web3.eth.defaultAccount, self.config['account_password'], 30)
+            sender = web3.eth.defaultAccount
+        else:
+            sender = signer.address
+        jobs = [each for each in self.jobs if each.tx_hash is None and each.error is None]
+        if not jobs:
+            return []
+        gas_price = web3.eth.gasPrice
+
+        transactions = []
+        for job in jobs:
+            constructor = factory.constructor(job.initial_supply, job.name, job.symbol)
+            with _admitted(self.config, "eth_estimateGas"):
+                gas_estimate = constructor.estimateGas({'from': sender})
+            self.log_message("Gas estimate for %s: %s", job.symbol, gas_estimate)
+            transactions.append((job, constructor, gas_estimate))
+
+        if signer is None:
+            # geth assigns the nonces, so a failed send leaves no gap
+            for job, constructor, gas_estimate in transactions:
+                try:
+                    job.tx_hash = constructor.transact({'from': sender, 'gas': gas_estimate})
+                except Exception as err:
+                    self._fail(job, err)
+        else:
+            nonce = signer.next_nonces(web3, len(transactions))
             try:
-                self.tx_receipt = web3.eth.waitForTransactionReceipt(self.tx_hash)
-                if self.tx_receipt:
-                    break
-            except:
-                super().log_message("Received timeout, retrying...")
-                continue
+                built = [constructor.buildTransaction({'from': sender,
+                                                       'gas': gas_estimate,
+                                                       'gasPrice': gas_price,
+                                                       'nonce': nonce + index})
+                         for index, (job, constructor, gas_estimate) in enumerate(transactions)]
+                raw_transactions = signer.sign_many(built)
+            except Exception:
+                signer.reset_nonce()
+                raise
+            failed = None
+            for (job, constructor, gas_estimate), raw_transaction in zip(transactions, raw_transactions):
+                if failed is not None:
+                    # signed with a nonce after the failed one, it would wait behind the gap forever
+                    self._fail(job, DeploymentNotSent(failed))
+                    continue
+                try:
+                    job.tx_hash = web3.eth.sendRawTransaction(raw_transaction)
+                except Exception as err:
+                    # let the node tell us where we are
+                    signer.reset_nonce()
+                    self._fail(job, err)
+                    failed = job.symbol
+        for job in jobs:
+            if job.tx_hash:
+                self.log_message("Deploying %s: tx_hash %s", job.symbol, job.tx_hash.hex())
+        return [job.tx_hash for job in jobs if job.tx_hash]
+
+    def _fail(self, job, err):
+        job.error = err
+        self.log_error("Deployment of %s failed: %s", job.symbol, err)
+        job.future.set_result(None)
+
+    def _poll(self):
+        deadline = time.time() + self.receipt_timeout
+        pending = [job for job in self.jobs if job.tx_hash and not job.future.done()]
+        while pending and time.time() < deadline:
+            for job in pending:
+                try:
+                    with _admitted(self.config, "eth_getTransactionReceipt"):
+                        receipt = web3.eth.getTransactionReceipt(job.tx_hash)
+                except Exception as err:
+                    self.log_error("Receipt lookup for %s failed: %s", job.tx_hash.hex(), err)
+                    continue
+                if receipt:
+                    job.receipt = receipt
+                    job.contract_address = receipt.contractAddress
+                    self.log_message("%s deployed at %s", job.symbol, job.contract_address)
+                    job.future.set_result(job.contract_address)
+            pending = [job for job in pending if not job.future.done()]
+            if pending:
+                time.sleep(self.poll_interval)
+        for job in pending:
+            self.log_error("Timed out waiting for receipt of %s", job.tx_hash.hex())
+            job.future.set_result(None)
+
+    def start(self):
+        """
+        Resolves receipts on a background thread; watch each job's future.
+        """
+        self.poller = threading.Thread(target=self._poll, daemon=True)
+        self.poller.start()
+        return [job.future for job in self.jobs]
+
+    def wait(self):
+        """
+        Blocks until every submitted job has an address or timed out; returns
+        {job: contract_address or None}.
+        """
+        if self.poller is None:
+            self._poll()
+        else:
+            self.poller.join()
+        return dict((job, job.contract_address) for job in self.jobs)
+
+
+class PendingTransaction:
+    def __init__(self, tx_hash, max_gas_price, transaction=None):
+        # every hash sent for this nonce, the latest last
+        self.hashes = [tx_hash]
+        self.max_gas_price = max_gas_price
+        # the fields to resend with; read back from the node when it signed the transaction
+        self.transaction = dict(transaction) if transaction else None
+        self.sent = time.time()
+        self.last_sent = self.sent
+        self.bumps = 0
+        self.capped = False
+
+
+class TransactionMonitor(LoggingBase):
+    """
+    Follows our transfer and burn transactions until they are mined. Whenever
+    a new block arrives it looks for their receipts, and one still pending
+    after bump_after seconds is resent with the same nonce at a gas price
+    bump_percent higher (replace-by-fee), never above the maximum gas price
+    the command allowed.
+    """
 
-        super().log_message("Received transaction receipt, contract address: {0}".format(
-            self.tx_receipt.contractAddress))
+    def __init__(self, config, use_logger=None):
+        self.config = config
+        self.bump_after = config.get("tx_bump_after", DEFAULT_BUMP_AFTER)
+        self.bump_percent = max(config.get("tx_bump_percent", DEFAULT_BUMP_PERCENT), MIN_BUMP_PERCENT)
+        self.poll_interval = config.get("receipt_poll_interval", DEFAULT_RECEIPT_POLL_INTERVAL)
+        self.timeout = config.get("tx_monitor_timeout", DEFAULT_MONITOR_TIMEOUT)
+        self.lock = threading.Lock()
+        # notified when a transaction is added, so an idle poller doesn't keep asking the node for blocks
+        self.has_pending = threading.Condition(self.lock)
+        self.pending = []
+        self.last_block = None
+        self.confirmation_times = collections.deque(maxlen=MAX_CONFIRMATION_SAMPLES)
+        self.confirmed = 0
+        self.bumps = 0
+        self.abandoned = 0
+        self.poller = None
+        super().__init__(use_logger)
 
-        return self.tx_receipt.contractAddress
+    def track(self, tx_hash, max_gas_price, transaction=None):
+        """
+        :param max_gas_price: highest gas price (wei) a replacement may use
+        :param transaction: the locally signed transaction, None if the node signed it
+        """
+        with self.lock:
+            self.pending.append(PendingTransaction(tx_hash, max_gas_price, transaction))
+            self.has_pending.notify()
+            self._start_poller()
+
+    def _start_poller(self):
+        if self.poller is None:
+            self.poller = threading.Thread(target=self.run, name="tx-monitor", daemon=True)
+            self.poller.start()
+
+    def export_state(self):
+        with self.lock:
+            pending = list(self.pending)
+        output = []
+        for each in pending:
+            transaction = None
+            if each.transaction:
+                transaction = dict((key, Web3.toHex(value) if isinstance(value, bytes) else value)
+                                   for key, value in each.transaction.items())
+            output.append({"hashes": [Web3.toHex(tx_hash) for tx_hash in each.hashes],
+                           "max_gas_price": each.max_gas_price,
+                           "transaction": transaction,
+                           "sent": each.sent,
+                           "last_sent": each.last_sent,
+                           "bumps": each.bumps,
+                           "capped": each.capped})
+        return output
+
+    def restore_state(self, state):
+        """
+        Resumes following transactions saved by export_state() in a previous run.
+        """
+        restored = []
+        for saved in state:
+            pending = PendingTransaction(HexBytes(saved["hashes"][0]), saved["max_gas_price"], saved["transaction"])
+            pending.hashes = [HexBytes(tx_hash) for tx_hash in saved["hashes"]]
+            pending.sent = saved["sent"]
+            pending.last_sent = saved["last_sent"]
+            pending.bumps = saved["bumps"]
+            pending.capped = saved["capped"]
+            restored.append(pending)
+        with self.lock:
+            known = set(each.hashes[0] for each in self.pending)
+            restored = [each for each in restored if each.hashes[0] not in known]
+            self.pending.extend(restored)
+            if self.pending:
+                self.has_pending.notify()
+                self._start_poller()
+        return len(restored)
+
+    def run(self):
+        while True:
+            with self.lock:
+                while not self.pending:
+                    self.has_pending.wait()
+            time.sleep(self.poll_interval)
+            try:
+                self.check()
+            except Exception as err:
+                self.log_error("Transaction monitor check failed: %s", err)
+
+    def check(self):
+        with _admitted(self.config, "eth_blockNumber"):
+            block_number = web3.eth.blockNumber
+        if block_number == self.last_block:
+            return
+        self.last_block = block_number
+        with self.lock:
+            pending = list(self.pending)
+        finished = []
+        for each in pending:
+            now = time.time()
+            if self._mined(each, now):
+                finished.append(each)
+            elif now - each.sent > self.timeout:
+                self.abandoned += 1
+                self.log_error("Giving up on %s after %s seconds unmined", each.hashes[-1].hex(), self.timeout)
+                finished.append(each)
+            elif not each.capped and now - each.last_sent >= self.bump_after:
+                self._bump(each, now)
+        with self.lock:
+            self.pending = [each for each in self.pending if each not in finished]
+
+    def _mined(self, pending, now):
+        for tx_hash in reversed(pending.hashes):
+            with _admitted(self.config, "eth_getTransactionReceipt"):
+                receipt = web3.eth.getTransactionReceipt(tx_hash)
+            if receipt:
+                elapsed = now - pending.sent
+                self.confirmed += 1
+                self.confirmation_times.append(elapsed)
+                self.log_message("Transaction %s mined after %.1f seconds and %s gas price bumps",
+                                 tx_hash.hex(), elapsed, pending.bumps)
+                return True
+        return False
+
+    def _bump(self, pending, now):
+        if pending.transaction is None:
+            sent = web3.eth.getTransaction(pending.hashes[-1])
+            if sent is None:
+                return
+            pending.transaction = {'from': sent['from'], 'to': sent['to'], 'data': sent['input'], 'gas': sent['gas'],
+                                   'gasPrice': sent['gasPrice'], 'nonce': sent['nonce'], 'value': sent['value']}
+        gas_price = pending.transaction['gasPrice']
+        new_gas_price = min(int(gas_price * (100 + self.bump_percent) / 100) + 1, pending.max_gas_price)
+        if new_gas_price * 100 < gas_price * (100 + MIN_BUMP_PERCENT):
+            pending.capped = True
+            self.log_error("%s is at its maximum gas price of %s GWei, waiting for it to be mined",
+                           pending.hashes[-1].hex(), Web3.fromWei(gas_price, 'gwei'))
+            return
+        transaction = dict(pending.transaction, gasPrice=new_gas_price)
+        signer = local_signer.get_signer(self.config)
+        try:
+            if signer:
+                raw_transaction = signer.sign(transaction)
+                with _admitted(self.config, "eth_sendRawTransaction", rate_limiter.PRIORITY_TRANSACTION):
+                    tx_hash = web3.eth.sendRawTransaction(raw_transaction)
+            else:
+                web3.personal.unlockAccount(transaction['from'], self.config['account_password'], 30)
+                with _admitted(self.config, "eth_sendTransaction", rate_limiter.PRIORITY_TRANSACTION):
+                    tx_hash = web3.eth.sendTransaction(transaction)
+        except (ValueError, rate_limiter.AdmissionRejected) as err:
+            # usually "nonce too low": an earlier version was just mined, the next check finds its receipt
+            self.log_error("Replacing %s failed: %s", pending.hashes[-1].hex(), err)
+            return
+        self.log_message("Replaced %s with %s at %s GWei", pending.hashes[-1].hex(), tx_hash.hex(),
+                         Web3.fromWei(new_gas_price, 'gwei'))
+        pending.transaction = transaction
+        pending.hashes.append(tx_hash)
+        pending.last_sent = now
+        pending.bumps += 1
+        self.bumps += 1
+
+    def stats(self):
+        times = sorted(self.confirmation_times)
+        output = {"pending": len(self.pending),
+                  "confirmed": self.confirmed,
+                  "bumps": self.bumps,
+                  "abandoned": self.abandoned}
+        if times:
+            output["confirmation_mean_seconds"] = sum(times) / len(times)
+            output["confirmation_p50_seconds"] = times[int(0.50 * (len(times) - 1))]
+            output["confirmation_p95_seconds"] = times[int(0.95 * (len(times) - 1))]
+        return output
+
+
+_transaction_monitor = None
+_transaction_monitor_lock = threading.Lock()
+
+
+def get_transaction_monitor(config, logger=None):
+    global _transaction_monitor
+    with _transaction_monitor_lock:
+        if _transaction_monitor is None:
+            _transaction_monitor = TransactionMonitor(config, logger)
+        return _transaction_monitor
 
 
 if __name__ == "__main__":
@@ -242,14 +769,17 @@ if __name__ == "__main__":
     ch = logging.StreamHandler()
     ch.setLevel(logging.INFO)
     # create formatter and add it to the handlers
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    formatter = log_pipeline.get_formatter(config_data)
     fh.setFormatter(formatter)
     ch.setFormatter(formatter)
-    # add the handlers to the logger
+    # add the handlers to the logger, then move them to a background thread so file writes don't block callers
     logger.addHandler(fh)
     logger.addHandler(ch)
+    log_pipeline.setup_queue_logging(logger, config_data.get("log_queue_size", log_pipeline.DEFAULT_QUEUE_SIZE))
 
     logger.info("Logging started")
+    if config_data.get("nodes"):
+        connect(config_data)
 
     erc20_remaining_tokens = ExecuteERC20Contract(config_data, "0x476b4077Ff0fC082B6e4C639480BE1DFD2a3e22a",
                                                   use_logger=logger)
@@ -0,0 +1,108 @@
+# caches estimateGas results for transaction shapes that cost the same every time
+import logging
+import threading
+import time
+
+DEFAULT_MARGIN = 1.2
+# a cached estimate is re-checked against the node after this many uses or seconds
+DEFAULT_REVALIDATE_USES = 50
+DEFAULT_REVALIDATE_SECONDS = 600
+DEFAULT_LOGGER = logging.getLogger("GasEstimateCache")
+
+
+class GasEstimate:
+    def __init__(self, gas):
+        self.gas = gas
+        self.validated = time.time()
+        self.uses = 0
+
+
+class GasEstimateCache:
+    """
+    Gas estimates keyed by (contract, function, recipient_is_new). ERC20
+    transfers to an address that already holds tokens cost nearly the same gas
+    every time, and so do transfers to an address with a zero balance, so one
+    live estimate per shape (plus a safety margin) covers every later
+    transaction. Unless split_recipients is set, callers use only the
+    conservative recipient_is_new=True shape and never look the recipient up.
+    """
+
+    def __init__(self, margin=DEFAULT_MARGIN, revalidate_uses=DEFAULT_REVALIDATE_USES,
+                 revalidate_seconds=DEFAULT_REVALIDATE_SECONDS, logger=None, split_recipients=False):
+        self.margin = margin
+        # tell existing holders apart, at the cost of a balanceOf call per transaction
+        self.split_recipients = split_recipients
+        self.revalidate_uses = revalidate_uses
+        self.revalidate_seconds = revalidate_seconds
+        self.logger = logger or DEFAULT_LOGGER
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _due(self, entry):
+        return entry.uses >= self.revalidate_uses or time.time() - entry.validated > self.revalidate_seconds
+
+    def estimate(self, contract_address, function_name, recipient_is_new, live_estimate):
+        """
+        Returns a gas limit for the transaction shape, calling live_estimate()
+        (which should return the node's estimateGas) only when there is no
+        cached value or it is due for re-validation.
+        """
+        key = (contract_address.lower(), function_name, recipient_is_new)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and not self._due(entry):
+                entry.uses += 1
+                self.hits += 1
+                return int(entry.gas * self.margin)
+            self.misses += 1
+        try:
+            gas = live_estimate()
+        except Exception:
+            if entry:
+                # node hiccup during re-validation, the old value is still good
+                self.logger.info("Gas re-validation failed for %s, using cached estimate", key)
+                return int(entry.gas * self.margin)
+            raise
+        if entry and entry.gas != gas:
+            self.logger.info("Gas estimate for %s changed from %s to %s", key, entry.gas, gas)
+        with self.lock:
+            self.entries[key] = GasEstimate(gas)
+        return int(gas * self.margin)
+
+    def invalidate(self, contract_address, function_name, recipient_is_new):
+        with self.lock:
+            self.entries.pop((contract_address.lower(), function_name, recipient_is_new), None)
+
+    def export_state(self):
+        with self.lock:
+            return {"entries": [list(key) + [entry.gas, entry.validated, entry.uses]
+                                for key, entry in self.entries.items()]}
+
+    def restore_state(self, state):
+        """
+        Restored estimates keep their validation time and use count, so they
+        are re-checked against the node on the usual schedule.
+        """
+        with self.lock:
+            for contract_address, function_name, recipient_is_new, gas, validated, uses in state["entries"]:
+                entry = self.entries[(contract_address, function_name, recipient_is_new)] = GasEstimate(gas)
+                entry.validated = validated
+                entry.uses = uses
+
+
+_gas_cache = None
+_gas_cache_lock = threading.Lock()
+
+
+def get_gas_cache(config, logger=None):
+    global _gas_cache
+    with _gas_cache_lock:
+        if _gas_cache is None:
+            _gas_cache = GasEstimateCache(config.get("gas_estimate_margin", DEFAULT_MARGIN),
+                                          config.get("gas_estimate_revalidate_uses", DEFAULT_REVALIDATE_USES),
+                                          config.get("gas_estimate_revalidate_seconds", DEFAULT_REVALIDATE_SECONDS),
+                                          logger,
+                                          config.get("gas_estimate_split_recipients", False))
+        return _gas_cache
@@ -1,6 +1,37 @@
+import codecs
 import socket
 import json
+import logging
+import threading
 import time
+import tracing
+from urllib.request import Request, urlopen, URLError
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+RECV_SIZE = 262144
+INITIAL_BUFFER_SIZE = 262144
+NEWLINE = ord("\n")
+# seconds to wait for a response, unless config['rpc_timeout'] says otherwise
+IPC_TIMEOUT = 2
+HTTP_TIMEOUT = 10
+# delay before retrying a request that got no response, doubled for each further retry
+RETRY_BACKOFF = 0.1
+MAX_RETRY_BACKOFF = 2
+DEFAULT_LOGGER = logging.getLogger("GethInterface")
+
+
+def parse_json(data):
+    """
+    Parses JSON from a bytes-like object, using orjson when it is installed.
+    Raises ValueError on malformed or incomplete input.
+    """
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data.tobytes() if type(data) is memoryview else data)
 
 
 class GethInterface:
@@ -10,44 +41,272 @@ class GethInterface:
         else:
             self.request_data = request_data
         self.config = config_data
-        self.logger = logger
+        self.logger = logger or DEFAULT_LOGGER
+        # transport counters for the last send(), read by NodeInfo's metrics
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.timeouts = 0
+        self.retries = 0
+        self.parse_time = 0.0
+        self.response_data = None
 
     def setup_socket(self):
         new_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         new_socket.connect(self.config['ipc_address'])
-        new_socket.settimeout(2)
+        new_socket.settimeout(self.config.get('rpc_timeout', IPC_TIMEOUT))
         return new_socket
 
     def log_info(self, message):
-        if self.logger:
-            self.logger.info(message)
-        else:
-            print(message)
+        self.logger.info(message)
 
     def log_error(self, message):
-        if self.logger:
-            self.logger.error(message)
-        else:
-            print(message)
+        self.logger.error(message)
+
+    def backoff(self):
+        time.sleep(min(RETRY_BACKOFF * 2 ** (self.retries - 1), MAX_RETRY_BACKOFF))
 
+    def _receive(self, _socket, buffer):
+        """
+        Reads one newline-terminated response into buffer with recv_into and
+        parses it straight from the bytes. Returns (length, parsed) where parsed
+        is None if the response never completed.
+        """
+        length = 0
+        while True:
+            if length + RECV_SIZE > len(buffer):
+                buffer.extend(bytes(len(buffer)))
+            view = memoryview(buffer)
+            try:
+                received = _socket.recv_into(view[length:], RECV_SIZE)
+            finally:
+                view.release()
+            if received == 0:
+                return length, None
+            length += received
+            # geth terminates every IPC response with a newline
+            if buffer[length - 1] == NEWLINE:
+                start = time.perf_counter()
+                view = memoryview(buffer)[:length]
+                try:
+                    parsed = parse_json(view)
+                except ValueError:
+                    # a newline inside a partial read, keep going
+                    continue
+                finally:
+                    view.release()
+                    self.parse_time += time.perf_counter() - start
+                return length, parsed
+
+    @tracing.traced("ipc.send")
     def send(self):
+        """
+        Sends the request and returns the raw response bytes. The parsed
+        response is left in self.response_data so callers don't decode twice.
+        """
         _socket = self.setup_socket()
-        _socket.sendall(self.request_data.encode())
-        response_raw = ""
+        request_bytes = self.request_data.encode()
+        buffer = bytearray(INITIAL_BUFFER_SIZE)
+        length = 0
         for _ in range(self.config['max_rpc_tries']):
-            while True:
-                try:
-                    response_raw += _socket.recv(4096).decode()
-                except socket.timeout:
-                    self.log_error("Geth IPC socket timeout.")
-                    # wait 2 seconds before hammering the IO system some more
-                    time.sleep(2)
-                    break
-            if response_raw == "":
-                # retry if we didn't get a response
+            _socket.sendall(request_bytes)
+            self.bytes_sent += len(request_bytes)
+            timed_out = False
+            try:
+                length, self.response_data = self._receive(_socket, buffer)
+            except socket.timeout:
+                self.timeouts += 1
+                self.log_error("Geth IPC socket timeout.")
+                # wait 2 seconds before hammering the IO system some more
+                time.sleep(2)
+                length = 0
+                timed_out = True
+            if self.response_data is None:
+                # retry if we didn't get a complete response
                 self.log_info("Geth IPC socket no response, retrying...")
+                self.retries += 1
                 _socket.close()
+                if not timed_out:
+                    self.backoff()
                 _socket = self.setup_socket()
             else:
                 break
+        _socket.close()
+        self.bytes_received = length
+        with memoryview(buffer) as view:
+            return view[:length].tobytes()
+
+
+class GethHTTPInterface(GethInterface):
+    """
+    Same contract as GethInterface but talks to a node's HTTP JSON-RPC
+    endpoint (config['http_address']) instead of the IPC socket.
+    """
+
+    @tracing.traced("http.send")
+    def send(self):
+        request_bytes = self.request_data.encode()
+        response_raw = b""
+        for _ in range(self.config['max_rpc_tries']):
+            req = Request(self.config['http_address'],
+                          data=request_bytes,
+                          headers={'Content-Type': 'application/json'},
+                          method="POST")
+            self.bytes_sent += len(request_bytes)
+            try:
+                response_raw = urlopen(req, timeout=self.config.get('rpc_timeout', HTTP_TIMEOUT)).read()
+            except socket.timeout:
+                self.timeouts += 1
+                self.log_error("Geth HTTP request timeout.")
+                response_raw = b""
+            except URLError as err:
+                self.log_error("Geth HTTP request failed: {0}".format(err))
+                response_raw = b""
+            if response_raw:
+                start = time.perf_counter()
+                try:
+                    self.response_data = parse_json(response_raw)
+                except ValueError:
+                    self.response_data = None
+                self.parse_time += time.perf_counter() - start
+            if self.response_data is None:
+                self.log_info("Geth HTTP no response, retrying...")
+                self.retries += 1
+                self.backoff()
+            else:
+                break
+        self.bytes_received = len(response_raw)
         return response_raw
+
+
+class GethSubscription:
+    """
+    Long-lived IPC connection for eth_subscribe. Notifications are read on a
+    background thread and handed to the callback registered for their
+    subscription; the connection is re-established and every subscription
+    renewed if geth goes away.
+    """
+
+    def __init__(self, config_data, logger=None):
+        self.config = config_data
+        self.logger = logger or DEFAULT_LOGGER
+        self.socket = None
+        self.running = False
+        self.connected = threading.Event()
+        self.lock = threading.Lock()
+        self.next_id = 1
+        # (params, callback) for every subscription, replayed on reconnect
+        self.subscriptions = []
+        # request id -> callback, until geth answers with the subscription id
+        self.pending = {}
+        # subscription id -> callback
+        self.callbacks = {}
+        self.notifications = 0
+
+    def log_info(self, message):
+        self.logger.info(message)
+
+    def log_error(self, message):
+        self.logger.error(message)
+
+    def subscribe(self, params, callback):
+        """
+        :param params: eth_subscribe params, e.g. ["newHeads"] or ["logs", {"address": ...}]
+        :param callback: called with the notification's result on the reader thread
+        """
+        with self.lock:
+            self.subscriptions.append((params, callback))
+        if self.connected.is_set():
+            self._send_subscribe(params, callback)
+
+    def start(self):
+        self.running = True
+        thread = threading.Thread(target=self._run, daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        self.connected.clear()
+        if self.socket:
+            self.socket.close()
+            self.socket = None
+
+    def _send_subscribe(self, params, callback):
+        with self.lock:
+            request_id = self.next_id
+            self.next_id += 1
+            self.pending[request_id] = callback
+        request_data = json.dumps({"jsonrpc": "2.0", "id": request_id, "method": "eth_subscribe", "params": params})
+        self.socket.sendall(request_data.encode())
+
+    def _connect(self):
+        new_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        new_socket.connect(self.config['ipc_address'])
+        # short timeout so stop() is noticed; silence between blocks is normal here
+        new_socket.settimeout(1)
+        self.socket = new_socket
+        with self.lock:
+            self.pending = {}
+            self.callbacks = {}
+            subscriptions = list(self.subscriptions)
+        for params, callback in subscriptions:
+            self._send_subscribe(params, callback)
+        self.connected.set()
+
+    def _run(self):
+        decoder = json.JSONDecoder()
+        while self.running:
+            try:
+                self._connect()
+                self.log_info("Geth IPC subscription connected.")
+                # a recv can end part way through a multi-byte character
+                text = codecs.getincrementaldecoder("utf-8")()
+                pending = ""
+                while self.running:
+                    try:
+                        chunk = self.socket.recv(65536)
+                    except socket.timeout:
+                        continue
+                    if not chunk:
+                        raise ConnectionError("Geth closed the IPC subscription socket")
+                    pending += text.decode(chunk)
+                    while True:
+                        pending = pending.lstrip()
+                        if not pending:
+                            break
+                        try:
+                            message, end = decoder.raw_decode(pending)
+                        except json.JSONDecodeError:
+                            break
+                        pending = pending[end:]
+                        self._dispatch(message)
+            except Exception as err:
+                # anything that ends the read loop drops the connection, so update() goes back to polling
+                self.connected.clear()
+                if not self.running:
+                    break
+                self.log_error("Geth IPC subscription lost ({0!r}), reconnecting in 2 seconds.".format(err))
+                if self.socket:
+                    self.socket.close()
+                    self.socket = None
+                time.sleep(2)
+
+    def _dispatch(self, message):
+        if type(message) is not dict:
+            return
+        if message.get("method") == "eth_subscription":
+            params = message["params"]
+            callback = self.callbacks.get(params["subscription"])
+            if callback:
+                self.notifications += 1
+                try:
+                    callback(params["result"])
+                except Exception as err:
+                    self.log_error("Subscription callback failed: {0}".format(err))
+        elif "id" in message:
+            with self.lock:
+                callback = self.pending.pop(message["id"], None)
+                if callback and "result" in message:
+                    self.callbacks[message["result"]] = callback
+            if callback and "error" in message:
+                self.log_error("eth_subscribe failed: {0}".format(message["error"]))
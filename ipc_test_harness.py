@@ -1,83 +1,359 @@
 # class for injection dependency testing node_information.py off an active ETH node
+import hashlib
 import json
+import os
+import socket
+import threading
 import ipc_socket
 
 
 NODE_SYNCED = False
 
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "geth_test_responses")
+
+# methods answered with the same canned result whatever the params are
+STATIC_METHODS = ("admin_nodeInfo", "admin_peers", "eth_gasPrice", "eth_call")
+
+RESPONSE_TEMPLATE = '{"jsonrpc":"2.0","id":%s,"result":%s}'
+
+# the unlocked account the stand-in reports for eth_accounts
+STAND_IN_ACCOUNT = "0x476b4077Ff0fC082B6e4C639480BE1DFD2a3e22a"
+STAND_IN_CHAIN_ID = 1
+STAND_IN_GAS_ESTIMATE = 52000
+
+
+class FixtureStore:
+    """
+    Loads every fixture in geth_test_responses/ once and keeps the results
+    pre-encoded as JSON so responses can be assembled without touching disk.
+    """
+
+    def __init__(self, fixture_dir=FIXTURE_DIR):
+        self.fixture_dir = fixture_dir
+        self.results = {}
+        self.blocks_by_number = {}
+        self.blocks_by_hash = {}
+        self.headers_by_number = {}
+        self.tx_counts = {}
+        self.latest_header = None
+        self.receipts = {}
+        self.logs = []
+        # transactions sent to the stand-in, all mined at once
+        self.sent_transactions = 0
+        self.load()
+
+    def _read_result(self, name):
+        response_stream = open(os.path.join(self.fixture_dir, name + ".json"), "r")
+        response_data = json.load(response_stream)
+        response_stream.close()
+        return response_data["result"]
+
+    def load(self):
+        for method in STATIC_METHODS + ("eth_getBalance", "eth_syncing", "eth_not_syncing"):
+            self.results[method] = json.dumps(self._read_result(method))
+        self.latest_header = json.dumps(self._read_result("eth_getBlockByNumber"))
+        self.add_block(self._read_result("eth_getBlockByNumber_full"))
+        for each in self._read_result("eth_getTransactionReceipt"):
+            self.receipts[each["transactionHash"]] = json.dumps(each)
+        self.logs = self._read_result("eth_getLogs")
+
+    def add_block(self, block):
+        """
+        Indexes a full block (transactions as objects) so it can be served by
+        number or hash, with and without full transactions.
+        """
+        number = int(block["number"], 16)
+        header = dict(block)
+        header["transactions"] = [each["hash"] for each in block["transactions"]]
+        self.blocks_by_number[number] = json.dumps(block)
+        self.blocks_by_hash[block["hash"]] = number
+        self.headers_by_number[number] = json.dumps(header)
+        self.tx_counts[number] = len(block["transactions"])
+
+    def get_block(self, block_id, full_transactions):
+        if block_id == "latest":
+            if full_transactions:
+                return self.blocks_by_number[max(self.blocks_by_number)]
+            return self.latest_header
+        if block_id in self.blocks_by_hash:
+            number = self.blocks_by_hash[block_id]
+        else:
+            number = int(block_id, 16)
+        if number not in self.blocks_by_number:
+            return "null"
+        if full_transactions:
+            return self.blocks_by_number[number]
+        return self.headers_by_number[number]
+
+    def add_receipt(self, tx_hash, transaction=None):
+        """
+        Mines a sent transaction into the latest block straight away. Raw
+        transactions aren't decoded, so their receipts have no from/to and
+        always carry a contract address, as if each one were a deployment.
+        """
+        header = json.loads(self.latest_header)
+        transaction = transaction or {}
+        contract_address = None
+        if not transaction.get("to"):
+            contract_address = "0x" + hashlib.sha256(tx_hash.encode()).hexdigest()[:40]
+        self.receipts[tx_hash] = json.dumps({"blockHash": header["hash"],
+                                             "blockNumber": header["number"],
+                                             "contractAddress": contract_address,
+                                             "cumulativeGasUsed": hex(STAND_IN_GAS_ESTIMATE),
+                                             "from": transaction.get("from"),
+                                             "gasUsed": hex(STAND_IN_GAS_ESTIMATE),
+                                             "logs": [],
+                                             "logsBloom": "0x" + "00" * 256,
+                                             "status": "0x1",
+                                             "to": transaction.get("to"),
+                                             "transactionHash": tx_hash,
+                                             "transactionIndex": "0x0"})
+        self.sent_transactions += 1
+
+    def get_logs(self, log_filter):
+        from_block = log_filter.get("fromBlock", "earliest")
+        to_block = log_filter.get("toBlock", "latest")
+        addresses = log_filter.get("address")
+        if type(addresses) is str:
+            addresses = [addresses]
+        output = []
+        for each in self.logs:
+            block_number = int(each["blockNumber"], 16)
+            if from_block not in ("earliest", "latest", "pending") and block_number < int(from_block, 16):
+                continue
+            if to_block not in ("earliest", "latest", "pending") and block_number > int(to_block, 16):
+                continue
+            if addresses and each["address"].lower() not in [a.lower() for a in addresses]:
+                continue
+            output.append(each)
+        return json.dumps(output)
+
+
+_fixture_store = None
+
+
+def get_fixture_store():
+    global _fixture_store
+    if _fixture_store is None:
+        _fixture_store = FixtureStore()
+    return _fixture_store
+
+
+def _check_params(request_data, expected_length):
+    if "params" not in request_data or type(request_data["params"]) is not list:
+        raise TypeError("Expected params list in request")
+    args = request_data["params"]
+    if len(args) < expected_length:
+        raise ValueError("Expected {0} params for {1}".format(expected_length, request_data["method"]))
+    return args
+
+
+def respond(request_data, store=None):
+    """
+    Builds the raw JSON response for a single request object, the way geth would.
+    """
+    if store is None:
+        store = get_fixture_store()
+    if type(request_data) is not dict:
+        raise TypeError("Stream output did not JSON deserialize into expected object")
+    method = request_data["method"]
+    if method in STATIC_METHODS:
+        result = store.results[method]
+    elif method == "eth_getBlockByNumber":
+        args = _check_params(request_data, 2)
+        if type(args[0]) is not str:
+            raise TypeError("Expected string for first param")
+        if type(args[1]) is not bool:
+            raise TypeError("Expected bool for second param")
+        result = store.get_block(args[0], args[1])
+    elif method == "eth_getBlockTransactionCountByHash":
+        args = _check_params(request_data, 1)
+        if args[0] in store.blocks_by_hash:
+            result = json.dumps(hex(store.tx_counts[store.blocks_by_hash[args[0]]]))
+        else:
+            result = "null"
+    elif method == "eth_syncing":
+        if NODE_SYNCED:
+            result = store.results["eth_syncing"]
+        else:
+            result = store.results["eth_not_syncing"]
+    elif method == "eth_getBalance":
+        args = _check_params(request_data, 2)
+        if type(args[0]) is not str:
+            raise TypeError("Expected string for first param")
+        if type(args[1]) is not str:
+            raise TypeError("Expected string for second param")
+        if args[1] != 'latest':
+            raise ValueError("Second argument should only be 'latest'")
+        result = store.results["eth_getBalance"]
+    elif method == "eth_getTransactionReceipt":
+        args = _check_params(request_data, 1)
+        result = store.receipts.get(args[0], "null")
+    elif method == "eth_getLogs":
+        args = _check_params(request_data, 1)
+        if type(args[0]) is not dict:
+            raise TypeError("Expected filter object for first param")
+        result = store.get_logs(args[0])
+    elif method in ("eth_sendTransaction", "eth_sendRawTransaction"):
+        if "params" not in request_data:
+            raise TypeError("Expected params in request")
+        tx_hash = "0x" + hashlib.sha256(json.dumps(request_data["params"], sort_keys=True).encode()).hexdigest()
+        params = request_data["params"]
+        store.add_receipt(tx_hash, params[0] if method == "eth_sendTransaction" and params else None)
+        result = json.dumps(tx_hash)
+    elif method == "eth_blockNumber":
+        result = json.dumps(json.loads(store.latest_header)["number"])
+    elif method == "eth_getTransactionCount":
+        result = json.dumps(hex(store.sent_transactions))
+    elif method == "eth_estimateGas":
+        result = json.dumps(hex(STAND_IN_GAS_ESTIMATE))
+    elif method == "eth_accounts":
+        result = json.dumps([STAND_IN_ACCOUNT])
+    elif method == "eth_chainId":
+        result = json.dumps(hex(STAND_IN_CHAIN_ID))
+    elif method == "net_version":
+        result = json.dumps(str(STAND_IN_CHAIN_ID))
+    elif method == "personal_unlockAccount":
+        result = "true"
+    else:
+        raise ValueError("Unsupported method")
+    return RESPONSE_TEMPLATE % (json.dumps(request_data.get("id")), result)
+
 
 class IPCTestHarness(ipc_socket.GethInterface):
 
     def send(self):
         request_data = json.loads(self.request_data)
-        if type(request_data) == dict:
-            if request_data["method"] == "admin_nodeInfo":
-                response_stream = open("geth_test_responses/admin_nodeInfo.json", "r")
-                response_data = json.load(response_stream)
-                response_stream.close()
-                response_data["id"] = request_data["id"]
-                return response_data
-            elif request_data["method"] == "admin_peers":
-                response_stream = open("geth_test_responses/admin_peers.json", "r")
-                response_data = json.load(response_stream)
-                response_stream.close()
-                response_data["id"] = request_data["id"]
-                return response_data
-            elif request_data["method"] == "eth_gasPrice":
-                response_stream = open("geth_test_responses/eth_gasPrice.json", "r")
-                response_data = json.load(response_stream)
-                response_stream.close()
-                response_data["id"] = request_data["id"]
-                return response_data
-            elif request_data["method"] == "eth_getBlockByNumber":
-                if "params" in request_data:
-                    args = request_data["params"]
-                    if type(args) is list:
-                        if type(args[0]) is not str:
-                            raise TypeError("Expected string for first param")
-                        if args[0] != "latest":
-                            raise ValueError("First argument should only be 'latest'")
-                        if type(args[1]) is not bool:
-                            raise TypeError("Expected bool for second param")
-                        if args[1] is not False:
-                            raise ValueError("Second argument should only by False")
-                        response_stream = open("geth_test_responses/eth_getBlockByNumber.json", "r")
-                        response_data = json.load(response_stream)
-                        response_stream.close()
-                        response_data["id"] = request_data["id"]
-                        return response_data
-                    else:
-                        raise TypeError("Expected params list in request")
-            elif request_data["method"] == "eth_syncing":
-                if NODE_SYNCED:
-                    response_stream = open("geth_test_responses/eth_syncing.json", "r")
-                    response_data = json.load(response_stream)
-                    response_stream.close()
-                    response_data["id"] = request_data["id"]
-                    return response_data
-                else:
-                    response_stream = open("geth_test_responses/eth_not_syncing.json", "r")
-                    response_data = json.load(response_stream)
-                    response_stream.close()
-                    response_data["id"] = request_data["id"]
-                    return response_data
-            elif request_data["method"] == "eth_getBalance":
-                args = request_data["params"]
-                if type(args) is list:
-                    if type(args[0]) is not str:
-                        raise TypeError("Expected string for first param")
-                    if type(args[1]) is not str:
-                        raise TypeError("Expected string for second param")
-                    if args[1] != 'latest':
-                        raise ValueError("Second argument should only be 'latest'")
-                else:
-                    raise TypeError("Expected parameter list in request data")
-                response_stream = open("geth_test_responses/eth_getBalance.json", "r")
-                response_data = json.load(response_stream)
-                response_stream.close()
-                response_data["id"] = request_data["id"]
-                return response_data
-            else:
-                raise ValueError("Unsupported method")
+        if type(request_data) == list:
+            response_raw = "[" + ",".join([respond(each) for each in request_data]) + "]"
         else:
-            raise TypeError("Stream output did not JSON deserialize into expected object")
+            response_raw = respond(request_data)
+        self.bytes_sent = len(self.request_data)
+        self.bytes_received = len(response_raw)
+        return response_raw
+
+
+class StandInGethServer:
+    """
+    Local stand-in for geth's IPC endpoint. Listens on a unix socket and answers
+    every request from the fixture store, newline terminated like geth does.
+    """
+
+    def __init__(self, socket_path, store=None):
+        self.socket_path = socket_path
+        self.store = store if store else get_fixture_store()
+        self.server_socket = None
+        self.running = False
+        self.requests_served = 0
+        # method -> requests answered, for counting round trips
+        self.method_counts = {}
+        # subscription id -> (connection, subscription type)
+        self.subscriptions = {}
+        self.lock = threading.Lock()
+
+    def start(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self.server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server_socket.bind(self.socket_path)
+        self.server_socket.listen(64)
+        self.running = True
+        thread = threading.Thread(target=self._accept_loop, daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.server_socket:
+            self.server_socket.close()
+            self.server_socket = None
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+    def _accept_loop(self):
+        while self.running:
+            try:
+                connection, _ = self.server_socket.accept()
+            except OSError:
+                break
+            thread = threading.Thread(target=self._serve_connection, args=(connection,), daemon=True)
+            thread.start()
+
+    def _serve_connection(self, connection):
+        decoder = json.JSONDecoder()
+        pending = ""
+        try:
+            while self.running:
+                chunk = connection.recv(65536)
+                if not chunk:
+                    break
+                pending += chunk.decode()
+                while True:
+                    pending = pending.lstrip()
+                    if not pending:
+                        break
+                    try:
+                        request_data, end = decoder.raw_decode(pending)
+                    except json.JSONDecodeError:
+                        break
+                    pending = pending[end:]
+                    connection.sendall((self._respond(request_data, connection) + "\n").encode())
+        except OSError:
+            pass
+        finally:
+            with self.lock:
+                for subscription_id in [key for key, value in self.subscriptions.items() if value[0] is connection]:
+                    del self.subscriptions[subscription_id]
+            connection.close()
+
+    def _respond(self, request_data, connection=None):
+        self.requests_served += 1
+        if type(request_data) == list:
+            return "[" + ",".join([self._respond_one(each, connection) for each in request_data]) + "]"
+        return self._respond_one(request_data, connection)
+
+    def push_new_head(self, block):
+        """
+        Adds a full block to the store, makes it the latest and notifies every
+        newHeads subscriber, like geth does when it imports a block.
+        """
+        self.store.add_block(block)
+        number = int(block["number"], 16)
+        self.store.latest_header = self.store.headers_by_number[number]
+        header = dict(json.loads(self.store.latest_header))
+        del header["transactions"]
+        self._notify("newHeads", header)
+
+    def _notify(self, subscription_type, result):
+        with self.lock:
+            targets = [(subscription_id, connection) for subscription_id, (connection, kind)
+                       in self.subscriptions.items() if kind == subscription_type]
+        for subscription_id, connection in targets:
+            message = {"jsonrpc": "2.0", "method": "eth_subscription",
+                       "params": {"subscription": subscription_id, "result": result}}
+            try:
+                connection.sendall((json.dumps(message) + "\n").encode())
+            except OSError:
+                with self.lock:
+                    self.subscriptions.pop(subscription_id, None)
+
+    def _subscribe(self, request_data, connection):
+        subscription_id = "0x" + hashlib.sha256(os.urandom(16)).hexdigest()[:32]
+        with self.lock:
+            self.subscriptions[subscription_id] = (connection, request_data["params"][0])
+        return RESPONSE_TEMPLATE % (json.dumps(request_data.get("id")), json.dumps(subscription_id))
+
+    def _respond_one(self, request_data, connection=None):
+        if type(request_data) is dict:
+            with self.lock:
+                method = request_data.get("method")
+                self.method_counts[method] = self.method_counts.get(method, 0) + 1
+        if type(request_data) is dict and request_data.get("method") == "eth_subscribe" and connection:
+            return self._subscribe(request_data, connection)
+        # a real node answers bad requests with an error object instead of hanging up
+        try:
+            return respond(request_data, self.store)
+        except (TypeError, ValueError, KeyError) as err:
+            request_id = request_data.get("id") if type(request_data) is dict else None
+            return json.dumps({"jsonrpc": "2.0", "id": request_id,
+                               "error": {"code": -32601, "message": str(err)}})
@@ -0,0 +1,432 @@
+import argparse
+import gzip
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import tempfile
+import threading
+import time
+import zlib
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import benchmark
+import command
+import erc20
+import ipc_test_harness
+
+HELP = """
+python3 load_generator.py [--rate 20] [--duration 30] [--workers 2] [--directed-workers 1]
+                     [--mix get_block_data=10,total_supply=4,transfer=4,burn=1,publish=1]
+                     [--replay stream.jsonl] [--save-stream stream.jsonl] [--output load_output.json]
+
+Runs command.py workers (each its own process, like production) against a
+local stand-in Node API and the stand-in geth (ipc_test_harness). Commands are
+released on a fixed schedule, at --rate per second for --duration seconds (or
+at the offsets of a --replay file), whether or not the workers keep up, and
+each one's latency is measured from when it was due to when its output was
+posted. Writes per-function latency percentiles and throughput as JSON.
+
+Stream files have one command per line: {"offset": seconds, "command_data": {...}}
+with command_data exactly as the Node API dispatches it.
+"""
+
+DEFAULT_OUTPUT = "load_output.json"
+DEFAULT_RATE = 20
+DEFAULT_DURATION = 30
+DEFAULT_WORKERS = 2
+DEFAULT_DIRECTED_WORKERS = 1
+DEFAULT_MIX = "get_block_data=10,total_supply=4,transfer=4,burn=1,publish=1"
+# distinct synthetic blocks served to get_block_data, and transactions in each
+DEFAULT_BLOCKS = 256
+DEFAULT_BLOCK_SIZE = 100
+FIRST_BLOCK = 9100000
+# seconds a worker waits after a poll that returned no command
+DEFAULT_IDLE_INTERVAL = 0.05
+# seconds to wait for outputs after the last command was due
+DEFAULT_DRAIN_TIMEOUT = 60
+# seconds to wait for every worker to start polling before the schedule starts
+STARTUP_TIMEOUT = 60
+
+DIRECTED_FUNCTIONS = ("publish", "transfer", "burn", "total_supply")
+API_KEY = "load-test"
+CONTRACT_ADDRESS = "0x3c469e9d6c5875d37a43f353d4ea8da14f68b5c1"
+FINISHED_MESSAGE = "Load test finished"
+CONFIG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config")
+
+
+def parse_mix(text):
+    """
+    "get_block_data=10,transfer=1" -> {"get_block_data": 10.0, "transfer": 1.0}
+    """
+    mix = {}
+    for each in text.split(","):
+        name, weight = each.split("=")
+        if name not in ("get_block_data",) + DIRECTED_FUNCTIONS:
+            raise ValueError("Unknown command in mix: {0}".format(name))
+        mix[name] = float(weight)
+    return mix
+
+
+def function_name(command_data):
+    return "get_block_data" if "get_block_data" in command_data else command_data.get("erc20_function")
+
+
+def is_directed(command_data):
+    return "erc20_function" in command_data
+
+
+def synthetic_command(function, command_id, rng, blocks):
+    if function == "get_block_data":
+        return {"command_id": command_id, "get_block_data": FIRST_BLOCK + rng.randrange(blocks)}
+    command_data = {"command_id": command_id, "erc20_function": function, "token_id": rng.randrange(1, 1000)}
+    if function == "publish":
+        command_data.update(token_name="Load Test Token", token_symbol="LTT", token_count=1000000)
+    elif function == "total_supply":
+        command_data.update(contract_address=CONTRACT_ADDRESS)
+    else:
+        command_data.update(contract_address=CONTRACT_ADDRESS, token_count=rng.randrange(1, 100), gas_price=20)
+        if function == "transfer":
+            command_data["address"] = "0x%040x" % rng.randrange(1, 2 ** 160)
+    return command_data
+
+
+def synthetic_stream(rate, duration, mix, blocks=DEFAULT_BLOCKS, poisson=False, seed=None):
+    """
+    Commands at rate per second for duration seconds, evenly spaced or with
+    Poisson arrivals, drawn from mix (name -> weight).
+    """
+    rng = random.Random(seed)
+    names = sorted(mix)
+    weights = [mix[name] for name in names]
+    stream = []
+    offset = 0.0
+    while offset < duration:
+        command_id = len(stream) + 1
+        function = rng.choices(names, weights)[0]
+        stream.append({"offset": offset, "command_data": synthetic_command(function, command_id, rng, blocks)})
+        offset += rng.expovariate(rate) if poisson else 1.0 / rate
+    return stream
+
+
+def load_stream(filename, speed=1.0):
+    input_stream = open(filename, "r")
+    stream = [json.loads(line) for line in input_stream if line.strip()]
+    input_stream.close()
+    for each in stream:
+        each["offset"] /= speed
+    return sorted(stream, key=lambda each: each["offset"])
+
+
+def save_stream(stream, filename):
+    output_stream = open(filename, "w")
+    for each in stream:
+        output_stream.write(json.dumps(each) + "\n")
+    output_stream.close()
+
+
+class CommandRecord:
+    def __init__(self, command_data, due):
+        self.command_data = command_data
+        self.function = function_name(command_data)
+        self.due = due
+        self.dispatched = None
+        self.completed = None
+        self.success = None
+        self.outputs = 0
+
+
+class StandInNodeApi:
+    """
+    Local stand-in for the Node API's dispatch and command_output endpoints.
+    A command is only dispatched once its offset has passed; after close()
+    every dispatch answers with an error, which ends the workers' loops.
+    """
+
+    def __init__(self, stream, port=0):
+        self.stream = stream
+        self.queues = {"directed": deque(), "undirected": deque()}
+        self.records = {}
+        self.lock = threading.Lock()
+        self.polls = 0
+        self.start_time = None
+        self.closed = False
+        self.unknown_outputs = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self.server.daemon_threads = True
+
+    @property
+    def endpoint(self):
+        return "http://127.0.0.1:{0}/".format(self.server.server_address[1])
+
+    def _handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                parts = self.path.strip("/").split("/")
+                if len(parts) == 3 and parts[1] == "dispatch_directed_command":
+                    self._respond(api.dispatch("directed"))
+                elif len(parts) == 3 and parts[1] == "dispatch_undirected_command":
+                    self._respond(api.dispatch("undirected"))
+                else:
+                    self.send_error(404)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                encoding = self.headers.get("Content-Encoding")
+                if encoding == "gzip":
+                    body = gzip.decompress(body)
+                elif encoding == "deflate":
+                    body = zlib.decompress(body)
+                api.output(json.loads(body.decode('utf-8')))
+                self._respond({"result": "OK"})
+
+            def _respond(self, output):
+                data = json.dumps(output).encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        thread = threading.Thread(target=self.server.serve_forever, name="stand-in-node-api", daemon=True)
+        thread.start()
+        return self
+
+    def begin(self):
+        """
+        Starts the schedule: offsets count from now.
+        """
+        with self.lock:
+            self.start_time = time.time()
+            for each in self.stream:
+                record = CommandRecord(each["command_data"], self.start_time + each["offset"])
+                self.records[record.command_data["command_id"]] = record
+                self.queues["directed" if is_directed(record.command_data) else "undirected"].append(record)
+
+    def dispatch(self, kind):
+        now = time.time()
+        with self.lock:
+            self.polls += 1
+            if self.closed:
+                return {"result": "Error", "error_message": FINISHED_MESSAGE}
+            queue = self.queues[kind]
+            if queue and queue[0].due <= now:
+                record = queue.popleft()
+                record.dispatched = now
+                return {"result": "OK", "command_data": record.command_data}
+        return {"result": "OK", "command_data": {}}
+
+    def output(self, output):
+        now = time.time()
+        with self.lock:
+            record = self.records.get(output.get("command_id"))
+            if record is None:
+                self.unknown_outputs += 1
+                return
+            record.outputs += 1
+            # latency runs to the first output; some failure paths post a second one
+            if record.completed is None:
+                record.completed = now
+                record.success = bool(output.get("success"))
+
+    def all_completed(self):
+        with self.lock:
+            return all(record.completed is not None for record in self.records.values())
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def worker_config(api_endpoint, socket_path, overrides=None):
+    config = {"api_endpoint": api_endpoint,
+              "api_key": API_KEY,
+              "user_agent": "load_generator",
+              "ipc_address": socket_path,
+              "max_rpc_tries": 3,
+              "polling_interval": 1,
+              "idle_poll_interval": DEFAULT_IDLE_INTERVAL,
+              "account": ipc_test_harness.STAND_IN_ACCOUNT,
+              "account_password": "",
+              "abi": os.path.join(CONFIG_DIR, "erc20.abi"),
+              "bin": os.path.join(CONFIG_DIR, "erc20.bin"),
+              "receipt_timeout": 30,
+              "receipt_poll_interval": 0.1}
+    if overrides:
+        config.update(overrides)
+    return config
+
+
+def run_worker(mode, config):
+    """
+    One command.py worker loop, run in its own process until the stand-in Node API closes.
+    """
+    logger = logging.getLogger("load_generator.{0}.{1}".format(mode, os.getpid()))
+    logger.setLevel(logging.WARNING)
+    logger.addHandler(logging.StreamHandler())
+    command_module = command.CommandModule(logger, config)
+    erc20.connect(config)
+    poll = getattr(command_module, mode)
+    try:
+        while True:
+            if not poll():
+                time.sleep(config["idle_poll_interval"])
+    except command.NodeApiError:
+        pass
+
+
+def latency_summary(samples):
+    if not samples:
+        return {"count": 0}
+    output = benchmark.summarize(samples)
+    # meaningless for latencies of overlapping commands, throughput is reported separately
+    del output["ops_per_second"]
+    return output
+
+
+def build_report(api):
+    records = list(api.records.values())
+    completed = [record for record in records if record.completed is not None]
+    functions = {}
+    for name in sorted(set(record.function for record in records)):
+        mine = [record for record in records if record.function == name]
+        done = [record for record in mine if record.completed is not None]
+        functions[name] = {"commands": len(mine),
+                           "completed": len(done),
+                           "failed": len([record for record in done if not record.success]),
+                           "duplicate_outputs": sum(max(record.outputs - 1, 0) for record in mine),
+                           "latency": latency_summary([record.completed - record.due for record in done]),
+                           "queue": latency_summary([record.dispatched - record.due for record in done]),
+                           "service": latency_summary([record.completed - record.dispatched for record in done])}
+    elapsed = max(record.completed for record in completed) - api.start_time if completed else 0
+    return {"commands": len(records),
+            "completed": len(completed),
+            "failed": len([record for record in completed if not record.success]),
+            "unknown_outputs": api.unknown_outputs,
+            "elapsed_seconds": elapsed,
+            "throughput_per_second": len(completed) / elapsed if elapsed else None,
+            "latency": latency_summary([record.completed - record.due for record in completed]),
+            "functions": functions}
+
+
+def run(stream, workers=DEFAULT_WORKERS, directed_workers=DEFAULT_DIRECTED_WORKERS, blocks=DEFAULT_BLOCKS,
+        block_size=DEFAULT_BLOCK_SIZE, drain_timeout=DEFAULT_DRAIN_TIMEOUT, overrides=None):
+    ipc_test_harness.NODE_SYNCED = True
+    store = ipc_test_harness.get_fixture_store()
+    for i in range(blocks):
+        store.add_block(benchmark.synthetic_block(FIRST_BLOCK + i, block_size))
+    socket_dir = tempfile.mkdtemp()
+    geth = ipc_test_harness.StandInGethServer(os.path.join(socket_dir, "geth.ipc"), store).start()
+    api = StandInNodeApi(stream).start()
+    config = worker_config(api.endpoint, geth.socket_path, overrides)
+
+    modes = []
+    if any(not is_directed(each["command_data"]) for each in stream):
+        modes += ["undirected_command"] * workers
+    if any(is_directed(each["command_data"]) for each in stream):
+        modes += ["directed_command"] * directed_workers
+    # spawned rather than forked, this process is already running server threads
+    context = multiprocessing.get_context("spawn")
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    processes = [context.Process(target=run_worker, args=(mode, config), daemon=True) for mode in modes]
+    try:
+        for each in processes:
+            each.start()
+        deadline = time.time() + STARTUP_TIMEOUT
+        while api.polls < len(processes) and time.time() < deadline:
+            time.sleep(0.05)
+        api.begin()
+        deadline = api.start_time + (stream[-1]["offset"] if stream else 0) + drain_timeout
+        while not api.all_completed() and time.time() < deadline:
+            time.sleep(0.1)
+        api.close()
+        for each in processes:
+            each.join(10)
+            if each.is_alive():
+                each.terminate()
+    finally:
+        api.stop()
+        geth.stop()
+        os.rmdir(socket_dir)
+    report = build_report(api)
+    report["geth_requests"] = geth.requests_served
+    # both stand-ins run in this process; near 1.0 means they, not the workers, were the bottleneck
+    used = resource.getrusage(resource.RUSAGE_SELF)
+    if report["elapsed_seconds"]:
+        report["harness_cpu_fraction"] = (used.ru_utime + used.ru_stime - usage.ru_utime - usage.ru_stime) / \
+            report["elapsed_seconds"]
+    report["workers"] = {"undirected": modes.count("undirected_command"),
+                         "directed": modes.count("directed_command")}
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=HELP, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rate", type=float, default=DEFAULT_RATE)
+    parser.add_argument("--duration", type=float, default=DEFAULT_DURATION)
+    parser.add_argument("--mix", default=DEFAULT_MIX)
+    parser.add_argument("--poisson", action="store_true", help="Poisson arrivals instead of evenly spaced")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--replay", default=None, help="stream file to replay instead of a synthetic stream")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed-up factor")
+    parser.add_argument("--save-stream", default=None)
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    parser.add_argument("--directed-workers", type=int, default=DEFAULT_DIRECTED_WORKERS)
+    parser.add_argument("--blocks", type=int, default=DEFAULT_BLOCKS)
+    parser.add_argument("--block-size", type=int, default=DEFAULT_BLOCK_SIZE)
+    parser.add_argument("--drain-timeout", type=float, default=DEFAULT_DRAIN_TIMEOUT)
+    parser.add_argument("--config", default=None, help="JSON file of worker config overrides")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT)
+    args = parser.parse_args()
+
+    if args.replay:
+        command_stream = load_stream(args.replay, args.speed)
+    else:
+        command_stream = synthetic_stream(args.rate, args.duration, parse_mix(args.mix), args.blocks, args.poisson,
+                                          args.seed)
+    if args.save_stream:
+        save_stream(command_stream, args.save_stream)
+    config_overrides = None
+    if args.config:
+        config_stream = open(args.config, "r")
+        config_overrides = json.load(config_stream)
+        config_stream.close()
+
+    results = run(command_stream, args.workers, args.directed_workers, args.blocks, args.block_size,
+                  args.drain_timeout, config_overrides)
+    report = {"commit": benchmark.current_commit(),
+              "timestamp": time.time(),
+              "python": platform.python_version(),
+              "parameters": vars(args),
+              "results": results}
+    output_stream = open(args.output, "w")
+    json.dump(report, output_stream, indent=2, sort_keys=True)
+    output_stream.close()
+
+    print("{0}/{1} commands completed ({2} failed), {3:.1f} commands/second".format(
+        results["completed"], results["commands"], results["failed"], results["throughput_per_second"] or 0))
+    if results.get("harness_cpu_fraction", 0) > 0.8:
+        print("The stand-in servers used {0:.0%} of a CPU, so the harness may have limited throughput".format(
+            results["harness_cpu_fraction"]))
+    for name, stats in sorted(results["functions"].items()):
+        latency = stats["latency"]
+        if latency["count"]:
+            print("{0}: p50 {1:.3f}s p95 {2:.3f}s p99 {3:.3f}s max {4:.3f}s".format(
+                name, latency["p50_seconds"], latency["p95_seconds"], latency["p99_seconds"], latency["max_seconds"]))
+    print("Wrote load test results to {0}".format(args.output))
@@ -0,0 +1,115 @@
+# signs transactions in-process so geth doesn't have to unlock and sign every one
+import fcntl
+import json
+import os
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from eth_account import Account
+
+_signer = None
+_signer_lock = threading.Lock()
+
+# private key of the pool worker process, set by _init_worker
+_worker_key = None
+
+
+def _init_worker(private_key):
+    global _worker_key
+    _worker_key = private_key
+
+
+def _sign_in_worker(transaction):
+    return bytes(Account.signTransaction(transaction, _worker_key).rawTransaction)
+
+
+class LocalSigner:
+    """
+    Holds the decrypted key for config['keystore_file'] and hands out nonces
+    locally, so transactions can be signed here and sent with
+    eth_sendRawTransaction. The next nonce is kept in a file per account in
+    lock_dir, locked with flock, so every worker on the host draws from the
+    same counter.
+    """
+
+    def __init__(self, keystore_file, password, lock_dir=None):
+        keystore_stream = open(keystore_file, "r")
+        keystore = json.load(keystore_stream)
+        keystore_stream.close()
+        # scrypt makes this deliberately slow, which is why it only happens once
+        self.private_key = Account.decrypt(keystore, password)
+        self.address = Account.privateKeyToAccount(self.private_key).address
+        self.nonce_file = os.path.join(lock_dir or tempfile.gettempdir(), "erc20-nonce-" + self.address.lower())
+        # flock is per open file, so threads of one process still need their own lock
+        self.lock = threading.Lock()
+
+    def _locked_nonce(self, update):
+        with self.lock:
+            fd = os.open(self.nonce_file, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                stored = os.read(fd, 32).decode('ascii').strip()
+                nonce = update(int(stored) if stored else None)
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.ftruncate(fd, 0)
+                if nonce is not None:
+                    os.write(fd, str(nonce).encode('ascii'))
+            finally:
+                # closing releases the flock
+                os.close(fd)
+
+    def next_nonces(self, web3, count):
+        """
+        Reserves count consecutive nonces and returns the first. The node's
+        pending count is read every time, so the shared counter catches up
+        with transactions sent from elsewhere.
+        """
+        reserved = []
+
+        def reserve(stored):
+            pending = web3.eth.getTransactionCount(self.address, 'pending')
+            reserved.append(pending if stored is None or stored < pending else stored)
+            return reserved[0] + count
+
+        self._locked_nonce(reserve)
+        return reserved[0]
+
+    def next_nonce(self, web3):
+        return self.next_nonces(web3, 1)
+
+    def reset_nonce(self):
+        """
+        Forget the shared nonce so the next one is read from the node again,
+        e.g. after a transaction failed to build, sign or send and its nonce
+        was never used.
+        """
+        self._locked_nonce(lambda stored: None)
+
+    def sign(self, transaction):
+        return bytes(Account.signTransaction(transaction, self.private_key).rawTransaction)
+
+    def sign_many(self, transactions, processes=None):
+        """
+        Signs a batch of transactions across a process pool, returning the raw
+        transactions in the same order.
+        """
+        if len(transactions) < 2:
+            return [self.sign(each) for each in transactions]
+        with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker,
+                                 initargs=(self.private_key,)) as executor:
+            return list(executor.map(_sign_in_worker, transactions))
+
+
+def get_signer(config):
+    """
+    Returns the process-wide LocalSigner, or None when no keystore_file is
+    configured and transactions should be signed by the node instead.
+    """
+    global _signer
+    if not config.get("keystore_file"):
+        return None
+    with _signer_lock:
+        if _signer is None:
+            _signer = LocalSigner(config["keystore_file"], config["account_password"], config.get("nonce_lock_dir"))
+        return _signer
@@ -0,0 +1,106 @@
+# queue-based logging: callers only enqueue records, a background thread formats and writes them
+import atexit
+import json
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+# records waiting for the listener; once full, new records are dropped rather than blocking the caller
+DEFAULT_QUEUE_SIZE = 10000
+
+# attributes every LogRecord has, anything else on a record came from extra={...}
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+def record_fields(record):
+    """
+    Returns the structured fields passed to a log call with extra={...}.
+    """
+    return dict((key, value) for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES)
+
+
+class StructuredFormatter(logging.Formatter):
+    """
+    The usual text format followed by the record's structured fields as key=value pairs.
+    """
+
+    def format(self, record):
+        output = super().format(record)
+        fields = record_fields(record)
+        if fields:
+            output += " " + " ".join("{0}={1}".format(key, fields[key]) for key in sorted(fields))
+        return output
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    One JSON object per record, structured fields included, for log shippers.
+    """
+
+    def format(self, record):
+        output = {"time": record.created,
+                  "logger": record.name,
+                  "level": record.levelname,
+                  "message": record.getMessage()}
+        output.update(record_fields(record))
+        if record.exc_info:
+            output["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(output, default=str)
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    QueueHandler that leaves %-formatting to the listener thread and drops
+    records (counting them in self.dropped) instead of blocking when the
+    queue is full. Records are passed by reference, so log arguments should
+    not be mutated after the call.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def get_formatter(config=None):
+    """
+    JSONFormatter when config['log_format'] is "json", otherwise the repo's
+    usual text format with structured fields appended.
+    """
+    if config and config.get("log_format") == "json":
+        return JSONFormatter()
+    return StructuredFormatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+
+def setup_queue_logging(logger, queue_size=DEFAULT_QUEUE_SIZE):
+    """
+    Moves the logger's handlers behind a queue: the logger gets a single
+    NonBlockingQueueHandler and a QueueListener thread feeds the original
+    handlers, so file and console I/O no longer happen on the calling thread.
+    The listener is flushed and stopped at exit.
+
+    :return: the started QueueListener
+    """
+    handlers = list(logger.handlers)
+    for each in handlers:
+        logger.removeHandler(each)
+    log_queue = queue.Queue(queue_size)
+    logger.addHandler(NonBlockingQueueHandler(log_queue))
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(_stop_listener, listener)
+    return listener
+
+
+def _stop_listener(listener):
+    # stop() drains the queue, but fails if the listener was already stopped
+    if listener._thread is not None:
+        listener.stop()
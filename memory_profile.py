@@ -0,0 +1,172 @@
+# opt-in memory instrumentation for long-running loops: tracemalloc diffs, object counts and watched structure sizes
+import atexit
+import gc
+import json
+import os
+import signal
+import threading
+import time
+import tracemalloc
+
+DEFAULT_INTERVAL = 300
+# frames kept per allocation; more show where sites are called from but make tracing slower
+DEFAULT_FRAMES = 1
+TOP_SITES = 20
+TRACKED_TYPES = ("BlockData", "TransactionData")
+# kill -USR1 <pid> writes a report straight away
+DUMP_SIGNAL = signal.SIGUSR1
+# allocations made by the profiler itself
+IGNORED_FILES = (tracemalloc.__file__, "<frozen importlib._bootstrap>", "<frozen importlib._bootstrap_external>",
+                 "<unknown>")
+
+_profiler = None
+
+
+def _rss_bytes():
+    try:
+        statm = open("/proc/self/statm", "r")
+        resident = int(statm.read().split()[1])
+        statm.close()
+    except (OSError, ValueError, IndexError):
+        return None
+    return resident * os.sysconf("SC_PAGE_SIZE")
+
+
+def object_counts(type_names=TRACKED_TYPES):
+    """
+    Live instances of each named class, found by walking the gc's objects.
+    """
+    counts = dict.fromkeys(type_names, 0)
+    for each in gc.get_objects():
+        name = type(each).__name__
+        if name in counts:
+            counts[name] += 1
+    return counts
+
+
+def _sites(statistics):
+    output = []
+    for stat in statistics[:TOP_SITES]:
+        frame = stat.traceback[0]
+        site = {"site": "{0}:{1}".format(frame.filename, frame.lineno),
+                "size": stat.size,
+                "size_diff": stat.size_diff,
+                "count": stat.count,
+                "count_diff": stat.count_diff}
+        if len(stat.traceback) > 1:
+            site["traceback"] = stat.traceback.format()
+        output.append(site)
+    return output
+
+
+class MemoryProfiler:
+    """
+    Every interval seconds (or on DUMP_SIGNAL) appends a JSON line to filename
+    with traced and resident memory, the allocation sites that grew most since
+    the previous report and since the first one, live BlockData/TransactionData
+    counts and the sizes of watched structures.
+    """
+
+    def __init__(self, filename, interval=DEFAULT_INTERVAL, frames=DEFAULT_FRAMES, logger=None):
+        self.filename = filename
+        self.interval = interval
+        self.frames = frames
+        self.logger = logger
+        # name -> callable returning a size, e.g. len() of a list that may leak
+        self.watched = {}
+        self.baseline = None
+        self.previous = None
+        self.reports = 0
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def watch(self, name, size):
+        self.watched[name] = size
+        return self
+
+    def _snapshot(self):
+        snapshot = tracemalloc.take_snapshot()
+        return snapshot.filter_traces([tracemalloc.Filter(False, filename) for filename in IGNORED_FILES])
+
+    def report(self, reason="interval"):
+        with self.lock:
+            snapshot = self._snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            output = {"time": time.time(),
+                      "pid": os.getpid(),
+                      "reason": reason,
+                      "traced_bytes": current,
+                      "traced_peak_bytes": peak,
+                      "rss_bytes": _rss_bytes(),
+                      "objects": object_counts(),
+                      "watched": {}}
+            for name, size in self.watched.items():
+                try:
+                    output["watched"][name] = size()
+                except Exception as err:
+                    output["watched"][name] = repr(err)
+            if self.previous is not None:
+                output["top_growth"] = _sites(snapshot.compare_to(self.previous, "lineno"))
+                output["top_growth_since_start"] = _sites(snapshot.compare_to(self.baseline, "lineno"))
+            else:
+                self.baseline = snapshot
+                # compared with itself so the first report has the same fields, with zero diffs
+                output["top_sites"] = _sites(snapshot.compare_to(snapshot, "lineno"))
+            self.previous = snapshot
+            output_stream = open(self.filename, "a")
+            output_stream.write(json.dumps(output) + "\n")
+            output_stream.close()
+            self.reports += 1
+        if self.logger:
+            self.logger.info("Memory report %s: %s bytes traced, %s resident, objects %s",
+                             self.reports, current, output["rss_bytes"], output["objects"])
+        return output
+
+    def _on_signal(self, signum, frame):
+        # only wake the profiler thread, a snapshot is too much work for a signal handler
+        self.wake.set()
+
+    def run(self):
+        while True:
+            self.wake.wait(self.interval)
+            reason = "signal" if self.wake.is_set() else "interval"
+            self.wake.clear()
+            if self.stopped.is_set():
+                return
+            try:
+                self.report(reason)
+            except Exception as err:
+                if self.logger:
+                    self.logger.error("Memory report failed: %s", err)
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(DUMP_SIGNAL, self._on_signal)
+        self.thread = threading.Thread(target=self.run, name="memory-profile", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        self.wake.set()
+        if self.thread:
+            self.thread.join()
+        self.report("exit")
+        tracemalloc.stop()
+
+
+def enable(filename, interval=DEFAULT_INTERVAL, frames=DEFAULT_FRAMES, logger=None):
+    """
+    Starts tracemalloc and the periodic reports for the process; a last report is written at exit.
+    """
+    global _profiler
+    _profiler = MemoryProfiler(filename, interval, frames, logger).start()
+    atexit.register(_profiler.stop)
+    return _profiler
+
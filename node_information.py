@@ -1,10 +1,18 @@
 # singleton which monitors the status of the node
 
+import call_cache
 import ipc_socket
+import log_pipeline
+import node_pool
+import node_snapshot
+import rate_limiter
+import rpc_cache
 import rpc_interface
+import rpc_metrics
 import util
 import logging
 import json
+import time
 
 
 class TransactionData:
@@ -26,7 +34,7 @@ class TransactionData:
             self.to_address = to_address
             self.wei_value = wei_value
 
-    def __str__(self):
+    def to_dict(self):
         output = dict()
         output["from"] = self.from_address
         output["gas"] = self.gas
@@ -34,7 +42,16 @@ class TransactionData:
         output["hash"] = self.tx_hash
         output["to"] = self.to_address
         output["value"] = self.wei_value
-        return json.dumps(output)
+        return output
+
+    def touches(self, addresses):
+        """
+        True if the transaction is from or to one of the given lowercase addresses.
+        """
+        return (self.from_address or "").lower() in addresses or (self.to_address or "").lower() in addresses
+
+    def __str__(self):
+        return json.dumps(self.to_dict())
 
 
 class BlockData:
@@ -51,6 +68,9 @@ class BlockData:
             self.tx_count = block_data["tx_count"]
             self.transactions = []
             for each_tx in block_data["transactions"]:
+                # str() nests each transaction as a JSON string, to_dict() as an object
+                if type(each_tx) == dict:
+                    each_tx = json.dumps(each_tx)
                 self.transactions.append(TransactionData(json_data=each_tx))
         else:
             self.block_number = block_number
@@ -62,12 +82,8 @@ class BlockData:
             self.tx_count = tx_count
             self.transactions = []
 
-    def __str__(self):
-        tr_strings = []
-        for each_tx in self.transactions:
-            tr_strings.append(str(each_tx))
+    def _header_dict(self):
         output = dict()
-        output["transactions"] = tr_strings
         output["block_number"] = self.block_number
         output["block_hash"] = self.block_hash
         output["block_timestamp"] = self.block_timestamp
@@ -75,24 +91,70 @@ class BlockData:
         output["gas_limit"] = self.gas_limit
         output["block_size"] = self.block_size
         output["tx_count"] = self.tx_count
+        return output
+
+    def to_dict(self):
+        """
+        The block with its transactions as nested objects, for uploads that
+        don't need the legacy JSON-string-per-transaction format of str().
+        """
+        output = dict()
+        output["transactions"] = [each_tx.to_dict() for each_tx in self.transactions]
+        output.update(self._header_dict())
+        return output
+
+    def filtered(self, addresses):
+        """
+        Returns a copy holding only the transactions from or to one of addresses.
+        tx_count still gives the full block's count.
+        """
+        addresses = set(address.lower() for address in addresses)
+        output = BlockData(self.block_number, self.block_hash, self.block_timestamp, self.gas_used,
+                           self.gas_limit, self.block_size, self.tx_count)
+        output.transactions = [each_tx for each_tx in self.transactions if each_tx.touches(addresses)]
+        return output
+
+    def __str__(self):
+        tr_strings = []
+        for each_tx in self.transactions:
+            tr_strings.append(str(each_tx))
+        output = dict()
+        output["transactions"] = tr_strings
+        output.update(self._header_dict())
         return json.dumps(output)
 
 
+# JSON-RPC "limit exceeded" (EIP-1474), returned for calls dropped by admission control
+ADMISSION_REJECTED_CODE = -32005
+
+# used when NodeInfo is created without a logger
+DEFAULT_LOGGER = logging.getLogger("NodeInformation")
+
 UNIT_TESTING = False
 if UNIT_TESTING:
     import ipc_test_harness
 
 
 class NodeInfo:
-    def __init__(self, logger):
+    def __init__(self, logger, config=None, priority=rate_limiter.PRIORITY_LIVE):
         # Global config
-        self.config = util.load_config_from_file()
+        if config:
+            self.config = config
+        else:
+            self.config = util.load_config_from_file()
         if UNIT_TESTING:
-            if logger:
-                logger.warn("UNIT_TESTING is enabled. Kill process immediately if not in test environment!")
-            else:
-                print("UNIT_TESTING is enabled. Kill process immediately if not in test environment!")
+            (logger or DEFAULT_LOGGER).warning("UNIT_TESTING is enabled. Kill process immediately if not in "
+                                               "test environment!")
         self.rpc_interface = rpc_interface.RPCInterface()
+        # class used to carry each request to the node, swapped out for the harness in tests/benchmarks
+        self.node_pool = None
+        if UNIT_TESTING:
+            self.transport = ipc_test_harness.IPCTestHarness
+        elif self.config and self.config.get("nodes"):
+            self.node_pool = node_pool.NodePool(self.config, logger)
+            self.transport = self.node_pool.interface
+        else:
+            self.transport = ipc_socket.GethInterface
         self.logger = logger
         self.enode = None
         self.name = None
@@ -101,80 +163,253 @@ class NodeInfo:
         # will at least tell us if it's connected to a test harness!
         self.total_rpc_calls = 0
         self.total_rpc_delay = 0
+        # per-method latency histograms and transport counters
+        self.metrics = rpc_metrics.RPCMetrics()
+        # coalesces identical reads and caches them per method, shared by every NodeInfo in the process
+        self.rpc_cache = rpc_cache.get_shared_cache(self.config)
+        # admission control shared by every NodeInfo in the process; priority is this one's class
+        self.limiter = rate_limiter.get_limiter(self.config)
+        self.priority = priority
+        # eth_call results for the current head are dropped as heads are reported to it
+        self.call_cache = call_cache.get_call_cache(self.config)
         self.gas_price = None
         self.synced = False
         self.blocks_behind = 0
         self.balance = 0
+        self.balance_wei = 0
         self.peers = []
         self.latest_block = None
+        # set by start_head_subscription(); while connected, update() is a no-op
+        self.subscription = None
+        self.head_updates = 0
+        self.last_head_received = None
+        # rolling history of status samples, set by the process that refreshes the status (node_snapshot.py)
+        self.history = None
+        # status published by a node_snapshot refresher, read instead of polling geth when fresh
+        self.snapshot = node_snapshot.get_reader(self.config)
 
     def get_block_data(self, block_number):
-        result = self._eth_syncing()
-        if result and self.synced:
+        if self._check_synced():
             return self._getBlockData(block_number)
 
     def update(self):
+        """
+        Refreshes the node status, from the shared snapshot when one is fresh.
+        Returns False if the node could not be reached.
+        """
+        if self.snapshot and self._load_snapshot():
+            self._record_history()
+            return True
+        if self.subscription and self.subscription.connected.is_set():
+            # state is kept current by newHeads notifications, which record their own samples
+            return True
         result = self._eth_syncing()
         if result and self.synced:
             self._eth_gasPrice()
             self._admin_peers()
             self._getLatestBlock()
             self._getBalance()
+        if result:
+            self._record_history()
+        return bool(result)
+
+    def _record_history(self):
+        if self.history:
+            self.history.record(self)
+
+    def _check_synced(self):
+        """
+        True if the node is synchronized, going by the shared snapshot when
+        one is fresh and asking geth otherwise.
+        """
+        if not (self.snapshot and self._load_snapshot()):
+            if not self._eth_syncing():
+                return False
+        return self.synced
+
+    def snapshot_payload(self):
+        return {"synced": self.synced,
+                "blocks_behind": self.blocks_behind,
+                "gas_price": self.gas_price,
+                "balance_wei": self.balance_wei,
+                "peers": self.peers,
+                "latest_block": self.latest_block,
+                "enode": self.enode,
+                "name": self.name,
+                "eth_node_id": self.eth_node_id}
+
+    def _load_snapshot(self):
+        payload = self.snapshot.read()
+        if payload is None:
+            return False
+        self.load_payload(payload)
+        return True
+
+    def load_payload(self, payload):
+        """
+        Takes on the status from a snapshot_payload(), e.g. one published by a
+        node_snapshot refresher or saved by the previous run of a worker.
+        """
+        self.synced = payload["synced"]
+        self.blocks_behind = payload["blocks_behind"]
+        self.gas_price = payload["gas_price"]
+        self.balance_wei = payload["balance_wei"]
+        self.balance = util.wei_to_ether(self.balance_wei)
+        self.peers = payload["peers"]
+        self.latest_block = payload["latest_block"]
+        if self.latest_block:
+            self._head_seen(self.latest_block)
+        self.enode = payload["enode"]
+        self.name = payload["name"]
+        self.eth_node_id = payload["eth_node_id"]
+
+    def start_head_subscription(self, log_filter=None, log_callback=None):
+        """
+        Switches NodeInfo to push mode: subscribes to newHeads over IPC and only
+        refreshes the other fields when a new head arrives. update() falls back
+        to polling whenever the subscription connection is down.
+
+        :param log_filter: optional eth_subscribe logs filter, e.g. {"address": contract_address}
+        :param log_callback: called with each matching log object
+        """
+        self.subscription = ipc_socket.GethSubscription(self.config, self.logger)
+        self.subscription.subscribe(["newHeads"], self._on_new_head)
+        if log_filter is not None and log_callback:
+            self.subscription.subscribe(["logs", log_filter], log_callback)
+        self.subscription.start()
+        return self.subscription
+
+    def stop_head_subscription(self):
+        if self.subscription:
+            self.subscription.stop()
+            self.subscription = None
+
+    def _on_new_head(self, header):
+        self.head_updates += 1
+        self.last_head_received = time.time()
+        latest_block = {'gas_limit': util.hex_to_dec(header["gasLimit"]),
+                        'gas_used': util.hex_to_dec(header["gasUsed"]),
+                        'hash': header["hash"],
+                        'number': util.hex_to_dec(header["number"]),
+                        'size': util.hex_to_dec(header["size"]) if header.get("size") else None,
+                        'timestamp': util.hex_to_dec(header["timestamp"]),
+                        'transaction_count': None}
+        self.latest_block = latest_block
+        self._head_seen(latest_block)
+        result = self._eth_syncing()
+        if result and self.synced:
+            self._getBlockTransactionCount(latest_block)
+            self._eth_gasPrice()
+            self._admin_peers()
+            self._getBalance()
+        self._record_history()
 
     @property
     def output_request(self):
         output = {"synchronized": self.synced,
                   "peers": len(self.peers),
                   "gas_price": self.gas_price,
-                  "balance": self.balance,
+                  "balance": float(self.balance),
+                  "balance_wei": self.balance_wei,
                   "blocks_behind": self.blocks_behind}
         if self.latest_block:
             for each in self.latest_block.keys():
                 output["latest_block_" + each] = self.latest_block[each]
         return output
 
-    def _admin_node_info(self):
-        request_data = self.rpc_interface.get_node_info()
-        if UNIT_TESTING:
-            ipc = ipc_test_harness.IPCTestHarness(request_data, self.config)
-        else:
-            ipc = ipc_socket.GethInterface(request_data, self.config)
-        response_stream = ipc.send()
+    def _head_seen(self, latest_block):
+        self.rpc_cache.new_head(latest_block["number"])
+        self.call_cache.new_head(latest_block["number"], latest_block["hash"])
+
+    def _log_info(self, message, *args, **fields):
+        """
+        Formats lazily, so nothing is built when INFO is disabled. Keyword
+        arguments are attached to the record as structured fields.
+        """
+        logger = self.logger or DEFAULT_LOGGER
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(message, *args, extra=fields)
+
+    def _log_error(self, message, *args, **fields):
+        (self.logger or DEFAULT_LOGGER).error(message, *args, extra=fields)
+
+    def _send_request(self, method, request_data):
+        """
+        Returns the processed response for a prepared request, from the shared
+        RPC cache when possible and otherwise from the node.
+        """
+        request_obj = json.loads(request_data)
+        cached_response, outcome = self.rpc_cache.fetch(method, request_obj.get("params"),
+                                                        lambda: self._send_to_node(method, request_data,
+                                                                                   request_obj))
+        self.metrics.count(method, rpc_cache.OUTCOME_COUNTERS[outcome])
+        if outcome in ("miss", "uncached"):
+            return cached_response
+        if type(cached_response) != dict:
+            # the load this call shared failed, so fail the same way
+            self.rpc_interface.forget_request(request_obj["id"])
+            return cached_response
+        # answer the outstanding request with the shared response
+        response_stream = dict(cached_response)
+        response_stream["id"] = request_obj["id"]
+        return self.rpc_interface.process_response(response_stream)
+
+    def _send_to_node(self, method, request_data, request_obj):
+        queued = self.limiter.acquire(method, request_obj.get("params"), self.priority)
+        if queued is None:
+            self.metrics.count(method, "rejected")
+            # answer the outstanding request locally rather than leaving it behind
+            return self.rpc_interface.process_response({"jsonrpc": "2.0", "id": request_obj["id"],
+                                                        "error": {"code": ADMISSION_REJECTED_CODE,
+                                                                  "message": "admission queue timeout"}})
+        try:
+            ipc = self.transport(request_data, self.config, self.logger)
+            start = time.time()
+            response_stream = ipc.send()
+        finally:
+            self.limiter.release()
+        if ipc.response_data is not None:
+            response_stream = ipc.response_data
         response_data = self.rpc_interface.process_response(response_stream)
+        if type(response_data) != dict:
+            # nothing came back to answer the request with
+            self.rpc_interface.forget_request(request_obj["id"])
 
+        if type(response_data) == dict and "delay" in response_data:
+            # the request was created before it queued for admission
+            delay = response_data["delay"] - queued
+        else:
+            delay = time.time() - start
+        error = type(response_data) != dict or "result" not in response_data
+        self.metrics.observe(method, delay, error=error, timeouts=ipc.timeouts, retries=ipc.retries,
+                             bytes_sent=ipc.bytes_sent, bytes_received=ipc.bytes_received,
+                             parse_seconds=ipc.parse_time, queue_seconds=queued)
         if type(response_data) == dict:
-            self.total_rpc_delay += response_data["delay"]
+            self.total_rpc_delay += delay
             self.total_rpc_calls += 1
+        return response_data
+
+    def _admin_node_info(self):
+        request_data = self.rpc_interface.get_node_info()
+        response_data = self._send_request("admin_nodeInfo", request_data)
+
+        if type(response_data) == dict:
             if "result" in response_data:
                 result_data = response_data["result"]
                 self.enode = result_data["enode"]
                 self.name = result_data["name"]
                 self.eth_node_id = result_data["id"]
-                message = "Successful admin_nodeInfo IPC call: " + str(response_data["delay"]) + " seconds"
-                if self.logger:
-                    self.logger.info(message)
-                else:
-                    print(message)
+                self._log_info("Successful admin_nodeInfo IPC call: %s seconds", response_data["delay"],
+                               rpc_method="admin_nodeInfo", rpc_delay=response_data["delay"])
                 return True
-        message = "admin_nodeInfo API call failed."
-        if self.logger:
-            self.logger.error(message)
-        else:
-            print(message)
+        self._log_error("admin_nodeInfo API call failed.", rpc_method="admin_nodeInfo")
         return False
 
     def _admin_peers(self):
         request_data = self.rpc_interface.get_peers()
-        if UNIT_TESTING:
-            ipc = ipc_test_harness.IPCTestHarness(request_data, self.config)
-        else:
-            ipc = ipc_socket.GethInterface(request_data, self.config)
-        response_stream = ipc.send()
-        response_data = self.rpc_interface.process_response(response_stream)
+        response_data = self._send_request("admin_peers", request_data)
 
         if type(response_data) == dict:
-            self.total_rpc_delay += response_data["delay"]
-            self.total_rpc_calls += 1
             if "result" in response_data:
                 result_data = response_data["result"]
                 self.peers = []
@@ -183,68 +418,36 @@ class NodeInfo:
                                            caps=each["caps"],
                                            id=each["id"],
                                            network=each["network"]))
-                message = "Successful admin_Peers IPC call: " + str(response_data["delay"]) + " seconds"
-                message += "(" + str(len(self.peers)) + " peers)"
-                if self.logger:
-                    self.logger.info(message)
-                else:
-                    print(message)
+                self._log_info("Successful admin_Peers IPC call: %s seconds (%d peers)", response_data["delay"],
+                               len(self.peers), rpc_method="admin_peers", rpc_delay=response_data["delay"])
                 return True
-        message = "admin_peers IPC call failed."
-        if self.logger:
-            self.logger.error(message)
-        else:
-            print(message)
+        self._log_error("admin_peers IPC call failed.", rpc_method="admin_peers")
         return False
 
     def _eth_gasPrice(self):
         request_data = self.rpc_interface.eth_gas_price()
-        if UNIT_TESTING:
-            ipc = ipc_test_harness.IPCTestHarness(request_data, self.config)
-        else:
-            ipc = ipc_socket.GethInterface(request_data, self.config)
-        response_stream = ipc.send()
-        response_data = self.rpc_interface.process_response(response_stream)
+        response_data = self._send_request("eth_gasPrice", request_data)
 
         if type(response_data) == dict:
-            self.total_rpc_delay += response_data["delay"]
-            self.total_rpc_calls += 1
             if "result" in response_data:
                 gas_price = util.hex_to_dec(response_data["result"])
                 self.gas_price = gas_price
-                message = "Successful eth_gasPrice IPC call: " + str(response_data["delay"]) + " seconds"
-                if self.logger:
-                    self.logger.info(message)
-                else:
-                    print(message)
+                self._log_info("Successful eth_gasPrice IPC call: %s seconds", response_data["delay"],
+                               rpc_method="eth_gasPrice", rpc_delay=response_data["delay"])
                 return True
-        message = "eth_gasPrice IPC call failed."
-        if self.logger:
-            self.logger.error(message)
-        else:
-            print(message)
+        self._log_error("eth_gasPrice IPC call failed.", rpc_method="eth_gasPrice")
         return False
 
     def _getBlockData(self, block_number):
         request_data = self.rpc_interface.get_block_transactions(block_number)
-        if UNIT_TESTING:
-            ipc = ipc_test_harness.IPCTestHarness(request_data, self.config)
-        else:
-            ipc = ipc_socket.GethInterface(request_data, self.config)
-        response_stream = ipc.send()
-        response_data = self.rpc_interface.process_response(response_stream)
+        response_data = self._send_request("eth_getBlockByNumber", request_data)
 
         if type(response_data) == dict:
-            self.total_rpc_delay += response_data["delay"]
-            self.total_rpc_calls += 1
             if "result" in response_data:
                 result_data = response_data["result"]
                 if result_data is None:
-                    message = "getBlockByNumber API call: block still pending"
-                    if self.logger:
-                        self.logger.error(message)
-                    else:
-                        print(message)
+                    self._log_error("getBlockByNumber API call: block still pending",
+                                    rpc_method="eth_getBlockByNumber")
                     return None
                 block_data = BlockData(util.hex_to_dec(result_data["number"]),
                                        result_data["hash"],
@@ -254,39 +457,23 @@ class NodeInfo:
                                        util.hex_to_dec(result_data["size"]),
                                        len(result_data["transactions"]))
 
-                for each_transaction in result_data["transactions"]:
-                    new_obj = TransactionData(each_transaction["from"],
-                                              util.hex_to_dec(each_transaction["gas"]),
-                                              util.hex_to_dec(each_transaction["gasPrice"]),
-                                              each_transaction["hash"],
-                                              each_transaction["to"],
-                                              util.hex_to_dec(each_transaction["value"]))
-                    block_data.transactions.append(new_obj)
-                message = "Successful getBlockByNumber IPC call: " + str(response_data["delay"]) + " seconds"
-                if self.logger:
-                    self.logger.info(message)
-                else:
-                    print(message)
+                transactions = result_data["transactions"]
+                columns = util.hex_columns(transactions, ("gas", "gasPrice", "value"))
+                block_data.transactions = [TransactionData(each_transaction["from"], gas, gas_price,
+                                                           each_transaction["hash"], each_transaction["to"], value)
+                                           for each_transaction, gas, gas_price, value in
+                                           zip(transactions, columns["gas"], columns["gasPrice"], columns["value"])]
+                self._log_info("Successful getBlockByNumber IPC call: %s seconds", response_data["delay"],
+                               rpc_method="eth_getBlockByNumber", rpc_delay=response_data["delay"])
                 return block_data
-        message = "getBlockByNumber API call failed."
-        if self.logger:
-            self.logger.error(message)
-        else:
-            print(message)
+        self._log_error("getBlockByNumber API call failed.", rpc_method="eth_getBlockByNumber")
         return None
 
     def _getLatestBlock(self):
         request_data = self.rpc_interface.get_latest_block()
-        if UNIT_TESTING:
-            ipc = ipc_test_harness.IPCTestHarness(request_data, self.config)
-        else:
-            ipc = ipc_socket.GethInterface(request_data, self.config)
-        response_stream = ipc.send()
-        response_data = self.rpc_interface.process_response(response_stream)
+        response_data = self._send_request("eth_getBlockByNumber", request_data)
 
         if type(response_data) == dict:
-            self.total_rpc_delay += response_data["delay"]
-            self.total_rpc_calls += 1
             if "result" in response_data:
                 result_data = response_data["result"]
                 self.latest_block = {'gas_limit': util.hex_to_dec(result_data["gasLimit"]),
@@ -295,80 +482,57 @@ class NodeInfo:
                                      'size': util.hex_to_dec(result_data["size"]),
                                      'timestamp': util.hex_to_dec(result_data["timestamp"]),
                                      'transaction_count': len(result_data["transactions"])}
-                message = "Successful getBlockByNumber IPC call: " + str(response_data["delay"]) + " seconds"
-                if self.logger:
-                    self.logger.info(message)
-                else:
-                    print(message)
+                self._head_seen(self.latest_block)
+                self._log_info("Successful getBlockByNumber IPC call: %s seconds", response_data["delay"],
+                               rpc_method="eth_getBlockByNumber", rpc_delay=response_data["delay"])
                 return True
-        message = "getBlockByNumber API call failed."
-        if self.logger:
-            self.logger.error(message)
-        else:
-            print(message)
+        self._log_error("getBlockByNumber API call failed.", rpc_method="eth_getBlockByNumber")
+        return False
+
+    def _getBlockTransactionCount(self, latest_block):
+        # newHeads headers carry no transaction list, so the count is fetched separately
+        request_data = self.rpc_interface.get_block_transaction_count(latest_block["hash"])
+        response_data = self._send_request("eth_getBlockTransactionCountByHash", request_data)
+
+        if type(response_data) == dict:
+            if "result" in response_data and response_data["result"]:
+                latest_block["transaction_count"] = util.hex_to_dec(response_data["result"])
+                self._log_info("Successful eth_getBlockTransactionCountByHash IPC call: %s seconds",
+                               response_data["delay"],
+                               rpc_method="eth_getBlockTransactionCountByHash", rpc_delay=response_data["delay"])
+                return True
+        self._log_error("eth_getBlockTransactionCountByHash IPC call failed.",
+                        rpc_method="eth_getBlockTransactionCountByHash")
         return False
 
     def _getBalance(self):
         request_data = self.rpc_interface.get_balance(self.config["account"])
-        if UNIT_TESTING:
-            ipc = ipc_test_harness.IPCTestHarness(request_data, self.config)
-        else:
-            ipc = ipc_socket.GethInterface(request_data, self.config)
-        response_stream = ipc.send()
-        response_data = self.rpc_interface.process_response(response_stream)
+        response_data = self._send_request("eth_getBalance", request_data)
 
         if type(response_data) == dict:
-            self.total_rpc_delay = response_data["delay"]
-            self.total_rpc_calls += 1
             if "result" in response_data:
-                message = "Successful eth_getBalance IPC call: " + str(response_data["delay"]) + " seconds"
-                if self.logger:
-                    self.logger.info(message)
-                else:
-                    print(message)
-                self.balance = util.wei_to_ether(util.hex_to_dec(response_data["result"]))
+                self._log_info("Successful eth_getBalance IPC call: %s seconds", response_data["delay"],
+                               rpc_method="eth_getBalance", rpc_delay=response_data["delay"])
+                self.balance_wei = util.hex_to_dec(response_data["result"])
+                self.balance = util.wei_to_ether(self.balance_wei)
                 return True
-        message = "eth_getBalance API call failed."
-        if self.logger:
-            self.logger.error(message)
-        else:
-            print(message)
+        self._log_error("eth_getBalance API call failed.", rpc_method="eth_getBalance")
         return False
 
     def _eth_syncing(self):
         request_data = self.rpc_interface.check_sync()
-        if UNIT_TESTING:
-            ipc = ipc_test_harness.IPCTestHarness(request_data, self.config)
-        else:
-            ipc = ipc_socket.GethInterface(request_data, self.config)
-        response_stream = ipc.send()
-        response_data = self.rpc_interface.process_response(response_stream)
+        response_data = self._send_request("eth_syncing", request_data)
 
         if type(response_data) == dict:
-            self.total_rpc_delay += response_data["delay"]
-            self.total_rpc_calls += 1
             if "result" in response_data:
                 syncing = response_data["result"]
-                if type(syncing) == dict:
-                    highest_block = util.hex_to_dec(syncing["highestBlock"])
-                    current_block = util.hex_to_dec(syncing["currentBlock"])
-                    self.synced = False
-                    self.blocks_behind = highest_block - current_block
-                else:
-                    self.synced = True
-                    self.blocks_behind = 0
-                message = "Successful eth_syncing API call: " + str(response_data["delay"]) + " seconds"
-                if self.logger:
-                    self.logger.info(message)
-                else:
-                    print(message)
+                self.synced = type(syncing) != dict
+                self.blocks_behind = util.blocks_behind(syncing)
+                self._log_info("Successful eth_syncing API call: %s seconds", response_data["delay"],
+                               rpc_method="eth_syncing", rpc_delay=response_data["delay"])
                 return True
         else:
-            message = "eth_syncing API called failed."
-            if self.logger:
-                self.logger.error(message)
-            else:
-                print(message)
+            self._log_error("eth_syncing API called failed.", rpc_method="eth_syncing")
             return False
 
 
@@ -378,10 +542,11 @@ if __name__ == "__main__":
     ch = logging.StreamHandler()
     ch.setLevel(logging.INFO)
     # create formatter and add it to the handlers
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    formatter = log_pipeline.get_formatter()
     ch.setFormatter(formatter)
-    # add the handlers to the logger
+    # add the handlers to the logger, written from a background thread
     logger.addHandler(ch)
+    log_pipeline.setup_queue_logging(logger)
 
     node_info = NodeInfo(logger)
     block_data = node_info.get_block_data(7102577)
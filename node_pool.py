@@ -0,0 +1,231 @@
+# routes node RPC traffic across several geth endpoints
+import json
+import logging
+import threading
+import time
+
+import ipc_socket
+import util
+
+# reads can be answered by any synced node; these need the node holding the account
+WRITE_METHODS = ("eth_sendTransaction", "personal_unlockAccount", "personal_sendTransaction")
+# these describe the node that answers, so they go to the primary and fail there rather than fail over
+NODE_METHODS = ("admin_nodeInfo", "admin_peers")
+# these prefer the primary but may fail over (signed transactions are valid on any node)
+PRIMARY_METHODS = ("eth_sendRawTransaction", "eth_syncing")
+
+# weight of the newest sample in the rolling latency average
+LATENCY_ALPHA = 0.2
+DEFAULT_MAX_BLOCKS_BEHIND = 5
+DEFAULT_REFRESH_INTERVAL = 15
+# how long a failed endpoint sits out before it's tried again
+FAILURE_BACKOFF = 30
+# the background sync check makes one try per endpoint with this timeout
+PROBE_TIMEOUT = 1
+DEFAULT_LOGGER = logging.getLogger("NodePool")
+
+
+class NodeEndpoint:
+    def __init__(self, address, kind="ipc", primary=False):
+        if kind not in ("ipc", "http"):
+            raise ValueError("Unsupported node endpoint type: {0}".format(kind))
+        self.address = address
+        self.kind = kind
+        self.primary = primary
+        self.latency = None
+        self.blocks_behind = None
+        self.failures = 0
+        self.failed_at = None
+        self.calls = 0
+
+    @property
+    def healthy(self):
+        return self.failed_at is None or time.time() - self.failed_at > FAILURE_BACKOFF
+
+    def transport_config(self, config):
+        endpoint_config = dict(config)
+        if self.kind == "ipc":
+            endpoint_config["ipc_address"] = self.address
+        else:
+            endpoint_config["http_address"] = self.address
+        return endpoint_config
+
+    def transport(self, request_data, config, logger=None):
+        if self.kind == "ipc":
+            return ipc_socket.GethInterface(request_data, self.transport_config(config), logger)
+        return ipc_socket.GethHTTPInterface(request_data, self.transport_config(config), logger)
+
+    # callers hold the pool's lock, every thread sending through the pool records here
+    def record_success(self, delay):
+        self.calls += 1
+        self.failed_at = None
+        if self.latency is None:
+            self.latency = delay
+        else:
+            self.latency = LATENCY_ALPHA * delay + (1 - LATENCY_ALPHA) * self.latency
+
+    def record_failure(self):
+        self.failures += 1
+        self.failed_at = time.time()
+
+    def status(self):
+        return {"address": self.address,
+                "type": self.kind,
+                "primary": self.primary,
+                "healthy": self.healthy,
+                "latency": self.latency,
+                "blocks_behind": self.blocks_behind,
+                "calls": self.calls,
+                "failures": self.failures}
+
+
+class NodePool:
+    """
+    Several geth endpoints behind one transport. Reads go to the fastest synced
+    node, writes and node identity queries to the primary only, and any other
+    call fails over to the next candidate when a node errors out. Once the
+    pool is in use, a background thread re-checks the sync status of every
+    endpoint each refresh_interval (unless there is only one).
+
+    config['nodes'] is a list like [{"address": "/path/geth.ipc", "type": "ipc", "primary": true},
+    {"address": "http://10.0.0.9:8545", "type": "http"}]; without it the pool
+    wraps the single config['ipc_address'].
+    """
+
+    def __init__(self, config, logger=None):
+        self.config = config
+        self.logger = logger or DEFAULT_LOGGER
+        self.max_blocks_behind = config.get("max_blocks_behind", DEFAULT_MAX_BLOCKS_BEHIND)
+        self.refresh_interval = config.get("node_refresh_interval", DEFAULT_REFRESH_INTERVAL)
+        self.endpoints = []
+        for each in config.get("nodes") or [{"address": config["ipc_address"], "type": "ipc", "primary": True}]:
+            self.endpoints.append(NodeEndpoint(each["address"], each.get("type", "ipc"), each.get("primary", False)))
+        if not [each for each in self.endpoints if each.primary]:
+            self.endpoints[0].primary = True
+        self.last_refresh = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        # started by the first candidates() call, so a pool built just to find the primary has no thread
+        self.thread = None
+
+    def log_error(self, message):
+        self.logger.error(message)
+
+    @property
+    def primary(self):
+        for each in self.endpoints:
+            if each.primary:
+                return each
+
+    def refresh(self):
+        """
+        Polls eth_syncing once on every endpoint that isn't backing off, then
+        updates their blocks_behind and latency together.
+        """
+        probe_config = dict(self.config, max_rpc_tries=1, rpc_timeout=PROBE_TIMEOUT)
+        results = []
+        for endpoint in [each for each in self.endpoints if each.healthy]:
+            ipc = endpoint.transport(json.dumps({"jsonrpc": "2.0", "id": 1, "method": "eth_syncing", "params": []}),
+                                     probe_config, self.logger)
+            start = time.time()
+            try:
+                ipc.send()
+            except OSError as err:
+                self.log_error("Node {0} unreachable: {1}".format(endpoint.address, err))
+                ipc.response_data = None
+            results.append((endpoint, ipc.response_data, time.time() - start))
+        with self.lock:
+            for endpoint, response_data, delay in results:
+                if type(response_data) == dict and "result" in response_data:
+                    endpoint.blocks_behind = util.blocks_behind(response_data["result"])
+                    endpoint.record_success(delay)
+                else:
+                    endpoint.record_failure()
+            self.last_refresh = time.time()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.refresh()
+            except Exception as err:
+                self.log_error("Node refresh failed: {0}".format(err))
+            self.stopped.wait(self.refresh_interval)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="node-pool-refresh", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+
+    def candidates(self, method):
+        """
+        Endpoints to try for a method, best first, going by the last refresh.
+        """
+        if self.thread is None and len(self.endpoints) > 1:
+            with self.lock:
+                if self.thread is None:
+                    self.start()
+        primary = self.primary
+        if method in WRITE_METHODS or method in NODE_METHODS:
+            # only the primary holds the unlocked account, and node identity must come from the primary
+            return [primary]
+        if method in PRIMARY_METHODS:
+            secondaries = [each for each in self.endpoints if each.healthy and each is not primary]
+            if primary.healthy:
+                return [primary] + secondaries
+            return secondaries + [primary]
+        synced = [each for each in self.endpoints if each.healthy
+                  and each.blocks_behind is not None and each.blocks_behind <= self.max_blocks_behind]
+        synced.sort(key=lambda each: float("inf") if each.latency is None else each.latency)
+        # nodes that are backing off go last
+        others = sorted([each for each in self.endpoints if each not in synced], key=lambda each: not each.healthy)
+        return synced + others
+
+    def interface(self, request_data, config, logger=None):
+        """
+        Transport factory with the same signature as GethInterface, so a pool
+        can be dropped in as NodeInfo.transport.
+        """
+        return PooledInterface(self, request_data, config, logger)
+
+    def status(self):
+        with self.lock:
+            return [each.status() for each in self.endpoints]
+
+
+class PooledInterface(ipc_socket.GethInterface):
+    def __init__(self, pool, request_data, config_data, logger=None):
+        super().__init__(request_data, config_data, logger)
+        self.pool = pool
+        self.endpoint = None
+
+    def send(self):
+        method = json.loads(self.request_data).get("method")
+        response_raw = b""
+        for endpoint in self.pool.candidates(method):
+            ipc = endpoint.transport(self.request_data, self.config, self.logger)
+            start = time.time()
+            try:
+                response_raw = ipc.send()
+            except OSError as err:
+                self.log_error("Node {0} failed: {1}".format(endpoint.address, err))
+                ipc.response_data = None
+            self.bytes_sent += ipc.bytes_sent
+            self.bytes_received += ipc.bytes_received
+            self.timeouts += ipc.timeouts
+            self.retries += ipc.retries
+            self.parse_time += ipc.parse_time
+            if ipc.response_data is not None:
+                with self.pool.lock:
+                    endpoint.record_success(time.time() - start)
+                self.endpoint = endpoint
+                self.response_data = ipc.response_data
+                return response_raw
+            with self.pool.lock:
+                endpoint.record_failure()
+            self.log_error("Failing over from node {0}".format(endpoint.address))
+        return response_raw
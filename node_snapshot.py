@@ -0,0 +1,222 @@
+# one process polls geth and publishes NodeInfo's status to a memory-mapped file every local process can read
+import json
+import logging
+import mmap
+import os
+import signal
+import struct
+import sys
+import threading
+import time
+
+import log_pipeline
+import rpc_metrics
+import status_history
+import util
+
+# magic, sequence number, publish time, payload length; the JSON payload follows
+HEADER = struct.Struct("<4s4xQdI4x")
+MAGIC = b"NIS1"
+DEFAULT_SIZE = 65536
+DEFAULT_INTERVAL = 5
+# readers go back to asking geth themselves once a snapshot is this many refresh intervals old
+STALE_INTERVALS = 3
+MAX_READ_ATTEMPTS = 100
+
+
+class SnapshotWriter:
+    """
+    Publishes a JSON-able payload seqlock-style: the sequence number is odd
+    while a write is in progress, so a reader that sees it change (or odd)
+    knows its copy is torn and retries.
+    """
+
+    def __init__(self, path, size=DEFAULT_SIZE):
+        self.path = path
+        self.size = size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        magic, sequence, _, _ = HEADER.unpack_from(self.map, 0)
+        # carry on from a previous writer's sequence so readers never see it go backwards
+        self.sequence = sequence + sequence % 2 if magic == MAGIC else 0
+
+    def publish(self, payload):
+        data = json.dumps(payload, separators=(",", ":")).encode('utf-8')
+        if HEADER.size + len(data) > self.size:
+            raise ValueError("Snapshot of {0} bytes does not fit in {1}".format(len(data), self.path))
+        self.sequence += 1
+        HEADER.pack_into(self.map, 0, MAGIC, self.sequence, time.time(), 0)
+        self.map[HEADER.size:HEADER.size + len(data)] = data
+        self.sequence += 1
+        HEADER.pack_into(self.map, 0, MAGIC, self.sequence, time.time(), len(data))
+        return self.sequence
+
+    def close(self):
+        self.map.close()
+
+
+class SnapshotReader:
+    def __init__(self, path, max_age=DEFAULT_INTERVAL * STALE_INTERVALS):
+        self.path = path
+        self.max_age = max_age
+        self.map = None
+        self.inode = None
+
+    def _open(self):
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except OSError:
+            return False
+        try:
+            stat = os.fstat(fd)
+            if stat.st_size < HEADER.size:
+                return False
+            if self.map is not None:
+                self.map.close()
+            self.map = mmap.mmap(fd, stat.st_size, access=mmap.ACCESS_READ)
+            self.inode = stat.st_ino
+            return True
+        finally:
+            os.close(fd)
+
+    def _replaced(self):
+        try:
+            return os.stat(self.path).st_ino != self.inode
+        except OSError:
+            return False
+
+    def read_consistent(self):
+        """
+        Returns (sequence, publish time, payload) from a consistent copy of the
+        snapshot, or None when nothing has been published.
+        """
+        if self.map is None and not self._open():
+            return None
+        for _ in range(MAX_READ_ATTEMPTS):
+            magic, sequence, published, length = HEADER.unpack_from(self.map, 0)
+            if magic != MAGIC or sequence == 0:
+                return None
+            if sequence % 2:
+                time.sleep(0)
+                continue
+            data = self.map[HEADER.size:HEADER.size + length]
+            if HEADER.unpack_from(self.map, 0)[1] == sequence:
+                return sequence, published, json.loads(data.decode('utf-8'))
+        return None
+
+    def read(self):
+        """
+        Returns the published payload, or None when it is missing or older than
+        max_age (e.g. the refresher died), in which case callers should ask geth.
+        """
+        snapshot = self.read_consistent()
+        if snapshot is None or time.time() - snapshot[1] > self.max_age:
+            # the refresher may have been restarted on a new file
+            if self._replaced() and self._open():
+                snapshot = self.read_consistent()
+            if snapshot is None or time.time() - snapshot[1] > self.max_age:
+                return None
+        return snapshot[2]
+
+
+def get_reader(config):
+    """
+    SnapshotReader for config['node_snapshot_file'], or None when no refresher is configured.
+    """
+    if not config or not config.get("node_snapshot_file"):
+        return None
+    interval = config.get("node_snapshot_interval", DEFAULT_INTERVAL)
+    return SnapshotReader(config["node_snapshot_file"],
+                          config.get("node_snapshot_max_age", interval * STALE_INTERVALS))
+
+
+class SnapshotRefresher:
+    """
+    Runs NodeInfo.update() every interval seconds and publishes the result.
+    A failed update publishes nothing, so readers see the snapshot go stale
+    and fall back to geth. Each refresh is also recorded in the status
+    history when config['status_history'] is set, and the history is saved
+    to config['status_history_file'] every status_history_save_interval
+    seconds so a crash loses at most that much.
+    """
+
+    def __init__(self, node_info, path, interval=DEFAULT_INTERVAL, size=DEFAULT_SIZE):
+        self.node_info = node_info
+        # the refresher is the snapshot's source, it must never read it back
+        self.node_info.snapshot = None
+        self.node_info.history = status_history.get_history(node_info.config)
+        config = node_info.config
+        self.history_file = config.get("status_history_file") if self.node_info.history else None
+        self.save_interval = config.get("status_history_save_interval", status_history.DEFAULT_SAVE_INTERVAL)
+        self.last_saved = time.time()
+        self.writer = SnapshotWriter(path, size)
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def refresh(self):
+        if not self.node_info.update():
+            return False
+        self.writer.publish(self.node_info.snapshot_payload())
+        return True
+
+    def save_history(self):
+        if self.history_file and time.time() - self.last_saved >= self.save_interval:
+            self.last_saved = time.time()
+            self.node_info.history.save(self.history_file)
+
+    def run(self):
+        while not self.stopped.is_set():
+            start = time.time()
+            try:
+                self.refresh()
+            except Exception as err:
+                self.node_info._log_error("Snapshot refresh failed: %s", err)
+            try:
+                self.save_history()
+            except Exception as err:
+                self.node_info._log_error("Saving the status history failed: %s", err)
+            self.stopped.wait(max(0, self.interval - (time.time() - start)))
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="node-snapshot", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+
+
+if __name__ == "__main__":
+    from node_information import NodeInfo
+
+    logger = logging.getLogger("NodeSnapshot")
+    logger.setLevel(logging.INFO)
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.INFO)
+    ch.setFormatter(log_pipeline.get_formatter())
+    logger.addHandler(ch)
+    log_pipeline.setup_queue_logging(logger)
+
+    config = util.load_config_from_file()
+    path = sys.argv[1] if len(sys.argv) > 1 else config["node_snapshot_file"]
+    refresher = SnapshotRefresher(NodeInfo(logger, config), path,
+                                  config.get("node_snapshot_interval", DEFAULT_INTERVAL))
+    logger.info("Publishing node status to %s every %s seconds", path, refresher.interval)
+    if config.get("node_snapshot_metrics_port"):
+        rpc_metrics.MetricsServer(refresher.node_info.metrics, config["node_snapshot_metrics_port"],
+                                  history=refresher.node_info.history).start()
+        logger.info("Serving RPC metrics and status history on port %s", config["node_snapshot_metrics_port"])
+    # exit normally on SIGTERM too, so the status history is saved by its atexit handler
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+    try:
+        refresher.run()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,265 @@
+# admission control for node RPCs: a weighted token bucket, a concurrency cap and priority classes
+import fcntl
+import heapq
+import itertools
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+
+# priority classes, lower is admitted first
+PRIORITY_TRANSACTION = 0
+PRIORITY_LIVE = 1
+PRIORITY_BACKFILL = 2
+
+# tokens a call costs; anything not listed costs DEFAULT_WEIGHT
+DEFAULT_WEIGHT = 1
+METHOD_WEIGHTS = {
+    # eth_getBlockByNumber with full transactions
+    "eth_getBlockByNumber_full": 10,
+    "eth_getLogs": 10,
+    "eth_call": 2,
+    "eth_estimateGas": 2,
+    "eth_getTransactionReceipt": 2,
+}
+
+# a waiting caller in one process holds back lower classes in the others for this long after its expected wait
+SHARED_WAIT_SLACK = 0.05
+# how often a caller held back by another process's higher class checks again
+SHARED_POLL_INTERVAL = 0.01
+# tokens, time of the last refill, then per priority class the time until which a caller of that class is waiting
+SHARED_STATE = struct.Struct("<dd3d")
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, method, waited):
+        self.method = method
+        self.waited = waited
+
+    def __str__(self):
+        return "{0} not admitted after {1:.2f} seconds in the queue".format(self.method, self.waited)
+
+
+class SharedTokenBucket:
+    """
+    A token bucket kept in a file and updated under flock, so every process on
+    the host that opens the same file draws from one budget. Callers that
+    can't take their tokens yet leave a mark for their priority class, and
+    while a higher class is marked as waiting, lower classes in every process
+    take nothing.
+    """
+
+    def __init__(self, path, rate, burst):
+        self.path = path
+        self.rate = rate
+        self.burst = burst
+
+    def _locked_state(self, update):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            stored = os.read(fd, SHARED_STATE.size)
+            now = time.time()
+            if len(stored) == SHARED_STATE.size:
+                state = list(SHARED_STATE.unpack(stored))
+                state[0] = min(self.burst, state[0] + max(0, now - state[1]) * self.rate)
+            else:
+                # a new file starts full
+                state = [self.burst, now, 0, 0, 0]
+            state[1] = now
+            result = update(state, now)
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.write(fd, SHARED_STATE.pack(*state))
+            return result
+        finally:
+            # closing releases the flock
+            os.close(fd)
+
+    def take(self, needed, weight, priority):
+        """
+        Takes weight tokens once needed are available and no higher class is
+        waiting; returns None when taken, otherwise the seconds to wait
+        before trying again.
+        """
+        def update(state, now):
+            waiting = state[2:]
+            if any(until > now for until in waiting[:priority]):
+                wait = SHARED_POLL_INTERVAL
+            elif state[0] >= needed:
+                state[0] -= weight
+                return None
+            else:
+                wait = (needed - state[0]) / self.rate
+            waiting[priority] = max(waiting[priority], now + wait + SHARED_WAIT_SLACK)
+            state[2:] = waiting
+            return wait
+        return self._locked_state(update)
+
+    def tokens(self):
+        return self._locked_state(lambda state, now: state[0])
+
+
+class AdmissionController:
+    """
+    Decides when a node RPC may go out. Each call takes its method's weight in
+    tokens from a bucket refilled at rate tokens per second (holding at most
+    burst), at most max_concurrent calls are in flight, and waiting callers
+    are admitted strictly by priority class, oldest first within a class.
+    With neither rate nor max_concurrent set, every call is admitted at once.
+    With shared_file, the bucket is a SharedTokenBucket in that file; the
+    concurrency cap and the queue stay per process.
+    """
+
+    def __init__(self, rate=None, burst=None, max_concurrent=None, weights=None, max_queue_seconds=None,
+                 shared_file=None):
+        self.rate = rate
+        # default to one second's worth of calls
+        self.burst = burst or rate or 0
+        self.tokens = self.burst
+        self.shared = SharedTokenBucket(shared_file, rate, self.burst) if shared_file and rate else None
+        self.max_concurrent = max_concurrent
+        self.weights = dict(METHOD_WEIGHTS)
+        if weights:
+            self.weights.update(weights)
+        self.max_queue_seconds = max_queue_seconds
+        self.condition = threading.Condition()
+        # heap of (priority, sequence) tickets
+        self.waiting = []
+        self.sequence = itertools.count()
+        self.active = 0
+        self.updated = time.monotonic()
+
+    @property
+    def unlimited(self):
+        return not self.rate and not self.max_concurrent
+
+    def weight(self, method, params=None):
+        if method == "eth_getBlockByNumber" and params and len(params) > 1 and params[1]:
+            method = "eth_getBlockByNumber_full"
+        return self.weights.get(method, DEFAULT_WEIGHT)
+
+    def _refill(self, now):
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _take(self, method, params, needed, priority):
+        """
+        Takes the call's tokens and returns None, or returns the seconds until
+        they may be available.
+        """
+        if not self.rate:
+            return None
+        if self.shared:
+            return self.shared.take(needed, self.weight(method, params), priority)
+        self._refill(time.monotonic())
+        if self.tokens < needed:
+            return (needed - self.tokens) / self.rate
+        self.tokens -= self.weight(method, params)
+        return None
+
+    def acquire(self, method, params=None, priority=PRIORITY_LIVE):
+        """
+        Blocks until the call may be sent and returns the seconds it spent
+        queued, or None if that would exceed max_queue_seconds and the call
+        should be dropped. Every admitted call must be followed by release().
+        """
+        if self.unlimited:
+            return 0.0
+        # a call heavier than the whole bucket goes once the bucket is full, leaving it in debt
+        needed = min(self.weight(method, params), self.burst)
+        start = time.monotonic()
+        with self.condition:
+            ticket = (priority, next(self.sequence))
+            heapq.heappush(self.waiting, ticket)
+            try:
+                while True:
+                    wait = None
+                    if self.waiting[0] == ticket:
+                        if self.max_concurrent and self.active >= self.max_concurrent:
+                            # release() wakes us
+                            pass
+                        else:
+                            wait = self._take(method, params, needed, priority)
+                            if wait is None:
+                                break
+                    now = time.monotonic()
+                    if self.max_queue_seconds is not None:
+                        remaining = start + self.max_queue_seconds - now
+                        if remaining <= 0:
+                            return None
+                        wait = remaining if wait is None else min(wait, remaining)
+                    self.condition.wait(wait)
+                self.active += 1
+            finally:
+                self.waiting.remove(ticket)
+                heapq.heapify(self.waiting)
+                # the next ticket in line may be admissible now
+                self.condition.notify_all()
+        return time.monotonic() - start
+
+    def release(self):
+        if self.unlimited:
+            return
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    @contextmanager
+    def admitted(self, method, params=None, priority=PRIORITY_LIVE):
+        """
+        Context manager around a call made outside NodeInfo (e.g. through web3).
+        Raises AdmissionRejected when the call waited too long.
+        """
+        queued = self.acquire(method, params, priority)
+        if queued is None:
+            raise AdmissionRejected(method, self.max_queue_seconds)
+        try:
+            yield queued
+        finally:
+            self.release()
+
+    def status(self):
+        with self.condition:
+            if self.shared:
+                tokens = self.shared.tokens()
+            else:
+                self._refill(time.monotonic())
+                tokens = self.tokens
+            return {"tokens": tokens, "active": self.active, "waiting": len(self.waiting)}
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_limiter(config=None):
+    """
+    One controller per process, configured from config['rpc_rate_limit'],
+    'rpc_burst', 'rpc_max_concurrent', 'rpc_method_weights', 'rpc_max_queue_seconds'
+    and 'rpc_rate_limit_file'. With rpc_rate_limit_file set, the rate and burst
+    are shared by every process using that file, otherwise they are this
+    process's alone.
+    """
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            config = config or {}
+            _limiter = AdmissionController(config.get("rpc_rate_limit"),
+                                           config.get("rpc_burst"),
+                                           config.get("rpc_max_concurrent"),
+                                           config.get("rpc_method_weights"),
+                                           config.get("rpc_max_queue_seconds"),
+                                           config.get("rpc_rate_limit_file"))
+        return _limiter
+
+
+def reset():
+    """
+    Drops the process's controller, so the next get_limiter() builds a new one
+    from its config (e.g. in a forked worker that inherited its parent's).
+    """
+    global _limiter
+    with _limiter_lock:
+        _limiter = None
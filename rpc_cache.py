@@ -0,0 +1,228 @@
+# request coalescing and TTL caching for idempotent node reads
+import json
+import threading
+import time
+from collections import OrderedDict
+
+import util
+
+# ttl policies: seconds, BLOCK (until the next head, capped at block_ttl), FOREVER, DEEP (forever, but only once
+# the block is confirmations below the head, so a reorg can't leave a stale copy), or 0 to disable
+BLOCK = "block"
+FOREVER = None
+DEEP = "deep"
+
+DEFAULT_TTLS = {
+    "eth_syncing": 3,
+    "eth_gasPrice": BLOCK,
+    "eth_getBalance": BLOCK,
+    "admin_peers": 10,
+    "admin_nodeInfo": 300,
+    # "latest" is rewritten to BLOCK in policy()
+    "eth_getBlockByNumber": DEEP,
+    # eth_getBlockByNumber with full transactions; blocks are large and rarely read twice
+    "eth_getBlockByNumber_full": 0,
+    "eth_getBlockTransactionCountByHash": FOREVER,
+    "eth_getTransactionReceipt": DEEP,
+}
+
+# fallback lifetime of BLOCK entries when no new head is reported
+DEFAULT_BLOCK_TTL = 15
+DEFAULT_CONFIRMATIONS = 12
+# budget for the serialized size of all cached responses
+DEFAULT_MAX_BYTES = 8 * 1024 * 1024
+BLOCK_TAGS = ("latest", "pending")
+# RPCMetrics counter for each fetch() outcome
+OUTCOME_COUNTERS = {"hit": "cache_hits", "miss": "cache_misses", "coalesced": "cache_coalesced",
+                    "uncached": "cache_uncached"}
+
+
+def _block_number(method, params, result):
+    """
+    Block a DEEP response belongs to, or None when it can't be told.
+    """
+    try:
+        if method == "eth_getBlockByNumber":
+            return util.hex_to_dec(params[0])
+        return util.hex_to_dec(result["blockNumber"])
+    except (TypeError, ValueError, KeyError, IndexError):
+        return None
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        # raised by the leader's loader, re-raised in every follower
+        self.error = None
+
+
+class RPCCache:
+    """
+    Sits between RPCInterface and the transport. Identical reads in flight at
+    the same time share one RPC, and successful responses are kept for a
+    per-method TTL. Configure with config['rpc_cache_ttls'] (method -> seconds,
+    "block", "deep", null for forever, 0 to disable). The least recently used
+    entries are dropped once the responses add up to more than max_bytes.
+    """
+
+    def __init__(self, ttls=None, block_ttl=DEFAULT_BLOCK_TTL, max_bytes=DEFAULT_MAX_BYTES,
+                 confirmations=DEFAULT_CONFIRMATIONS):
+        self.ttls = dict(DEFAULT_TTLS)
+        if ttls:
+            self.ttls.update(ttls)
+        self.block_ttl = block_ttl
+        self.max_bytes = max_bytes
+        self.confirmations = confirmations
+        self.lock = threading.Lock()
+        # key -> (response, expires, per block, size)
+        self.entries = OrderedDict()
+        self.size = 0
+        self.inflight = {}
+        self.head = None
+        self.hits = {}
+        self.misses = {}
+        self.coalesced = {}
+        # calls to methods that are never cached, kept out of the hit rate
+        self.uncached = {}
+
+    @classmethod
+    def disabled(cls):
+        return cls(dict((method, 0) for method in DEFAULT_TTLS))
+
+    def policy(self, method, params):
+        if method == "eth_getBlockByNumber" and params and len(params) > 1 and params[1]:
+            method = "eth_getBlockByNumber_full"
+        if method not in self.ttls:
+            return 0
+        ttl = self.ttls[method]
+        if method.startswith("eth_getBlockByNumber") and params and params[0] in BLOCK_TAGS:
+            return BLOCK if ttl in (FOREVER, DEEP) else ttl
+        return ttl
+
+    def _store(self, key, entry):
+        # caller holds the lock
+        if key in self.entries:
+            self.size -= self.entries[key][3]
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        self.size += entry[3]
+        while self.size > self.max_bytes and self.entries:
+            self.size -= self.entries.popitem(last=False)[1][3]
+
+    def _drop(self, key):
+        self.size -= self.entries.pop(key)[3]
+
+    def new_head(self, block_number):
+        """
+        Drops every BLOCK entry; called from newHeads or when a later block is seen.
+        """
+        with self.lock:
+            if self.head is not None and block_number <= self.head:
+                return
+            self.head = block_number
+            for key in [key for key, entry in self.entries.items() if entry[2]]:
+                self._drop(key)
+
+    def _count(self, counters, method):
+        counters[method] = counters.get(method, 0) + 1
+
+    def fetch(self, method, params, loader):
+        """
+        Returns (response, outcome) where outcome is "hit", "coalesced", "miss"
+        or "uncached" for a method the policy never caches; loader() performs the RPC and returns the parsed response. Followers of
+        a failed load get the leader's response (e.g. None) or its exception.
+        """
+        ttl = self.policy(method, params)
+        if ttl == 0:
+            with self.lock:
+                self._count(self.uncached, method)
+            return loader(), "uncached"
+        key = (method, json.dumps(params, sort_keys=True))
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and (entry[1] is None or entry[1] > time.time()):
+                self.entries.move_to_end(key)
+                self._count(self.hits, method)
+                return entry[0], "hit"
+            flight = self.inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.inflight[key] = _Flight()
+                self._count(self.misses, method)
+            else:
+                self._count(self.coalesced, method)
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.response, "coalesced"
+        try:
+            flight.response = loader()
+        except Exception as err:
+            flight.error = err
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            flight.done.set()
+        response = flight.response
+        if type(response) == dict and response.get("result") is not None:
+            if ttl == DEEP:
+                block_number = _block_number(method, params, response["result"])
+                head = self.head
+                if block_number is None or head is None or head - block_number < self.confirmations:
+                    return response, "miss"
+                ttl = FOREVER
+            per_block = ttl == BLOCK
+            lifetime = self.block_ttl if per_block else ttl
+            expires = None if lifetime is FOREVER else time.time() + lifetime
+            size = len(json.dumps(response))
+            if size <= self.max_bytes:
+                with self.lock:
+                    self._store(key, (response, expires, per_block, size))
+        return response, "miss"
+
+    def export_state(self, max_entries=None):
+        """
+        The most recently used entries that outlive a head change, as
+        [method, params JSON, response, expires] lists for restore_state().
+        """
+        with self.lock:
+            entries = [[key[0], key[1], entry[0], entry[1]] for key, entry in self.entries.items()
+                       if not entry[2] and (entry[1] is None or entry[1] > time.time())]
+        return entries[-max_entries:] if max_entries else entries
+
+    def restore_state(self, entries):
+        now = time.time()
+        with self.lock:
+            for method, params, response, expires in entries:
+                if expires is None or expires > now:
+                    self._store((method, params), (response, expires, False, len(json.dumps(response))))
+
+    def stats(self):
+        with self.lock:
+            methods = set(self.hits) | set(self.misses) | set(self.coalesced) | set(self.uncached)
+            return {method: {"hits": self.hits.get(method, 0),
+                             "misses": self.misses.get(method, 0),
+                             "coalesced": self.coalesced.get(method, 0),
+                             "uncached": self.uncached.get(method, 0)} for method in methods}
+
+
+_shared_cache = None
+_shared_lock = threading.Lock()
+
+
+def get_shared_cache(config=None):
+    """
+    One cache per process so every NodeInfo coalesces with the others.
+    """
+    global _shared_cache
+    with _shared_lock:
+        if _shared_cache is None:
+            config = config or {}
+            _shared_cache = RPCCache(config.get("rpc_cache_ttls"),
+                                     config.get("rpc_cache_block_ttl", DEFAULT_BLOCK_TTL),
+                                     config.get("rpc_cache_max_bytes", DEFAULT_MAX_BYTES),
+                                     config.get("rpc_cache_confirmations", DEFAULT_CONFIRMATIONS))
+        return _shared_cache
@@ -1,4 +1,5 @@
-import random
+import itertools
+import threading
 import time
 import json
 
@@ -7,36 +8,54 @@ class RPCInterface:
     def __init__(self):
         self.jsonversion = 2.0
         self.outstanding_requests = []
+        # subscription callbacks refresh NodeInfo from another thread
+        self.lock = threading.Lock()
+        # responses are matched to outstanding requests by id, so ids must not repeat
+        self.request_ids = itertools.count(1)
 
     def process_request(self, data):
         request_obj = dict(data)
         request_obj["jsonrpc"] = str(self.jsonversion)
-        request_obj["id"] = random.randint(0, 100)
-        self.outstanding_requests.append(dict(request_id=request_obj["id"],
-                                              obj=request_obj,
-                                              sent=time.time()))
+        with self.lock:
+            request_obj["id"] = next(self.request_ids)
+            self.outstanding_requests.append(dict(request_id=request_obj["id"],
+                                                  obj=request_obj,
+                                                  sent=time.time()))
         return json.dumps(request_obj)
 
     def process_response(self, json_data):
-        try:
-            data = json.loads(json_data)
-        except json.JSONDecodeError as err:
-            data = None
+        # transports that already parsed the response hand over the object itself
+        if type(json_data) in (dict, list):
+            data = json_data
+        else:
+            try:
+                data = json.loads(json_data)
+            except json.JSONDecodeError as err:
+                data = None
         if type(data) == dict and "id" in data:
             output = dict(data)
-            ctr = 0
-            for each in self.outstanding_requests:
-                if each["request_id"] == data["id"]:
-                    output["request_obj"] = each.copy()
-                    output["delay"] = time.time() - each["sent"]
-                    break
-                ctr += 1
-            if ctr < len(self.outstanding_requests):
-                del self.outstanding_requests[ctr]
+            with self.lock:
+                ctr = 0
+                for each in self.outstanding_requests:
+                    if each["request_id"] == data["id"]:
+                        output["request_obj"] = each.copy()
+                        output["delay"] = time.time() - each["sent"]
+                        break
+                    ctr += 1
+                if ctr < len(self.outstanding_requests):
+                    del self.outstanding_requests[ctr]
             return output
         else:
             return data
 
+    def forget_request(self, request_id):
+        """
+        Drops an outstanding request that will never get a response.
+        """
+        with self.lock:
+            self.outstanding_requests = [each for each in self.outstanding_requests
+                                         if each["request_id"] != request_id]
+
     def check_sync(self):
         data = {"method": "eth_syncing", "params": []}
         return self.process_request(data)
@@ -61,6 +80,10 @@ class RPCInterface:
         data = {"method": "eth_getBlockByNumber", "params": [hex(block_number), True]}
         return self.process_request(data)
 
+    def get_block_transaction_count(self, block_hash):
+        data = {"method": "eth_getBlockTransactionCountByHash", "params": [block_hash]}
+        return self.process_request(data)
+
     def get_latest_block(self):
         data = {"method": "eth_getBlockByNumber", "params": ["latest", False]}
         return self.process_request(data)
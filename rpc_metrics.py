@@ -0,0 +1,247 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# upper bounds (seconds) of the latency histogram buckets, Prometheus style
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+
+COUNTERS = ("calls", "errors", "timeouts", "retries", "bytes_sent", "bytes_received",
+            "cache_hits", "cache_misses", "cache_coalesced", "cache_uncached", "rejected")
+
+
+class MethodStats:
+    def __init__(self):
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.latency_sum = 0.0
+        self.calls = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.retries = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.parse_seconds = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_coalesced = 0
+        self.cache_uncached = 0
+        self.rejected = 0
+        # time spent waiting for admission control before the call went out
+        self.queue_buckets = [0] * len(LATENCY_BUCKETS)
+        self.queue_seconds = 0.0
+
+    def percentile(self, fraction, buckets=None):
+        """
+        Estimates a latency percentile from the histogram (or queue_buckets) by
+        interpolating linearly inside the bucket the rank falls in.
+        """
+        if buckets is None:
+            buckets = self.buckets
+        total = sum(buckets)
+        if total == 0:
+            return None
+        rank = fraction * total
+        seen = 0
+        lower = 0.0
+        for i, upper in enumerate(LATENCY_BUCKETS):
+            count = buckets[i]
+            if count and seen + count >= rank:
+                if upper == float("inf"):
+                    return lower
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+            if upper != float("inf"):
+                lower = upper
+        return lower
+
+
+def _add_to_histogram(buckets, value):
+    for i, upper in enumerate(LATENCY_BUCKETS):
+        if value <= upper:
+            buckets[i] += 1
+            break
+
+
+class RPCMetrics:
+    """
+    Per-method RPC latency histograms plus error, timeout, retry and byte
+    counters. Safe to share between the NodeInfo and the metrics endpoint thread.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.methods = {}
+        self.started = time.time()
+
+    def observe(self, method, delay, error=False, timeouts=0, retries=0, bytes_sent=0, bytes_received=0,
+                parse_seconds=0.0, queue_seconds=0.0):
+        with self.lock:
+            stats = self.methods.get(method)
+            if stats is None:
+                stats = self.methods[method] = MethodStats()
+            _add_to_histogram(stats.buckets, delay)
+            _add_to_histogram(stats.queue_buckets, queue_seconds)
+            stats.queue_seconds += queue_seconds
+            stats.latency_sum += delay
+            stats.calls += 1
+            if error:
+                stats.errors += 1
+            stats.timeouts += timeouts
+            stats.retries += retries
+            stats.bytes_sent += bytes_sent
+            stats.bytes_received += bytes_received
+            stats.parse_seconds += parse_seconds
+
+    def count(self, method, counter):
+        """
+        Bumps a counter without recording a call, e.g. cache_hits for reads
+        answered from the RPC cache.
+        """
+        with self.lock:
+            stats = self.methods.get(method)
+            if stats is None:
+                stats = self.methods[method] = MethodStats()
+            setattr(stats, counter, getattr(stats, counter) + 1)
+
+    def summary(self):
+        output = {}
+        with self.lock:
+            for method, stats in self.methods.items():
+                output[method] = {"p50": stats.percentile(0.50),
+                                  "p95": stats.percentile(0.95),
+                                  "p99": stats.percentile(0.99),
+                                  "mean": stats.latency_sum / stats.calls if stats.calls else None}
+                for each in COUNTERS:
+                    output[method][each] = getattr(stats, each)
+                output[method]["parse_seconds"] = stats.parse_seconds
+                output[method]["queue_p95"] = stats.percentile(0.95, stats.queue_buckets)
+                output[method]["queue_seconds"] = stats.queue_seconds
+        return output
+
+    def prometheus_text(self):
+        lines = ["# TYPE erc20_rpc_latency_seconds histogram"]
+        with self.lock:
+            methods = sorted(self.methods.items())
+            for method, stats in methods:
+                cumulative = 0
+                for i, upper in enumerate(LATENCY_BUCKETS):
+                    cumulative += stats.buckets[i]
+                    le = "+Inf" if upper == float("inf") else repr(upper)
+                    lines.append('erc20_rpc_latency_seconds_bucket{method="%s",le="%s"} %d' % (method, le, cumulative))
+                lines.append('erc20_rpc_latency_seconds_sum{method="%s"} %f' % (method, stats.latency_sum))
+                lines.append('erc20_rpc_latency_seconds_count{method="%s"} %d' % (method, stats.calls))
+            for each in COUNTERS[1:]:
+                lines.append("# TYPE erc20_rpc_%s_total counter" % each)
+                for method, stats in methods:
+                    lines.append('erc20_rpc_%s_total{method="%s"} %d' % (each, method, getattr(stats, each)))
+            lines.append("# TYPE erc20_rpc_parse_seconds_total counter")
+            for method, stats in methods:
+                lines.append('erc20_rpc_parse_seconds_total{method="%s"} %f' % (method, stats.parse_seconds))
+            lines.append("# TYPE erc20_rpc_queue_seconds histogram")
+            for method, stats in methods:
+                cumulative = 0
+                for i, upper in enumerate(LATENCY_BUCKETS):
+                    cumulative += stats.queue_buckets[i]
+                    le = "+Inf" if upper == float("inf") else repr(upper)
+                    lines.append('erc20_rpc_queue_seconds_bucket{method="%s",le="%s"} %d' % (method, le, cumulative))
+                lines.append('erc20_rpc_queue_seconds_sum{method="%s"} %f' % (method, stats.queue_seconds))
+                lines.append('erc20_rpc_queue_seconds_count{method="%s"} %d' % (method, cumulative))
+        return "\n".join(lines) + "\n"
+
+    def dump(self, filename):
+        output_stream = open(filename, "w")
+        json.dump({"timestamp": time.time(), "started": self.started, "methods": self.summary()}, output_stream)
+        output_stream.close()
+
+
+class MetricsServer:
+    """
+    Serves RPCMetrics as Prometheus text on http://<host>:<port>/metrics from a
+    daemon thread. Binds to localhost unless told otherwise.
+
+    Given a StatusHistory it also answers /history?start=&end=&tier=&stat= with
+    the sampled node status and /history/aggregate?field=&start=&end= with a
+    summary of one field, both as JSON.
+    """
+
+    def __init__(self, metrics, port, host="127.0.0.1", history=None):
+        self.metrics = metrics
+        self.port = port
+        self.host = host
+        self.history = history
+        self.httpd = None
+
+    def start(self):
+        metrics = self.metrics
+        history = self.history
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path == "/metrics":
+                    self._respond(metrics.prometheus_text(), "text/plain; version=0.0.4")
+                elif url.path in ("/history", "/history/aggregate") and history is not None:
+                    query = dict((key, values[0]) for key, values in parse_qs(url.query).items())
+                    start = float(query["start"]) if "start" in query else None
+                    end = float(query["end"]) if "end" in query else None
+                    try:
+                        if url.path == "/history":
+                            output = history.query(start, end, stat=query.get("stat", "mean"),
+                                                   tier=query.get("tier"))
+                        else:
+                            output = history.aggregate(query["field"], start, end, query.get("tier"))
+                    except (KeyError, ValueError) as err:
+                        self.send_error(400, str(err))
+                        return
+                    self._respond(json.dumps(output), "application/json")
+                else:
+                    self.send_error(404)
+
+            def _respond(self, text, content_type):
+                body = text.encode()
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = HTTPServer((self.host, self.port), Handler)
+        thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+
+
+class MetricsDumper:
+    """
+    Writes RPCMetrics to a JSON file every interval seconds from a daemon thread.
+    """
+
+    def __init__(self, metrics, filename, interval):
+        self.metrics = metrics
+        self.filename = filename
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.metrics.dump(self.filename)
+
+    def start(self):
+        thread = threading.Thread(target=self._run, daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.metrics.dump(self.filename)
@@ -0,0 +1,286 @@
+# rolling history of NodeInfo status samples in fixed-width array columns, downsampled to minutes and hours
+import atexit
+import json
+import math
+import os
+import threading
+import time
+from array import array
+
+FIELDS = ("gas_price", "peers", "blocks_behind", "block_number", "block_gas_used", "block_gas_limit", "rpc_delay")
+STATS = ("mean", "min", "max")
+# (name, seconds per row, rows kept); raw keeps every sample, about 6 hours at a 5 second refresh
+TIERS = (("raw", 0, 4320),
+         ("minute", 60, 10080),
+         ("hour", 3600, 8760))
+NAN = float("nan")
+# seconds between saves to status_history_file while the refresher runs
+DEFAULT_SAVE_INTERVAL = 300
+
+
+def _number(value):
+    return NAN if value is None else float(value)
+
+
+def _output(value):
+    return None if math.isnan(value) else value
+
+
+class Tier:
+    """
+    Ring buffer of rows, each a timestamp, the number of samples it covers
+    and the mean/min/max of every field, stored column-wise in array('d').
+    Rows are appended in time order, so ranges are found by binary search.
+    """
+
+    def __init__(self, name, resolution, capacity):
+        self.name = name
+        self.resolution = resolution
+        self.capacity = capacity
+        self.columns = {"timestamp": array('d', bytes(8 * capacity)),
+                        "count": array('d', bytes(8 * capacity))}
+        for field in FIELDS:
+            for stat in STATS:
+                self.columns[field + "_" + stat] = array('d', bytes(8 * capacity))
+        # position of the oldest row and number of rows held
+        self.start = 0
+        self.size = 0
+
+    def append(self, timestamp, count, values):
+        index = (self.start + self.size) % self.capacity
+        if self.size == self.capacity:
+            self.start = (self.start + 1) % self.capacity
+        else:
+            self.size += 1
+        self.columns["timestamp"][index] = timestamp
+        self.columns["count"][index] = count
+        for field in FIELDS:
+            mean, low, high = values[field]
+            self.columns[field + "_mean"][index] = mean
+            self.columns[field + "_min"][index] = low
+            self.columns[field + "_max"][index] = high
+
+    def _index(self, position):
+        return (self.start + position) % self.capacity
+
+    def _bisect(self, timestamp):
+        # first position whose timestamp is >= timestamp
+        timestamps = self.columns["timestamp"]
+        low = 0
+        high = self.size
+        while low < high:
+            middle = (low + high) // 2
+            if timestamps[self._index(middle)] < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def indexes(self, start=None, end=None):
+        """
+        Ring indexes of the rows with start <= timestamp < end, oldest first.
+        """
+        first = 0 if start is None else self._bisect(start)
+        last = self.size if end is None else self._bisect(end)
+        return [self._index(position) for position in range(first, last)]
+
+    @property
+    def oldest(self):
+        return self.columns["timestamp"][self.start] if self.size else None
+
+
+class _Bucket:
+    """
+    The row a downsampled tier is currently accumulating.
+    """
+
+    def __init__(self, start):
+        self.start = start
+        self.count = 0
+        self.sums = dict.fromkeys(FIELDS, 0.0)
+        self.weights = dict.fromkeys(FIELDS, 0)
+        self.lows = dict.fromkeys(FIELDS, NAN)
+        self.highs = dict.fromkeys(FIELDS, NAN)
+
+    def add(self, count, values):
+        self.count += count
+        for field in FIELDS:
+            mean, low, high = values[field]
+            if math.isnan(mean):
+                continue
+            self.sums[field] += mean * count
+            self.weights[field] += count
+            if math.isnan(self.lows[field]) or low < self.lows[field]:
+                self.lows[field] = low
+            if math.isnan(self.highs[field]) or high > self.highs[field]:
+                self.highs[field] = high
+
+    def row(self):
+        return dict((field, (self.sums[field] / self.weights[field] if self.weights[field] else NAN,
+                             self.lows[field], self.highs[field])) for field in FIELDS)
+
+
+class StatusHistory:
+    """
+    Records a sample per NodeInfo refresh into the raw tier and rolls
+    completed minutes and hours up into the coarser tiers. Queries pick the
+    finest tier that still reaches back to the start of the range.
+    """
+
+    def __init__(self, tiers=TIERS):
+        self.lock = threading.Lock()
+        self.tiers = [Tier(*each) for each in tiers]
+        self.buckets = [None] * len(self.tiers)
+        # (total_rpc_delay, total_rpc_calls) at the previous sample
+        self.last_rpc = None
+
+    def record(self, node_info, timestamp=None):
+        latest_block = node_info.latest_block or {}
+        rpc_delay = NAN
+        if self.last_rpc is not None:
+            calls = node_info.total_rpc_calls - self.last_rpc[1]
+            if calls > 0:
+                rpc_delay = (node_info.total_rpc_delay - self.last_rpc[0]) / calls
+        self.last_rpc = (node_info.total_rpc_delay, node_info.total_rpc_calls)
+        self.add({"gas_price": _number(node_info.gas_price),
+                  "peers": float(len(node_info.peers)),
+                  "blocks_behind": _number(node_info.blocks_behind),
+                  "block_number": _number(latest_block.get("number")),
+                  "block_gas_used": _number(latest_block.get("gas_used")),
+                  "block_gas_limit": _number(latest_block.get("gas_limit")),
+                  "rpc_delay": rpc_delay}, timestamp)
+
+    def add(self, sample, timestamp=None):
+        """
+        :param sample: field -> float (NaN when unknown)
+        """
+        values = dict((field, (sample[field], sample[field], sample[field])) for field in FIELDS)
+        with self.lock:
+            self._append(0, time.time() if timestamp is None else timestamp, 1, values)
+
+    def _append(self, level, timestamp, count, values):
+        self.tiers[level].append(timestamp, count, values)
+        if level + 1 == len(self.tiers):
+            return
+        resolution = self.tiers[level + 1].resolution
+        bucket_start = timestamp - timestamp % resolution
+        bucket = self.buckets[level + 1]
+        if bucket is not None and bucket.start != bucket_start:
+            self._append(level + 1, bucket.start, bucket.count, bucket.row())
+            bucket = None
+        if bucket is None:
+            bucket = self.buckets[level + 1] = _Bucket(bucket_start)
+        bucket.add(count, values)
+
+    def tier(self, start=None, name=None):
+        if name is not None:
+            for each in self.tiers:
+                if each.name == name:
+                    return each
+            raise ValueError("No history tier named {0}".format(name))
+        for each in self.tiers:
+            # a tier that never wrapped still holds everything ever recorded
+            if start is None or each.size < each.capacity or each.oldest <= start:
+                return each
+        return self.tiers[-1]
+
+    def query(self, start=None, end=None, fields=FIELDS, stat="mean", tier=None):
+        """
+        Returns {"tier": name, "timestamp": [...], "count": [...], field: [...]}
+        for the rows in [start, end), using the given stat column of each field.
+        Unknown values come back as None.
+        """
+        with self.lock:
+            selected = self.tier(start, tier)
+            indexes = selected.indexes(start, end)
+            output = {"tier": selected.name,
+                      "timestamp": [selected.columns["timestamp"][i] for i in indexes],
+                      "count": [int(selected.columns["count"][i]) for i in indexes]}
+            for field in fields:
+                column = selected.columns[field + "_" + stat]
+                output[field] = [_output(column[i]) for i in indexes]
+        return output
+
+    def aggregate(self, field, start=None, end=None, tier=None):
+        """
+        Sample-weighted mean, min, max, first and last of field over [start, end).
+        """
+        with self.lock:
+            selected = self.tier(start, tier)
+            indexes = selected.indexes(start, end)
+            counts = selected.columns["count"]
+            means = selected.columns[field + "_mean"]
+            lows = selected.columns[field + "_min"]
+            highs = selected.columns[field + "_max"]
+            indexes = [i for i in indexes if not math.isnan(means[i])]
+            if not indexes:
+                return {"tier": selected.name, "samples": 0}
+            samples = sum(counts[i] for i in indexes)
+            return {"tier": selected.name,
+                    "samples": int(samples),
+                    "mean": sum(means[i] * counts[i] for i in indexes) / samples,
+                    "min": min(lows[i] for i in indexes),
+                    "max": max(highs[i] for i in indexes),
+                    "first": means[indexes[0]],
+                    "last": means[indexes[-1]]}
+
+    def save(self, filename):
+        """
+        Writes every tier as a JSON header line followed by the raw column
+        bytes. Partially filled minute/hour buckets are not kept.
+        """
+        with self.lock:
+            header = [{"name": each.name, "capacity": each.capacity, "start": each.start, "size": each.size,
+                       "columns": sorted(each.columns)} for each in self.tiers]
+            output_stream = open(filename + ".tmp", "wb")
+            output_stream.write(json.dumps(header).encode('utf-8') + b"\n")
+            for each in self.tiers:
+                for column in sorted(each.columns):
+                    each.columns[column].tofile(output_stream)
+            output_stream.close()
+        os.replace(filename + ".tmp", filename)
+
+    def load(self, filename):
+        """
+        Restores tiers saved by save(); tiers whose name or capacity no longer
+        match the configuration are left empty.
+        """
+        input_stream = open(filename, "rb")
+        header = json.loads(input_stream.readline().decode('utf-8'))
+        with self.lock:
+            for saved in header:
+                columns = {}
+                for column in saved["columns"]:
+                    columns[column] = array('d')
+                    columns[column].fromfile(input_stream, saved["capacity"])
+                for each in self.tiers:
+                    if each.name == saved["name"] and each.capacity == saved["capacity"] and \
+                            sorted(each.columns) == saved["columns"]:
+                        each.columns = columns
+                        each.start = saved["start"]
+                        each.size = saved["size"]
+        input_stream.close()
+
+
+_history = None
+_history_lock = threading.Lock()
+
+
+def get_history(config):
+    """
+    The process-wide StatusHistory when config['status_history'] is set, else
+    None. With config['status_history_file'] it is loaded at startup and
+    saved at exit; whoever records into it saves it in between.
+    """
+    global _history
+    if not config or not config.get("status_history"):
+        return None
+    with _history_lock:
+        if _history is None:
+            _history = StatusHistory()
+            filename = config.get("status_history_file")
+            if filename:
+                if os.path.exists(filename):
+                    _history.load(filename)
+                atexit.register(_history.save, filename)
+        return _history
@@ -0,0 +1,58 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import rate_limiter
+
+RATE = 50
+CALLS = 40
+
+
+def _draw(path, priority, results):
+    rate_limiter.reset()
+    limiter = rate_limiter.get_limiter({"rpc_rate_limit": RATE, "rpc_burst": 5, "rpc_rate_limit_file": path})
+    for _ in range(CALLS):
+        with limiter.admitted("eth_blockNumber", priority=priority):
+            pass
+    results.put((priority, time.time()))
+
+
+class SharedBudgetTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "budget")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        rate_limiter.reset()
+
+    def test_processes_share_the_rate(self):
+        results = multiprocessing.Queue()
+        priorities = (rate_limiter.PRIORITY_BACKFILL, rate_limiter.PRIORITY_BACKFILL, rate_limiter.PRIORITY_LIVE)
+        processes = [multiprocessing.Process(target=_draw, args=(self.path, priority, results))
+                     for priority in priorities]
+        start = time.time()
+        for each in processes:
+            each.start()
+        finished = [results.get(timeout=30) for _ in processes]
+        for each in processes:
+            each.join()
+        elapsed = max(finish for priority, finish in finished) - start
+        # one budget for all three processes, less the burst they start with
+        self.assertGreater(elapsed, (len(priorities) * CALLS - 5) / RATE * 0.9)
+        live = [finish for priority, finish in finished if priority == rate_limiter.PRIORITY_LIVE][0]
+        backfill = [finish for priority, finish in finished if priority == rate_limiter.PRIORITY_BACKFILL]
+        # the live process goes ahead of both backfill processes
+        self.assertLess(live, min(backfill))
+
+    def test_reset(self):
+        limiter = rate_limiter.get_limiter({"rpc_rate_limit": RATE})
+        rate_limiter.reset()
+        self.assertIsNot(rate_limiter.get_limiter({"rpc_rate_limit": RATE}), limiter)
+
+
+if __name__ == "__main__":
+    unittest.main()
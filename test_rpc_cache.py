@@ -0,0 +1,118 @@
+import json
+import logging
+import threading
+import time
+import unittest
+
+import node_information
+import rpc_cache
+
+
+class DeadTransport:
+    """
+    Stands in for a GethInterface whose node never answers.
+    """
+
+    def __init__(self, request_data, config, logger=None):
+        self.response_data = None
+        self.timeouts = 0
+        self.retries = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.parse_time = 0
+
+    def send(self):
+        # long enough for the other threads to join the same flight
+        time.sleep(0.2)
+        return b""
+
+
+class FailingTransport(DeadTransport):
+    def send(self):
+        time.sleep(0.2)
+        raise OSError("connection refused")
+
+
+def node_info(transport):
+    info = node_information.NodeInfo(logging.getLogger("test_rpc_cache"), {"ipc_address": "/nonexistent",
+                                                                         "max_rpc_tries": 1,
+                                                                         "account": "0x" + "00" * 20})
+    info.rpc_cache = rpc_cache.RPCCache()
+    info.transport = transport
+    return info
+
+
+def call_concurrently(func, count=3):
+    outcomes = [None] * count
+
+    def run(index):
+        try:
+            outcomes[index] = ("returned", func())
+        except Exception as err:
+            outcomes[index] = ("raised", err)
+    threads = [threading.Thread(target=run, args=(index,)) for index in range(count)]
+    for each in threads:
+        each.start()
+    for each in threads:
+        each.join()
+    return outcomes
+
+
+class CoalescedFailureTest(unittest.TestCase):
+    def test_followers_get_the_leaders_failed_response(self):
+        info = node_info(DeadTransport)
+        outcomes = call_concurrently(info.update)
+        self.assertEqual(outcomes, [("returned", False)] * 3)
+        self.assertEqual(sum(stats["coalesced"] for stats in info.rpc_cache.stats().values()), 2)
+        self.assertEqual(info.rpc_interface.outstanding_requests, [])
+
+    def test_followers_get_the_leaders_exception(self):
+        info = node_info(FailingTransport)
+        outcomes = call_concurrently(info.update)
+        self.assertEqual([outcome[0] for outcome in outcomes], ["raised"] * 3)
+        self.assertTrue(all(isinstance(outcome[1], OSError) for outcome in outcomes))
+
+
+def block_response(number, full=False):
+    transactions = [{"hash": "0x" + "ab" * 32, "input": "0x" + "00" * 512}] if full else []
+    return {"id": 1, "delay": 0, "result": {"number": hex(number), "transactions": transactions}}
+
+
+class CachePolicyTest(unittest.TestCase):
+    def fetch_twice(self, cache, method, params, response):
+        return [cache.fetch(method, params, lambda: response)[1] for _ in range(2)]
+
+    def test_blocks_near_the_head_are_not_cached(self):
+        cache = rpc_cache.RPCCache()
+        cache.new_head(100)
+        self.assertEqual(self.fetch_twice(cache, "eth_getBlockByNumber", [hex(95), False], block_response(95)),
+                         ["miss", "miss"])
+        self.assertEqual(self.fetch_twice(cache, "eth_getBlockByNumber", [hex(80), False], block_response(80)),
+                         ["miss", "hit"])
+
+    def test_full_blocks_are_not_cached_by_default(self):
+        cache = rpc_cache.RPCCache()
+        cache.new_head(100)
+        self.assertEqual(self.fetch_twice(cache, "eth_getBlockByNumber", [hex(80), True], block_response(80, True)),
+                         ["uncached", "uncached"])
+        self.assertEqual(cache.size, 0)
+
+    def test_uncacheable_calls_are_not_misses(self):
+        cache = rpc_cache.RPCCache({"eth_gasPrice": 0})
+        self.assertEqual(self.fetch_twice(cache, "eth_gasPrice", [], {"id": 1, "delay": 0, "result": "0x1"}),
+                         ["uncached", "uncached"])
+        self.assertEqual(cache.stats(), {"eth_gasPrice": {"hits": 0, "misses": 0, "coalesced": 0, "uncached": 2}})
+
+    def test_entries_are_dropped_over_the_byte_budget(self):
+        size = len(json.dumps(block_response(80, True)))
+        cache = rpc_cache.RPCCache({"eth_getBlockByNumber_full": rpc_cache.DEEP}, max_bytes=size * 2)
+        cache.new_head(100)
+        for number in (80, 81, 82):
+            cache.fetch("eth_getBlockByNumber", [hex(number), True], lambda: block_response(number, True))
+        self.assertEqual(len(cache.entries), 2)
+        self.assertLessEqual(cache.size, size * 2)
+        self.assertEqual(cache.fetch("eth_getBlockByNumber", [hex(80), True], lambda: None)[1], "miss")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import unittest
+
+# run in a child process: the first top-level span blocks inside flush() until the test sends SIGTERM
+CHILD = """
+import sys
+import time
+import tracing
+
+real_dumps = tracing.json.dumps
+
+
+class SlowJSON:
+    @staticmethod
+    def dumps(value):
+        print("flushing", flush=True)
+        time.sleep(5)
+        return real_dumps(value)
+
+
+tracing.enable(sys.argv[1])
+tracing.json = SlowJSON
+with tracing.span("command.run"):
+    pass
+"""
+
+
+class SigtermTest(unittest.TestCase):
+    def test_sigterm_during_flush_exits_with_a_complete_trace(self):
+        trace_file = os.path.join(tempfile.mkdtemp(), "trace.json")
+        child = subprocess.Popen([sys.executable, "-c", CHILD, trace_file], stdout=subprocess.PIPE,
+                                 cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(child.stdout.readline().strip(), b"flushing")
+        child.send_signal(signal.SIGTERM)
+        try:
+            returncode = child.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            child.kill()
+            raise
+        finally:
+            child.stdout.close()
+        self.assertEqual(returncode, 128 + signal.SIGTERM)
+        trace_stream = open(trace_file, "r")
+        events = json.load(trace_stream)
+        trace_stream.close()
+        self.assertIsInstance(events, list)
+
+
+if __name__ == "__main__":
+    unittest.main()
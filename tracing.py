@@ -0,0 +1,213 @@
+# opt-in timed spans for command execution, exported as Chrome trace JSON (chrome://tracing, Perfetto)
+import atexit
+import cProfile
+import functools
+import json
+import os
+import signal
+import threading
+import time
+
+# buffered events are written out when a top-level span (e.g. a whole command) ends, or once there are this many
+FLUSH_EVENTS = 1000
+
+_tracer = None
+_previous_sigterm = None
+
+
+class Span:
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.span_id = None
+        self.parent_id = None
+        self.start = None
+
+    def __enter__(self):
+        self.tracer._push(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.perf_counter() - self.start
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        self.tracer._pop(self, duration)
+        return False
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+class Tracer:
+    """
+    Streams events to trace_file in Chrome's JSON array format, which the
+    viewers load even when the closing bracket is missing, so a trace cut
+    short by a crash is still readable up to the last flush.
+    """
+
+    def __init__(self, trace_file, profile_dir=None):
+        self.trace_file = trace_file
+        self.profile_dir = profile_dir
+        self.events = []
+        self.lock = threading.Lock()
+        # held while writing, so recording spans never waits on the file
+        self.write_lock = threading.Lock()
+        self.output_stream = None
+        self.written = 0
+        # spans still running on other threads when the trace is completed are dropped
+        self.closed = False
+        self.local = threading.local()
+        self.next_id = 1
+        self.pid = os.getpid()
+        # perf_counter has no fixed epoch, so anchor it to wall time once
+        self.epoch = time.time() - time.perf_counter()
+
+    def _stack(self):
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def _push(self, span):
+        stack = self._stack()
+        with self.lock:
+            span.span_id = self.next_id
+            self.next_id += 1
+        if stack:
+            span.parent_id = stack[-1].span_id
+        stack.append(span)
+
+    def _pop(self, span, duration):
+        stack = self._stack()
+        if stack and stack[-1] is span:
+            stack.pop()
+        args = dict(span.args)
+        args["span_id"] = span.span_id
+        if span.parent_id:
+            args["parent_id"] = span.parent_id
+        event = {"name": span.name,
+                 "cat": span.name.split(".")[0],
+                 "ph": "X",
+                 "ts": (self.epoch + span.start) * 1e6,
+                 "dur": duration * 1e6,
+                 "pid": self.pid,
+                 "tid": threading.get_ident(),
+                 "args": args}
+        with self.lock:
+            self.events.append(event)
+            full = len(self.events) >= FLUSH_EVENTS
+        if full or not stack:
+            self.flush()
+
+    def span(self, name, **args):
+        return Span(self, name, args)
+
+    def profile_path(self, name):
+        if not self.profile_dir:
+            return None
+        return os.path.join(self.profile_dir, "{0}-{1}.prof".format(name, int(time.time() * 1000)))
+
+    def flush(self):
+        with self.write_lock:
+            with self.lock:
+                events = self.events
+                self.events = []
+            if not events or self.closed:
+                return
+            if self.output_stream is None:
+                output_stream = open(self.trace_file, "w")
+                output_stream.write("[\n")
+                self.output_stream = output_stream
+            for event in events:
+                # one write per event, so a SystemExit raised between them leaves the array well formed
+                self.output_stream.write((",\n" if self.written else "") + json.dumps(event))
+                self.written += 1
+            self.output_stream.flush()
+
+    def export(self):
+        """
+        Writes the remaining events and closes the array.
+        """
+        self.flush()
+        with self.write_lock:
+            if self.output_stream is None:
+                self.output_stream = open(self.trace_file, "w")
+                self.output_stream.write("[")
+            self.output_stream.write("\n]\n")
+            self.output_stream.close()
+            self.closed = True
+
+
+def enable(trace_file, profile_dir=None):
+    """
+    Turns tracing on for the process. Events are appended to trace_file as
+    commands finish and the trace is completed at exit, on SIGTERM or on
+    disable(); with profile_dir set, every span declared with profile=True also
+    runs under cProfile and dumps a .prof file there.
+    """
+    global _tracer, _previous_sigterm
+    if profile_dir and not os.path.isdir(profile_dir):
+        os.makedirs(profile_dir)
+    _tracer = Tracer(trace_file, profile_dir)
+    atexit.register(disable)
+    if threading.current_thread() is threading.main_thread():
+        _previous_sigterm = signal.signal(signal.SIGTERM, _on_sigterm)
+    return _tracer
+
+
+def _on_sigterm(signum, frame):
+    # the handler can interrupt the main thread while it holds the tracer's locks, so the trace is
+    # completed by the atexit disable() once SystemExit has unwound them
+    if callable(_previous_sigterm):
+        _previous_sigterm(signum, frame)
+    else:
+        # exit normally, so the other atexit handlers (worker state, memory report) run too
+        raise SystemExit(128 + signum)
+
+
+def disable():
+    global _tracer
+    if _tracer:
+        tracer = _tracer
+        _tracer = None
+        tracer.export()
+
+
+def span(name, **args):
+    if _tracer is None:
+        return NULL_SPAN
+    return _tracer.span(name, **args)
+
+
+def traced(name, profile=False):
+    """
+    Decorator wrapping a function in a span. Costs a single global lookup when
+    tracing is off.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            tracer = _tracer
+            if tracer is None:
+                return func(*args, **kwargs)
+            with tracer.span(name):
+                profile_path = tracer.profile_path(name) if profile else None
+                if profile_path is None:
+                    return func(*args, **kwargs)
+                profiler = cProfile.Profile()
+                try:
+                    return profiler.runcall(func, *args, **kwargs)
+                finally:
+                    profiler.dump_stats(profile_path)
+        return wrapper
+    return decorator
@@ -1,21 +1,78 @@
+import gzip
 import json
+import zlib
+from decimal import Context, Decimal
+from itertools import repeat
+from operator import itemgetter
 
 # should probably change this in production to an absolute path
 DEFAULT_CONFIG_PATH = "/home/ethereum/ERC20Interface/config/config.json"
 
+WEI_PER_ETHER = 10**18
+# enough digits for any uint256, so wei <-> ether conversions never round
+EXACT_CONTEXT = Context(prec=100)
+# zlib level for request bodies, most of the size win of 9 for a fraction of the CPU
+COMPRESSION_LEVEL = 6
+
 
 def wei_to_ether(wei):
-    return 1.0 * wei / 10**18
+    return Decimal(wei).scaleb(-18, EXACT_CONTEXT)
 
 
 def ether_to_wei(ether):
-    return ether * 10**18
+    if type(ether) is float:
+        ether = str(ether)
+    return int(Decimal(ether).scaleb(18, EXACT_CONTEXT))
 
 
 def hex_to_dec(x):
     return int(x, 16)
 
 
+def blocks_behind(syncing):
+    """
+    Number of blocks a node is behind, from an eth_syncing result (False when synced).
+    """
+    if type(syncing) == dict:
+        return hex_to_dec(syncing["highestBlock"]) - hex_to_dec(syncing["currentBlock"])
+    return 0
+
+
+def hex_columns(rows, fields):
+    """
+    Decodes hex quantity fields from a list of RPC objects (e.g. a block's
+    transactions) into one list of ints per field, a column at a time.
+
+    :param rows: list of dicts as returned by the node
+    :param fields: names of the hex fields to decode
+    :return: dict of field name -> list of ints in row order
+    """
+    output = {}
+    for field in fields:
+        output[field] = list(map(int, map(itemgetter(field), rows), repeat(16)))
+    return output
+
+
+def encode_json_body(data, compression=None):
+    """
+    Compact JSON request body for data, gzip or deflate compressed when asked.
+
+    :param compression: None, "gzip" or "deflate"
+    :return: (body bytes, headers dict)
+    """
+    body = json.dumps(data, separators=(",", ":")).encode('utf-8')
+    headers = {'Content-Type': 'application/json'}
+    if compression == "gzip":
+        body = gzip.compress(body, COMPRESSION_LEVEL)
+    elif compression == "deflate":
+        body = zlib.compress(body, COMPRESSION_LEVEL)
+    elif compression:
+        raise ValueError("Unsupported compression: {0}".format(compression))
+    if compression:
+        headers['Content-Encoding'] = compression
+    return body, headers
+
+
 def clean_hex(d):
     return hex(d).rstrip('L')
 
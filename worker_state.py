@@ -0,0 +1,192 @@
+# saves a command worker's state to a local file so a restarted worker resumes where it left off
+import atexit
+import gzip
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import call_cache
+import erc20
+import gas_cache
+
+VERSION = 1
+DEFAULT_INTERVAL = 10
+# node status is only taken from a file saved this recently
+DEFAULT_MAX_AGE = 300
+# RPC and eth_call cache entries kept in the file, the most recently used; full blocks make these large
+DEFAULT_CACHE_ENTRIES = 32
+MAX_COMPLETED_COMMANDS = 256
+# outputs larger than this (e.g. block data) are not kept; those commands are cheap reads and just run again
+MAX_STORED_OUTPUT = 4096
+# commands that only read, so running one again after a restart is harmless
+READ_ONLY_FUNCTIONS = ("total_supply",)
+
+
+def read_only(command_data):
+    return "get_block_data" in command_data or command_data.get("erc20_function") in READ_ONLY_FUNCTIONS
+
+
+class WorkerState:
+    """
+    Periodically writes the state a CommandModule would otherwise rebuild by
+    asking geth and the Node API again: the commands it finished (and their
+    outputs), the command it was running, transactions still being followed,
+    node status and the RPC, eth_call and gas estimate caches. The local nonce
+    is not saved; LocalSigner keeps it in a file of its own.
+    The file is gzipped JSON, replaced atomically on every save.
+    """
+
+    def __init__(self, command_module, filename, interval=DEFAULT_INTERVAL, max_age=DEFAULT_MAX_AGE,
+                 cache_entries=DEFAULT_CACHE_ENTRIES):
+        self.command_module = command_module
+        self.config = command_module.config
+        self.logger = command_module.logger
+        self.filename = filename
+        self.interval = interval
+        self.max_age = max_age
+        self.cache_entries = cache_entries
+        self.lock = threading.Lock()
+        # save() runs from the command loop and the periodic thread; the later snapshot must be the one written
+        self.save_lock = threading.Lock()
+        # command id -> output posted for it, None when it was too large to keep
+        self.completed = OrderedDict()
+        # (command id, command data) of the command being run
+        self.running = None
+        self.saves = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def command_started(self, command_id, command_data):
+        """
+        Commands that send transactions are saved before they run and again
+        once their output is posted; reads are left to the periodic save.
+        """
+        with self.lock:
+            self.running = (command_id, command_data)
+        if not read_only(command_data):
+            self.save()
+
+    def command_done(self, command_id, output):
+        """
+        Records the first output posted for a command; a later one (e.g. the
+        same output posted again after a restart) doesn't replace it.
+        """
+        if len(json.dumps(output)) > MAX_STORED_OUTPUT:
+            output = None
+        with self.lock:
+            if command_id not in self.completed:
+                self.completed[command_id] = output
+            self.completed.move_to_end(command_id)
+            while len(self.completed) > MAX_COMPLETED_COMMANDS:
+                self.completed.popitem(last=False)
+            durable = self.running and self.running[0] == command_id and not read_only(self.running[1])
+            if self.running and self.running[0] == command_id:
+                self.running = None
+        if durable:
+            self.save()
+
+    def previous_run(self, command_id):
+        """
+        Returns ("done", output) for a command finished before the restart
+        (output is None when it wasn't kept), ("interrupted", command data) for
+        the command that was running when the worker stopped, or None.
+        """
+        with self.lock:
+            if command_id in self.completed:
+                return "done", self.completed[command_id]
+            if self.running and self.running[0] == command_id:
+                return "interrupted", self.running[1]
+        return None
+
+    def collect(self):
+        config = self.config
+        node_info = self.command_module.node_info
+        with self.lock:
+            state = {"version": VERSION,
+                     "saved": time.time(),
+                     "completed": list(self.completed.items()),
+                     "running": self.running}
+        state["node_info"] = node_info.snapshot_payload()
+        state["rpc_cache"] = node_info.rpc_cache.export_state(self.cache_entries)
+        state["call_cache"] = call_cache.get_call_cache(config).export_state(self.cache_entries)
+        state["gas_cache"] = gas_cache.get_gas_cache(config, self.logger).export_state()
+        state["transactions"] = erc20.get_transaction_monitor(config, self.logger).export_state()
+        return state
+
+    def save(self):
+        with self.save_lock:
+            state = self.collect()
+            data = gzip.compress(json.dumps(state, separators=(",", ":")).encode('utf-8'))
+            output_stream = open(self.filename + ".tmp", "wb")
+            output_stream.write(data)
+            output_stream.close()
+            os.replace(self.filename + ".tmp", self.filename)
+            self.saves += 1
+
+    def load(self):
+        """
+        Restores a file written by save(). Returns False if there is none.
+        """
+        if not os.path.exists(self.filename):
+            return False
+        start = time.time()
+        input_stream = open(self.filename, "rb")
+        state = json.loads(gzip.decompress(input_stream.read()).decode('utf-8'))
+        input_stream.close()
+        if state.get("version") != VERSION:
+            self.logger.error("Ignoring worker state %s with version %s", self.filename, state.get("version"))
+            return False
+        config = self.config
+        node_info = self.command_module.node_info
+        with self.lock:
+            self.completed = OrderedDict((command_id, output) for command_id, output in state["completed"])
+            self.running = tuple(state["running"]) if state["running"] else None
+        node_info.rpc_cache.restore_state(state["rpc_cache"])
+        call_cache.get_call_cache(config).restore_state(state["call_cache"])
+        gas_cache.get_gas_cache(config, self.logger).restore_state(state["gas_cache"])
+        transactions = erc20.get_transaction_monitor(config, self.logger).restore_state(state["transactions"])
+        age = start - state["saved"]
+        if age <= self.max_age:
+            node_info.load_payload(state["node_info"])
+        self.logger.info("Restored worker state from %s (%.0f seconds old, %s pending transactions) in %.1f ms",
+                         self.filename, age, transactions, (time.time() - start) * 1000)
+        return True
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.save()
+            except Exception as err:
+                self.logger.error("Saving worker state to %s failed: %s", self.filename, err)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="worker-state", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        self.save()
+
+
+def get_worker_state(command_module):
+    """
+    WorkerState for config['worker_state_file'], loaded and saving every
+    config['worker_state_interval'] seconds and at exit, or None when it
+    isn't configured.
+    Each worker process needs a file of its own.
+    """
+    config = command_module.config
+    if not config.get("worker_state_file"):
+        return None
+    state = WorkerState(command_module, config["worker_state_file"],
+                        config.get("worker_state_interval", DEFAULT_INTERVAL),
+                        config.get("worker_state_max_age", DEFAULT_MAX_AGE),
+                        config.get("worker_state_cache_entries", DEFAULT_CACHE_ENTRIES))
+    state.load()
+    atexit.register(state.stop)
+    return state.start()